@@ -0,0 +1,115 @@
+"""
+Compare step throughput of inline execution (instance pool in the calling process) with the
+process pool backend. Each operation encodes a WasmRequest, executes the detective module and
+parses the WasmResponse, the same work StreamdalClient._call_wasm() does per step.
+
+Run `make test/wasm` first to download the wasm modules, then:
+
+    python benchmarks/bench_execution_mode.py --threads 8 --seconds 5
+"""
+
+import argparse
+import os
+import sys
+import time
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal.hostfunc as hostfunc  # noqa: E402
+import streamdal.procpool as procpool  # noqa: E402
+import streamdal.wasm as wasm  # noqa: E402
+import streamdal_protos.protos as protos  # noqa: E402
+from streamdal.kv import KV  # noqa: E402
+
+
+def new_request(payload_size: int) -> protos.WasmRequest:
+    field = b"x" * max(0, payload_size - 64)
+    payload = b'{"object": {"field": "streamdal@gmail.com", "pad": "' + field + b'"}}'
+
+    step = protos.PipelineStep(
+        name="detective",
+        wasm_id="detective",
+        wasm_function="f",
+        detective=protos.steps.DetectiveStep(
+            path="object.field",
+            args=["streamdal"],
+            negate=False,
+            type=protos.steps.DetectiveType.DETECTIVE_TYPE_STRING_CONTAINS_ANY,
+        ),
+    )
+
+    return protos.WasmRequest(step=step, input_payload=payload)
+
+
+def run(name: str, execute, req: protos.WasmRequest, threads: int, seconds: float):
+    stop = Event()
+    counts = [0] * threads
+
+    def worker(idx: int):
+        while not stop.is_set():
+            res = execute(bytes(req))
+            if protos.WasmResponse().parse(res).exit_code != 1:
+                raise Exception("unexpected exit code")
+            counts[idx] += 1
+
+    workers = [Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+
+    time.sleep(seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+
+    elapsed = time.perf_counter() - started
+    total = sum(counts)
+    print(
+        f"{name:<10} {total / elapsed:>12,.0f} steps/s  ({total} steps, {threads} threads)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--wasm", default="./test-assets/wasm/detective.wasm")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--payload-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    with open(args.wasm, "rb") as f:
+        wasm_bytes = f.read()
+
+    req = new_request(args.payload_size)
+
+    # Inline: one instance per thread from the instance pool
+    linker = wasm.new_linker(hostfunc.HostFunc(kv=KV()))
+    module = wasm.modules.get(wasm_bytes)
+    pool = wasm.InstancePool(lambda: wasm.new_instance(linker, module), args.threads)
+
+    def inline(data: bytes) -> bytes:
+        with pool.instance() as inst:
+            return wasm.call(inst, "f", data)
+
+    run("inline", inline, req, args.threads, args.seconds)
+
+    # Pooled: steps run in worker processes, payloads go through shared memory
+    processes = procpool.ProcessPool(args.workers, kv=KV())
+    processes.register("detective", wasm_bytes)
+
+    try:
+        run(
+            "process",
+            lambda data: processes.execute("detective", "f", data),
+            req,
+            args.threads,
+            args.seconds,
+        )
+    finally:
+        processes.shutdown()
+
+
+if __name__ == "__main__":
+    main()
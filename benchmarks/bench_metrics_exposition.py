@@ -0,0 +1,66 @@
+"""
+Measure how long rendering the Prometheus exposition takes. The first scrape encodes the start of
+every series' sample line, later scrapes reuse those and only format the values, as a scraper
+polling a steady set of series sees.
+
+No server is needed, metrics are never published:
+
+    python benchmarks/bench_metrics_exposition.py --series 50000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from threading import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal_protos.protos as protos  # noqa: E402
+from streamdal.exposition import Exposition  # noqa: E402
+from streamdal.metrics import Metrics  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--series", type=int, default=50000)
+    parser.add_argument("--scrapes", type=int, default=10)
+    args = parser.parse_args()
+
+    # With exit already set the background workers return immediately
+    exit = Event()
+    exit.set()
+
+    metrics = Metrics(
+        loop=asyncio.new_event_loop(), exit=exit, max_series=args.series + 1
+    )
+    aud = protos.Audience(
+        service_name="bench",
+        component_name="kafka",
+        operation_type=protos.OperationType.OPERATION_TYPE_CONSUMER,
+        operation_name="orders",
+    )
+    for i in range(args.series):
+        metrics.counter("counter_consume_bytes", {"pipeline_id": str(i)}, aud).add(1.0)
+    metrics.take_counters()
+
+    exposition = Exposition(metrics)
+
+    started = time.perf_counter()
+    size = sum(len(chunk) for chunk in exposition.render())
+    first = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(args.scrapes):
+        for _ in exposition.render():
+            pass
+    later = (time.perf_counter() - started) / args.scrapes
+
+    print(f"{args.series} series, {size / 1024:.0f} KiB per scrape")
+    print(f"{'first scrape':<14} {first * 1000:>8.1f}ms")
+    print(f"{'later scrapes':<14} {later * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
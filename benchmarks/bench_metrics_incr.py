@@ -0,0 +1,188 @@
+"""
+Measure Metrics.incr() under contention, comparing the per-thread counter shards against the
+previous design, where incr() put entries on a queue that three worker threads drained into a
+map of counters behind a global lock. The "handle" case adds to counter handles resolved once
+with Metrics.counter(), as process() does. For each case the benchmark reports how long the producer
+threads took to make their increments, and how long until every increment was counted.
+
+No server is needed, metrics are never published:
+
+    python benchmarks/bench_metrics_incr.py --threads 8 --number 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+from queue import Empty, SimpleQueue
+from threading import Event, Lock, Thread, local
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal_protos.protos as protos  # noqa: E402
+from streamdal.metrics import (  # noqa: E402
+    CounterEntry,
+    CounterStore,
+    DEFAULT_MAX_SERIES,
+    Metrics,
+    composite_id,
+    new_overflow_handle,
+)
+
+QUEUE_WORKERS = 3
+
+
+class LockedCounter:
+    """A counter incremented under a lock, as the queue workers' counters were"""
+
+    lock = Lock()
+
+    def __init__(self):
+        self.value = 0.0
+
+    def incr(self, value: float) -> None:
+        with self.lock:
+            self.value += value
+
+
+class QueueMetrics:
+    """The previous incr() path: a queue drained by worker threads into locked counters"""
+
+    def __init__(self):
+        self.queue = SimpleQueue()
+        self.counters = {}
+        self.lock = Lock()
+        self.exit = Event()
+        self.workers = [Thread(target=self.work) for _ in range(QUEUE_WORKERS)]
+        for w in self.workers:
+            w.start()
+
+    def incr(self, entry: CounterEntry) -> None:
+        self.queue.put_nowait(entry)
+
+    def work(self) -> None:
+        while not self.exit.is_set():
+            try:
+                entry = self.queue.get(block=False)
+            except Empty:
+                self.exit.wait(0.001)
+                continue
+
+            key = composite_id(entry)
+            with self.lock:
+                counter = self.counters.get(key)
+                if counter is None:
+                    counter = LockedCounter()
+                    self.counters[key] = counter
+            counter.incr(entry.value)
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(c.value for c in self.counters.values())
+
+    def stop(self) -> None:
+        self.exit.set()
+        for w in self.workers:
+            w.join()
+
+
+class ShardedMetrics:
+    """Metrics with only the parts incr() and merge() use, so no threads are started"""
+
+    def __init__(self):
+        metrics = object.__new__(Metrics)
+        metrics.lock = Lock()
+        metrics.counters = CounterStore(metrics.lock)
+        metrics.shards = []
+        metrics.shard = local()
+        metrics.handles = {}
+        metrics.exempt = {}
+        metrics.entries = {}
+        metrics.generation = 1
+        metrics.buckets = {}
+        metrics.max_series = DEFAULT_MAX_SERIES
+        metrics.overflow = new_overflow_handle(metrics)
+        self.metrics = metrics
+
+    def incr(self, entry: CounterEntry) -> None:
+        self.metrics.incr(entry)
+
+    def total(self) -> float:
+        self.metrics.merge()
+        return sum(self.metrics.counters.values)
+
+    def stop(self) -> None:
+        pass
+
+
+class HandleMetrics(ShardedMetrics):
+    """Adds to a handle per entry instead of passing the entry to incr()"""
+
+    def __init__(self):
+        super().__init__()
+        self.handles = {}
+
+    def incr(self, entry: CounterEntry) -> None:
+        handle = self.handles.get(id(entry))
+        if handle is None:
+            handle = self.metrics.counter(entry.name, entry.labels, entry.aud)
+            self.handles[id(entry)] = handle
+        handle.add(entry.value)
+
+
+def run(name: str, metrics, threads: int, number: int, labels: int) -> None:
+    aud = protos.Audience(service_name="bench", component_name="kafka")
+    entries = [
+        CounterEntry(
+            name="counter_consume_processed",
+            aud=aud,
+            labels={"pipeline_id": str(i)},
+            value=1.0,
+        )
+        for i in range(labels)
+    ]
+
+    def produce():
+        for i in range(number):
+            metrics.incr(entries[i % labels])
+
+    producers = [Thread(target=produce) for _ in range(threads)]
+    started = time.perf_counter()
+    for p in producers:
+        p.start()
+    for p in producers:
+        p.join()
+    produced = time.perf_counter() - started
+
+    expected = float(threads * number)
+    while metrics.total() < expected:
+        time.sleep(0.001)
+    counted = time.perf_counter() - started
+
+    metrics.stop()
+
+    print(
+        f"{name:<8} {threads * number / produced:>14,.0f} incr/s "
+        f"{produced:>9.3f}s {counted:>11.3f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--labels", type=int, default=16)
+    args = parser.parse_args()
+
+    print(
+        f"{args.threads} threads, {args.number} increments each, {args.labels} counters"
+    )
+    print(f"{'':<8} {'throughput':>21} {'produced':>10} {'all counted':>12}")
+
+    run("queue", QueueMetrics(), args.threads, args.number, args.labels)
+    run("sharded", ShardedMetrics(), args.threads, args.number, args.labels)
+    run("handle", HandleMetrics(), args.threads, args.number, args.labels)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure the memory used per counter series: the counter itself, its key, its CounterEntry and
+labels, and the handle returned by Metrics.counter(), as allocated when a process() call first
+increments a series and the publisher merges it. Series share an audience, as the series of a
+pipeline do, and differ by one label.
+
+No server is needed, metrics are never published:
+
+    python benchmarks/bench_metrics_memory.py --series 50000
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+from threading import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal_protos.protos as protos  # noqa: E402
+from streamdal.metrics import Metrics  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--series", type=int, default=50000)
+    args = parser.parse_args()
+
+    # With exit already set the background workers return immediately
+    exit = Event()
+    exit.set()
+
+    metrics = Metrics(
+        loop=asyncio.new_event_loop(), exit=exit, max_series=args.series + 1
+    )
+    aud = protos.Audience(
+        service_name="bench",
+        component_name="kafka",
+        operation_type=protos.OperationType.OPERATION_TYPE_CONSUMER,
+        operation_name="orders",
+    )
+    labels = [
+        {
+            "service": "bench",
+            "component": "kafka",
+            "operation": "orders",
+            "pipeline_id": f"pipeline-{i}",
+        }
+        for i in range(args.series)
+    ]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    handles = [metrics.counter("counter_consume_bytes", l, aud) for l in labels]
+    for handle in handles:
+        handle.add(1.0)
+    metrics.take_counters()
+
+    # The thread's shard holds on to the series too, until it is rotated out
+    metrics.shard.shard = None
+    metrics.shards.clear()
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print(f"{len(metrics.counters)} series")
+    print(f"{used / len(metrics.counters):.0f} bytes per series")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Measure the memory of Metrics under sustained overload: producer threads increment counters
+with a new label value every time, while the server never answers a MetricsRequest. With the
+default max_series and max_pending limits RSS levels off once the limits are reached; without
+them every new series and every flush's request is kept, and RSS grows for as long as the
+overload lasts (flushes also slow down as they carry every series, so that case overruns).
+
+Each case runs in its own process so their RSS doesn't mix. No server is needed:
+
+    python benchmarks/bench_metrics_overload.py --seconds 10 --threads 4
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal_protos.protos as protos  # noqa: E402
+from streamdal.metrics import Metrics  # noqa: E402
+
+UNBOUNDED = 1 << 60
+
+
+class UnresponsiveStub:
+    """A server that accepts MetricsRequests and never responds"""
+
+    async def metrics(self, *args, **kwargs):
+        await asyncio.sleep(3600)
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def run_case(bounded: bool, seconds: float, threads: int) -> None:
+    loop = asyncio.new_event_loop()
+
+    # With exit already set the background workers return immediately, the benchmark
+    # flushes from this thread so that it can also run the event loop
+    exit = Event()
+    exit.set()
+
+    kwargs = {}
+    if not bounded:
+        kwargs = {"max_series": UNBOUNDED, "max_pending": UNBOUNDED}
+
+    metrics = Metrics(stub=UnresponsiveStub(), loop=loop, exit=exit, **kwargs)
+    aud = protos.Audience(service_name="bench", component_name="kafka")
+    stop = Event()
+
+    def produce(worker: int):
+        i = 0
+        while not stop.is_set():
+            metrics.counter("counter_consume_bytes", {"id": f"{worker}-{i}"}, aud).add(
+                1.0
+            )
+            i += 1
+
+    producers = [Thread(target=produce, args=(i,)) for i in range(threads)]
+    for p in producers:
+        p.start()
+
+    started = time.monotonic()
+    next_report = started
+    while time.monotonic() - started < seconds:
+        metrics.flush()
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        if time.monotonic() >= next_report:
+            print(
+                f"{'bounded' if bounded else 'unbounded':<10} "
+                f"{time.monotonic() - started:>6.1f}s "
+                f"{rss_bytes() / 1024 / 1024:>10.1f} MB "
+                f"{len(metrics.handles):>10} {len(metrics.requests):>10}",
+                flush=True,
+            )
+            next_report += 1
+
+    stop.set()
+    for p in producers:
+        p.join()
+
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--case", choices=["bounded", "unbounded"])
+    args = parser.parse_args()
+
+    if args.case is not None:
+        run_case(args.case == "bounded", args.seconds, args.threads)
+        return
+
+    print(f"{args.threads} producer threads, a new series per increment")
+    print(f"{'':<10} {'elapsed':>7} {'rss':>13} {'series':>10} {'requests':>10}")
+
+    for case in ("bounded", "unbounded"):
+        subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--case",
+                case,
+                "--seconds",
+                str(args.seconds),
+                "--threads",
+                str(args.threads),
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Measure the cost of reaping idle counters, comparing generation buckets against the previous
+reaper, which copied the counters map and compared datetime.utcnow() to each counter's last
+update time on every run. Most counters are kept busy, only a small number are idle, as with
+a steady workload where a few label values go away.
+
+No server is needed, metrics are never published:
+
+    python benchmarks/bench_metrics_reaper.py --counters 100000 --idle 100
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from threading import Event, Lock, local
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from streamdal.metrics import (  # noqa: E402
+    COUNTER_TTL_GENERATIONS,
+    CounterEntry,
+    CounterStore,
+    Metrics,
+    counter_key,
+    new_overflow_handle,
+)
+
+
+def new_metrics(max_series: int) -> Metrics:
+    """Metrics with only the parts counters and expire() use, so no threads are started"""
+    metrics = object.__new__(Metrics)
+    metrics.lock = Lock()
+    metrics.counters = CounterStore(metrics.lock)
+    metrics.shards = []
+    metrics.shard = local()
+    metrics.handles = {}
+    metrics.exempt = {}
+    metrics.entries = {}
+    metrics.histograms = {}
+    metrics.generation = 1
+    metrics.buckets = {}
+    metrics.max_series = max_series
+    metrics.overflow = new_overflow_handle(metrics)
+    metrics.exit = Event()
+    return metrics
+
+
+class TimestampedCounter:
+    """A counter with the time of its last update, as counters had for the previous reaper"""
+
+    def __init__(self, last_updated: datetime):
+        self.value = 0.0
+        self.last_updated = last_updated
+
+
+def entries(number: int) -> list:
+    return [
+        CounterEntry(name="counter_consume_processed", aud=None, labels={"id": str(i)})
+        for i in range(number)
+    ]
+
+
+def full_scan(counters: int, idle: int) -> tuple:
+    """The previous reaper loop, with last update times set so that idle counters are stale"""
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=60)
+    items = {}
+    for i, entry in enumerate(entries(counters)):
+        counter = TimestampedCounter(stale if i < idle else now)
+        items[counter_key(entry.name, entry.labels, entry.aud)] = counter
+    lock = Lock()
+
+    started = time.perf_counter()
+    lock.acquire(blocking=True)
+    copied = items.copy()
+    lock.release()
+
+    reaped = []
+    for name in copied:
+        counter = copied[name]
+        if counter.value > 0:
+            continue
+
+        if (datetime.utcnow() - counter.last_updated).total_seconds() > 10:
+            del items[name]
+            reaped.append(name)
+
+    return time.perf_counter() - started, len(reaped)
+
+
+def generations(counters: int, idle: int) -> tuple:
+    metrics = new_metrics(counters)
+    handles = [metrics.counter(e.name, e.labels, e.aud) for e in entries(counters)]
+    for handle in handles:
+        handle.add()
+    metrics.take_counters()
+
+    # Busy counters are incremented every generation, idle ones aren't
+    for _ in range(COUNTER_TTL_GENERATIONS):
+        metrics.expire()
+        for handle in handles[idle:]:
+            handle.add()
+        metrics.take_counters()
+
+    started = time.perf_counter()
+    reaped = metrics.expire()
+    return time.perf_counter() - started, len(reaped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--counters", type=int, default=100000)
+    parser.add_argument("--idle", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{args.counters} counters, {args.idle} idle")
+    print(f"{'':<12} {'reap run':>10} {'reaped':>8}")
+
+    for name, case in (("full scan", full_scan), ("generations", generations)):
+        (elapsed, reaped) = case(args.counters, args.idle)
+        print(f"{name:<12} {elapsed * 1000:>8.2f}ms {reaped:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measure the cost of process() for an audience that has no pipelines and no tails, comparing the
+route cache and pass-through response against the previous path, which built an Audience and a
+SdkResponse, looked the audience up twice by its string key and checked for tails on every call.
+
+No server or wasm modules are needed:
+
+    python benchmarks/bench_noop_process.py --number 200000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal  # noqa: E402
+import streamdal_protos.protos as protos  # noqa: E402
+from streamdal import StreamdalClient, StreamdalConfig  # noqa: E402
+
+
+def new_client() -> StreamdalClient:
+    client = object.__new__(StreamdalClient)
+    client.cfg = StreamdalConfig(service_name="bench")
+    client.pipelines = {}
+    client.pending_pipelines = {}
+    client.pipelines_lock = threading.Lock()
+    client.routes = {}
+    client.audience_registry = streamdal.common.AudienceRegistry()
+    client.audiences = {}
+    client.tails = {}
+
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=200000)
+    parser.add_argument("--payload-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    client = new_client()
+    req = streamdal.ProcessRequest(
+        operation_type=streamdal.OPERATION_TYPE_CONSUMER,
+        operation_name="no-pipelines",
+        component_name="kafka",
+        data=os.urandom(args.payload_size),
+    )
+
+    # Mark the audience as announced so neither path talks to the server
+    aud = client._new_audience(req)
+    client.audiences[streamdal.common.aud_to_str(aud)] = aud
+
+    def previous():
+        aud = protos.Audience(
+            service_name=client.cfg.service_name,
+            operation_type=protos.OperationType(req.operation_type),
+            operation_name=req.operation_name,
+            component_name=req.component_name,
+        )
+        client._add_audience(aud)
+        pipelines = client._get_pipelines(aud)
+        return client._process(req, aud, pipelines, lambda handle, value: None)
+
+    def route_cache():
+        return client.process(req)
+
+    assert previous().data == route_cache().data
+
+    print(f"payload: {args.payload_size} bytes, {args.number} calls per case")
+    print(f"{'':<14} {'us/call':>10} {'alloc/call':>12}")
+
+    for name, fn in (("previous", previous), ("route cache", route_cache)):
+        started = time.perf_counter()
+        for _ in range(args.number):
+            fn()
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        fn()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"{name:<14} {elapsed / args.number * 1e6:10.2f} {peak:12d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Measure what a notify condition costs the process() call that hits it, comparing the I/O
+reactor against the previous approach, which created a new event loop for every notification
+and ran the call to completion in the calling thread. The server's reply takes --rtt seconds.
+
+No server is needed, the stub is replaced by one that waits out the round trip:
+
+    python benchmarks/bench_notify.py --number 200 --rtt 0.001
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from streamdal.reactor import Reactor  # noqa: E402
+
+
+class Stub:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+
+    async def notify(self, *args, **kwargs):
+        await asyncio.sleep(self.rtt)
+
+
+def previous(stub: Stub, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(stub.notify())
+        loop.close()
+    return time.perf_counter() - started
+
+
+def reactor(stub: Stub, number: int) -> float:
+    r = Reactor("localhost", 8082)
+    r.start()
+
+    started = time.perf_counter()
+    futures = [r.submit(stub.notify()) for _ in range(number)]
+    elapsed = time.perf_counter() - started
+
+    # Not part of what process() waits for
+    for future in futures:
+        future.result()
+    r.stop()
+
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--rtt", type=float, default=0.001)
+    args = parser.parse_args()
+
+    stub = Stub(args.rtt)
+
+    print(f"{args.number} notifications, {args.rtt * 1000:.1f}ms round trip")
+    print(f"{'':<10} {'us/notify':>10}")
+
+    for name, case in (("previous", previous), ("reactor", reactor)):
+        elapsed = case(stub, args.number)
+        print(f"{name:<10} {elapsed / args.number * 1_000_000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
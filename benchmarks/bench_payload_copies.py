@@ -0,0 +1,133 @@
+"""
+Measure the time and memory spent moving a payload through a single wasm step, comparing the
+path that encodes a WasmRequest with betterproto, writes it with Memory.write(), reads the
+result with read_memory() and parses it with betterproto, against wasm.call_step(), which
+writes the request straight into wasm memory and decodes the response from a view of it.
+
+The module used returns the input payload as the output payload without touching it, so the
+numbers only cover the SDK side of a step. No wasm modules need to be downloaded:
+
+    python benchmarks/bench_payload_copies.py --payload-size 1048576
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal.common as common  # noqa: E402
+import streamdal.wasm as wasm  # noqa: E402
+import streamdal_protos.protos as protos  # noqa: E402
+from wasmtime import Instance, Store  # noqa: E402
+
+# Returns the input payload of a WasmRequest as the output payload of its response
+PASSTHROUGH_WAT = b"""
+(module
+  (memory (export "memory") 1)
+  (global $next (mut i32) (i32.const 1024))
+  (func (export "alloc") (param $len i32) (result i32)
+    (local $ptr i32)
+    ;; Reuse the same region for every request, like a real allocator would after dealloc
+    (local.set $ptr (i32.const 1024))
+    (global.set $next (i32.add (i32.const 1024) (local.get $len)))
+    (if (i32.gt_u (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+      (then
+        (drop (memory.grow
+          (i32.add
+            (i32.div_u
+              (i32.sub (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+              (i32.const 65536))
+            (i32.const 1))))))
+    (local.get $ptr))
+  (func (export "dealloc") (param i32 i32))
+  (func (export "f") (param $ptr i32) (param $len i32) (result i64)
+    (local $p i32) (local $n i32) (local $shift i32) (local $b i32)
+    (local.set $p (local.get $ptr))
+    (if (i32.eq (i32.load8_u (local.get $p)) (i32.const 0x0a))
+      (then
+        (local.set $p (i32.add (local.get $p) (i32.const 1)))
+        (block $done
+          (loop $next
+            (local.set $b (i32.load8_u (local.get $p)))
+            (local.set $p (i32.add (local.get $p) (i32.const 1)))
+            (local.set $n
+              (i32.or (local.get $n)
+                (i32.shl (i32.and (local.get $b) (i32.const 0x7f)) (local.get $shift))))
+            (local.set $shift (i32.add (local.get $shift) (i32.const 7)))
+            (br_if $next (i32.ge_u (local.get $b) (i32.const 0x80)))))
+        (local.set $p (i32.add (local.get $p) (local.get $n)))))
+    (i32.store8 (local.get $p) (i32.const 0x0a))
+    (i64.or
+      (i64.shl (i64.extend_i32_u (local.get $p)) (i64.const 32))
+      (i64.extend_i32_u
+        (i32.sub (i32.add (local.get $ptr) (local.get $len)) (local.get $p)))))
+)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--payload-size", type=int, default=1024 * 1024)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    store = Store(wasm.get_engine())
+    inst = wasm.WasmInstance(
+        Instance(store, wasm.modules.get(PASSTHROUGH_WAT), []), store
+    )
+
+    payload = os.urandom(args.payload_size)
+    step = protos.PipelineStep(
+        name="passthrough",
+        wasm_function="f",
+        detective=protos.steps.DetectiveStep(path="object.field", args=["a"]),
+    )
+    step_field = wasm.encode_step(bytes(step))
+
+    def encoded_message():
+        req = protos.WasmRequest(step=step, input_payload=payload)
+        data = bytes(req)
+
+        start_ptr = inst.alloc(store, len(data))
+        inst.memory.write(store, data, start_ptr)
+        result_ptr = inst.func("f")(store, start_ptr, len(data))
+        res = common.read_memory(inst.memory, store, result_ptr, -1)
+        inst.dealloc(store, result_ptr >> 32, len(res))
+
+        return protos.WasmResponse().parse(res)
+
+    def view():
+        return wasm.call_step(inst, "f", step_field, payload)
+
+    assert encoded_message().output_payload == payload
+    assert view().output_payload == payload
+
+    print(f"payload: {args.payload_size} bytes, {args.number} steps per case")
+    print(f"{'':<16} {'us/step':>10} {'peak alloc':>12} {'payload copies':>15}")
+
+    for name, fn in (("betterproto", encoded_message), ("call_step", view)):
+        started = time.perf_counter()
+        for _ in range(args.number):
+            fn()
+        elapsed = time.perf_counter() - started
+
+        # Peak traced memory in payload-sized units approximates how many copies of the
+        # payload one step makes. Only Python allocations are traced, not wasm memory.
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        resp = fn()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del resp
+
+        print(
+            f"{name:<16} {elapsed / args.number * 1e6:10.1f} {peak:12d} "
+            f"{peak / args.payload_size:15.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measure the cost of building the encoded WasmRequest for a step, comparing encoding the whole
+message with betterproto (what _call_wasm() used to do for every step of every payload) against
+concatenating the step field that is encoded once per step with the payload.
+
+No wasm modules are needed:
+
+    python benchmarks/bench_wasm_request.py --payload-size 1024
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from copy import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import streamdal.wasm as wasm  # noqa: E402
+import streamdal_protos.protos as protos  # noqa: E402
+
+
+def new_step() -> protos.PipelineStep:
+    return protos.PipelineStep(
+        name="detective",
+        wasm_id="detective",
+        wasm_function="f",
+        wasm_bytes=b"\x00asm" + b"\x00" * 1024,
+        detective=protos.steps.DetectiveStep(
+            path="object.field",
+            args=["streamdal", "gmail.com", "example.org"],
+            negate=False,
+            type=protos.steps.DetectiveType.DETECTIVE_TYPE_STRING_CONTAINS_ANY,
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--payload-size", type=int, default=1024)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    step = new_step()
+    payload = b"x" * args.payload_size
+    isr = protos.InterStepResult(
+        detective_result=protos.steps.DetectiveStepResult(
+            matches=[protos.steps.DetectiveStepResultMatch(path="object.field")]
+        )
+    )
+
+    def per_message():
+        req = protos.WasmRequest()
+        req.input_payload = payload
+        req.step = copy(step)
+        req.step.wasm_bytes = None
+        req.inter_step_result = isr
+        return bytes(req)
+
+    request_step = copy(step)
+    request_step.wasm_bytes = None
+    step_field = wasm.encode_step(bytes(request_step))
+
+    def precompiled():
+        return wasm.encode_wasm_request(step_field, payload, bytes(isr))
+
+    def precompiled_no_isr():
+        return wasm.encode_wasm_request(step_field, payload)
+
+    assert per_message() == precompiled()
+
+    print(f"payload: {args.payload_size} bytes, {args.number} requests per case")
+    for name, fn in (
+        ("betterproto WasmRequest", per_message),
+        ("cached step + isr", precompiled),
+        ("cached step, no isr", precompiled_no_isr),
+    ):
+        elapsed = min(timeit.repeat(fn, number=args.number, repeat=3))
+        print(f"{name:<26} {elapsed / args.number * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,9 +21,14 @@ setup(
         "streamdal.validation",
         "streamdal.tail",
         "streamdal.hostfunc",
+        "streamdal.wasm",
+        "streamdal.procpool",
+        "streamdal.plan",
+        "streamdal.exposition",
+        "streamdal.reactor",
     ],
     install_requires=[
-        "betterproto==2.0.0b6",
+        "betterproto==2.0.0b6",  # streamdal.copy_passthrough_response() relies on its internals
         "black==23.11.0",
         "bleach==6.1.0",
         "certifi==2023.11.17",
@@ -5,32 +5,27 @@ import logging
 import os
 import platform
 import signal
+import streamdal.exposition as exposition
 import streamdal.hostfunc as hostfunc
+import streamdal.plan as plan
+import streamdal.procpool as procpool
+import streamdal.reactor as reactor
 import streamdal_protos.protos as protos
 import socket
 import time
 import uuid
 import streamdal.validation as validation
+import streamdal.wasm as wasm
 from betterproto import which_one_of
-from copy import copy
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
-from grpclib.client import Channel
+from functools import partial
 from streamdal.metrics import Metrics, CounterEntry
 from streamdal.tail import Tail
 from streamdal.kv import KV
 from streamdal_protos.protos import SdkResponse as ProcessResponse
-from threading import Thread, Event
-from wasmtime import (
-    Config,
-    Engine,
-    Linker,
-    Module,
-    Store,
-    WasiConfig,
-    Instance,
-    FuncType,
-    ValType,
-)
+from threading import Event, Lock
+from wasmtime import Linker
 
 DEFAULT_SERVER_URL = "localhost:8082"
 DEFAULT_SERVER_TOKEN = "1234"
@@ -39,6 +34,7 @@ DEFAULT_PIPELINE_TIMEOUT = 1 / 10  # 100 milliseconds
 DEFAULT_STEP_TIMEOUT = 1 / 100  # 10 milliseconds
 DEFAULT_GRPC_TIMEOUT = 5  # 5 seconds
 DEFAULT_HEARTBEAT_INTERVAL = 1  # 1 second
+DEFAULT_SHUTDOWN_TIMEOUT = 2  # 2 seconds
 MAX_PAYLOAD_SIZE = 1024 * 1024  # 1 megabyte
 
 OPERATION_TYPE_CONSUMER = 1
@@ -47,6 +43,20 @@ OPERATION_TYPE_PRODUCER = 2
 CLIENT_TYPE_SDK = 1
 CLIENT_TYPE_SHIM = 2
 
+# Run wasm steps in the calling thread, or in a pool of worker processes
+EXECUTION_MODE_INLINE = "inline"
+EXECUTION_MODE_PROCESS = "process"
+
+# What process() does for an audience whose first pipelines are still being compiled.
+# Audiences that already had pipelines keep using those until the new ones are ready.
+WARMUP_POLICY_WAIT = "wait"  # Wait for the pipelines to be ready
+WARMUP_POLICY_FAIL_OPEN = (
+    "fail_open"  # Return the payload as if there were no pipelines
+)
+WARMUP_POLICY_FAIL_CLOSED = "fail_closed"  # Return an EXEC_STATUS_ERROR response
+DEFAULT_WARMUP_THREADS = 2
+DEFAULT_WARMUP_TIMEOUT = 30  # seconds the wait policy waits before failing closed
+
 EXEC_STATUS_TRUE = protos.ExecStatus.EXEC_STATUS_TRUE
 EXEC_STATUS_FALSE = protos.ExecStatus.EXEC_STATUS_FALSE
 EXEC_STATUS_ERROR = protos.ExecStatus.EXEC_STATUS_ERROR
@@ -60,6 +70,42 @@ class ProcessRequest:
     data: bytes
 
 
+def build_passthrough_response(data: bytes) -> ProcessResponse:
+    """Return a ProcessResponse with the payload unchanged and no pipeline status"""
+    return ProcessResponse(data=data, status=EXEC_STATUS_TRUE)
+
+
+# Fields of the response process() returns for payloads of audiences without pipelines or
+# tails, copied into each one rather than going through the protobuf constructor
+PASSTHROUGH_FIELDS = build_passthrough_response(b"").__dict__.copy()
+
+
+def copy_passthrough_response(data: bytes) -> ProcessResponse:
+    """
+    Same as build_passthrough_response(), but the fields of a template response are copied
+    in, which is about 20 times cheaper than the constructor. This relies on the private state
+    of betterproto's messages, which is why betterproto's version is pinned in setup.py.
+    """
+    resp = object.__new__(ProcessResponse)
+    fields = resp.__dict__
+    fields.update(PASSTHROUGH_FIELDS)
+    fields["data"] = data
+    fields["_group_current"] = PASSTHROUGH_FIELDS["_group_current"].copy()
+    return resp
+
+
+def same_message(a, b) -> bool:
+    return a == b and bytes(a) == bytes(b) and a.to_dict() == b.to_dict()
+
+
+# Should another betterproto version keep its state differently, use the constructor
+passthrough_response = (
+    copy_passthrough_response
+    if same_message(copy_passthrough_response(b"{}"), build_passthrough_response(b"{}"))
+    else build_passthrough_response
+)
+
+
 @dataclass(frozen=True)
 class Audience:
     """Audience is a dataclass that holds information about an audience. It is passed into the config when
@@ -88,6 +134,51 @@ class StreamdalConfig:
     client_type: int = CLIENT_TYPE_SDK
     exit: Event = Event()
     audiences: list = field(default_factory=list)
+    wasm_cache_dir: str = os.getenv("STREAMDAL_WASM_CACHE_DIR", "")
+    wasm_cache_max_bytes: int = os.getenv(
+        "STREAMDAL_WASM_CACHE_MAX_BYTES", wasm.DEFAULT_DISK_CACHE_MAX_BYTES
+    )
+    wasm_pool_size: int = os.getenv("STREAMDAL_WASM_POOL_SIZE", wasm.DEFAULT_POOL_SIZE)
+    wasm_unused_max_count: int = os.getenv(
+        "STREAMDAL_WASM_UNUSED_MAX_COUNT", wasm.DEFAULT_UNUSED_MAX_COUNT
+    )
+    wasm_unused_max_bytes: int = os.getenv(
+        "STREAMDAL_WASM_UNUSED_MAX_BYTES", wasm.DEFAULT_UNUSED_MAX_BYTES
+    )
+    wasm_instance_max_calls: int = os.getenv(
+        "STREAMDAL_WASM_INSTANCE_MAX_CALLS", wasm.DEFAULT_INSTANCE_MAX_CALLS
+    )
+    wasm_instance_max_memory: int = os.getenv(
+        "STREAMDAL_WASM_INSTANCE_MAX_MEMORY", wasm.DEFAULT_INSTANCE_MAX_MEMORY
+    )
+    execution_mode: str = os.getenv("STREAMDAL_EXECUTION_MODE", EXECUTION_MODE_INLINE)
+    process_pool_size: int = os.getenv(
+        "STREAMDAL_PROCESS_POOL_SIZE", procpool.DEFAULT_PROCESS_POOL_SIZE
+    )
+    metrics_flush_interval: float = os.getenv(
+        "STREAMDAL_METRICS_FLUSH_INTERVAL", metrics.DEFAULT_FLUSH_INTERVAL
+    )
+    metrics_max_batch_size: int = os.getenv(
+        "STREAMDAL_METRICS_MAX_BATCH_SIZE", metrics.DEFAULT_MAX_BATCH_SIZE
+    )
+    metrics_max_series: int = os.getenv(
+        "STREAMDAL_METRICS_MAX_SERIES", metrics.DEFAULT_MAX_SERIES
+    )
+    metrics_max_pending: int = os.getenv(
+        "STREAMDAL_METRICS_MAX_PENDING", metrics.DEFAULT_MAX_PENDING_REQUESTS
+    )
+    metrics_drop_policy: str = os.getenv(
+        "STREAMDAL_METRICS_DROP_POLICY", metrics.DROP_POLICY_HOLD
+    )
+    metrics_port: int = os.getenv("STREAMDAL_METRICS_PORT", exposition.DEFAULT_PORT)
+    warmup_policy: str = os.getenv("STREAMDAL_WARMUP_POLICY", WARMUP_POLICY_WAIT)
+    warmup_threads: int = os.getenv("STREAMDAL_WARMUP_THREADS", DEFAULT_WARMUP_THREADS)
+    warmup_timeout: float = os.getenv(
+        "STREAMDAL_WARMUP_TIMEOUT", DEFAULT_WARMUP_TIMEOUT
+    )
+    shutdown_timeout: float = os.getenv(
+        "STREAMDAL_SHUTDOWN_TIMEOUT", DEFAULT_SHUTDOWN_TIMEOUT
+    )
 
     def validate(self) -> None:
         if self.service_name == "":
@@ -96,20 +187,78 @@ class StreamdalConfig:
             raise ValueError("streamdal_url is required")
         elif self.streamdal_token == "":
             raise ValueError("streamdal_token is required")
+        elif int(self.wasm_pool_size) < 1:
+            raise ValueError("wasm_pool_size must be at least 1")
+        elif int(self.wasm_unused_max_count) < 0:
+            raise ValueError("wasm_unused_max_count must not be negative")
+        elif int(self.wasm_unused_max_bytes) < 0:
+            raise ValueError("wasm_unused_max_bytes must not be negative")
+        elif int(self.wasm_instance_max_calls) < 0:
+            raise ValueError("wasm_instance_max_calls must not be negative")
+        elif int(self.wasm_instance_max_memory) < 0:
+            raise ValueError("wasm_instance_max_memory must not be negative")
+        elif self.execution_mode not in (EXECUTION_MODE_INLINE, EXECUTION_MODE_PROCESS):
+            raise ValueError(
+                f"execution_mode must be '{EXECUTION_MODE_INLINE}' or '{EXECUTION_MODE_PROCESS}'"
+            )
+        elif int(self.process_pool_size) < 1:
+            raise ValueError("process_pool_size must be at least 1")
+        elif float(self.step_timeout) <= 0:
+            raise ValueError("step_timeout must be greater than 0")
+        elif float(self.pipeline_timeout) <= 0:
+            raise ValueError("pipeline_timeout must be greater than 0")
+        elif self.warmup_policy not in (
+            WARMUP_POLICY_WAIT,
+            WARMUP_POLICY_FAIL_OPEN,
+            WARMUP_POLICY_FAIL_CLOSED,
+        ):
+            raise ValueError(
+                f"warmup_policy must be one of '{WARMUP_POLICY_WAIT}', "
+                f"'{WARMUP_POLICY_FAIL_OPEN}' or '{WARMUP_POLICY_FAIL_CLOSED}'"
+            )
+        elif int(self.warmup_threads) < 1:
+            raise ValueError("warmup_threads must be at least 1")
+        elif float(self.warmup_timeout) <= 0:
+            raise ValueError("warmup_timeout must be greater than 0")
+        elif float(self.metrics_flush_interval) <= 0:
+            raise ValueError("metrics_flush_interval must be greater than 0")
+        elif int(self.metrics_max_batch_size) < 1:
+            raise ValueError("metrics_max_batch_size must be at least 1")
+        elif int(self.metrics_max_series) < 1:
+            raise ValueError("metrics_max_series must be at least 1")
+        elif int(self.metrics_max_pending) < 1:
+            raise ValueError("metrics_max_pending must be at least 1")
+        elif self.metrics_drop_policy not in (
+            metrics.DROP_POLICY_HOLD,
+            metrics.DROP_POLICY_DROP,
+        ):
+            raise ValueError(
+                f"metrics_drop_policy must be '{metrics.DROP_POLICY_HOLD}' or '{metrics.DROP_POLICY_DROP}'"
+            )
+        elif not 0 <= int(self.metrics_port) <= 65535:
+            raise ValueError("metrics_port must be between 0 and 65535")
+        elif float(self.shutdown_timeout) < 0:
+            raise ValueError("shutdown_timeout must not be negative")
 
 
 class StreamdalClient:
     cfg: StreamdalConfig
     pipelines: dict
+    pending_pipelines: dict
+    pipelines_lock: Lock
+    warmup_pool: ThreadPoolExecutor
+    routes: dict
+    audience_registry: common.AudienceRegistry
     log: logging.Logger
     metrics: Metrics
     kv: KV
-    functions: dict
+    functions: wasm.FunctionCache
+    linker: Linker
+    process_pool: procpool.ProcessPool
     exit: Event
     session_id: str
     grpc_timeout: int
     auth_token: str
-    workers: list
     audiences: dict
     tails: dict
     paused_tails: dict
@@ -118,15 +267,11 @@ class StreamdalClient:
     schemas: dict
     host_func: hostfunc.HostFunc
 
-    # Due to the blocking nature of streaming calls, we need separate event loops and gRPC
-    # channels for register` and tail requests. All other unary operations can use the same
-    # grpc_channel and grpc_loop
-    grpc_channel: Channel
+    # All calls to the server, including the register and tail streams, run on the reactor's
+    # event loop and share its gRPC channel
+    reactor: reactor.Reactor
     grpc_stub: protos.InternalStub
-    grpc_loop: asyncio.AbstractEventLoop
-    register_channel: Channel
-    register_stub: protos.InternalStub
-    register_loop: asyncio.AbstractEventLoop
+    tasks: list
 
     def __init__(self, cfg: StreamdalConfig):
         if not isinstance(cfg, StreamdalConfig):
@@ -143,21 +288,18 @@ class StreamdalClient:
         self.host = host
         self.port = port
 
-        register_loop = asyncio.new_event_loop()
-        self.register_channel = Channel(
-            host=self.host, port=self.port, loop=register_loop
-        )
-        self.register_stub = protos.InternalStub(channel=self.register_channel)
-        self.register_loop = register_loop
-
-        grpc_loop = asyncio.new_event_loop()
-        self.grpc_channel = Channel(host=self.host, port=self.port, loop=grpc_loop)
-        self.grpc_stub = protos.InternalStub(channel=self.grpc_channel)
-        self.grpc_loop = grpc_loop
+        self.reactor = reactor.Reactor(self.host, self.port, log=log)
+        self.reactor.start()
+        self.grpc_stub = self.reactor.stub
+        self.tasks = []
 
         self.auth_token = cfg.streamdal_token
         self.grpc_timeout = 5
         self.pipelines = {}
+        self.pending_pipelines = {}
+        self.pipelines_lock = Lock()
+        self.routes = {}
+        self.audience_registry = common.AudienceRegistry()
         self.audiences = {}
         self.tails = {}
         self.paused_tails = {}
@@ -168,31 +310,62 @@ class StreamdalClient:
             stub=self.grpc_stub,
             log=self.log,
             exit=cfg.exit,
-            loop=grpc_loop,
+            loop=self.reactor.loop,
             auth_token=self.auth_token,
+            flush_interval=cfg.metrics_flush_interval,
+            max_batch_size=cfg.metrics_max_batch_size,
+            max_series=cfg.metrics_max_series,
+            max_pending=cfg.metrics_max_pending,
+            drop_policy=cfg.metrics_drop_policy,
         )
-        self.functions = {}
+
+        # Optionally serve the metrics for Prometheus to scrape from the process
+        self.exposition = None
+        if int(cfg.metrics_port) > 0:
+            self.exposition = exposition.ExpositionServer(
+                self.metrics, int(cfg.metrics_port), log=self.log
+            )
+            self.exposition.start()
+        self.functions = wasm.FunctionCache(
+            cfg.wasm_unused_max_count, cfg.wasm_unused_max_bytes
+        )
+        self.linker = None
         self.session_id = str(uuid.uuid4())
-        self.workers = []
         self.kv = KV()
         self.host_func = hostfunc.HostFunc(kv=self.kv)
 
+        # Persist compiled modules across restarts if a cache directory is configured
+        if cfg.wasm_cache_dir != "" and wasm.modules.disk is None:
+            wasm.modules.disk = wasm.DiskCache(
+                cfg.wasm_cache_dir, cfg.wasm_cache_max_bytes, log=self.log
+            )
+
+        # Optionally execute wasm steps in worker processes instead of the calling thread
+        self.process_pool = None
+        if cfg.execution_mode == EXECUTION_MODE_PROCESS:
+            self.process_pool = procpool.ProcessPool(
+                cfg.process_pool_size,
+                cache_dir=cfg.wasm_cache_dir,
+                kv=self.kv,
+                log=self.log,
+            )
+
         events = [signal.SIGINT, signal.SIGTERM, signal.SIGQUIT, signal.SIGHUP]
         for e in events:
             signal.signal(e, self.shutdown)
 
+        # Modules of new pipelines are compiled and instantiated in the background
+        self.warmup_pool = ThreadPoolExecutor(
+            max_workers=int(cfg.warmup_threads),
+            thread_name_prefix="streamdal-warmup",
+        )
+
         # Pull initial pipelines
         self._pull_initial_pipelines()
 
-        # Start heartbeat
-        heartbeat = Thread(target=self._heartbeat, daemon=False)
-        heartbeat.start()
-        self.workers.append(heartbeat)
-
-        # Run register
-        register = Thread(target=self._register, daemon=False)
-        register.start()
-        self.workers.append(register)
+        # Start heartbeat and register on the reactor
+        self.tasks.append(self.reactor.submit(self._heartbeat()))
+        self.tasks.append(self.reactor.submit(self._register()))
 
         self.log.debug("Client started")
 
@@ -218,101 +391,182 @@ class StreamdalClient:
 
                 self._set_pipelines(cmd)
 
-        self.grpc_loop.run_until_complete(call())
+        self.reactor.call(call())
+
+    def _aud_key(self, aud: protos.Audience) -> str:
+        """Key of an audience in the pipelines, tails, schemas and audiences maps"""
+        return self.audience_registry.key(aud)
 
     def seen_audience(self, aud: protos.Audience) -> bool:
         """Have we seen this audience before?"""
-        return self.audiences.get(common.aud_to_str(aud)) is not None
+        return self.audiences.get(self._aud_key(aud)) is not None
 
     def _add_audience(self, aud: protos.Audience) -> None:
         """Add an audience to the local map and send to server"""
         if self.seen_audience(aud):
             return
 
-        async def call():
+        # We haven't seen it yet, add to local map and send to server
+        self.audiences[self._aud_key(aud)] = aud
+        self.reactor.submit(self._announce_audience(aud))
+
+    async def _announce_audience(self, aud: protos.Audience) -> None:
+        try:
             req = protos.NewAudienceRequest(audience=aud, session_id=self.session_id)
             await self.grpc_stub.new_audience(
                 req, timeout=self.grpc_timeout, metadata=self._get_metadata()
             )
+        except Exception as e:
+            self.log.debug(f"Failed to announce audience: {e}")
 
-        # We haven't seen it yet, add to local map and send to server
-        self.audiences[common.aud_to_str(aud)] = aud
-        self.grpc_loop.create_task(call())
-
-    def _add_audiences(self) -> None:
+    async def _add_audiences(self) -> None:
         """This method is used to re-announce audiences after a disconnect"""
-
-        async def call():
-            try:
-                req = protos.NewAudienceRequest(
-                    audience=aud, session_id=self.session_id
-                )
-                await self.grpc_stub.new_audience(
-                    req, timeout=self.grpc_timeout, metadata=self._get_metadata()
-                )
-            except Exception as e:
-                self.log.debug(f"Failed to re-announce audience: {e}")
-
-        for aud_str in self.audiences.keys():
-            aud = common.str_to_aud(aud_str)
-            self.grpc_loop.run_until_complete(call())
+        await asyncio.gather(
+            *(self._announce_audience(aud) for aud in list(self.audiences.values()))
+        )
 
     def process(self, req: ProcessRequest) -> ProcessResponse:
-        """Apply pipelines to a component+operation"""
+        """
+        Apply pipelines to a component+operation
+
+        Payloads of audiences without pipelines or tails are returned unchanged, without
+        running any pipeline work.
+        """
         if req is None:
             raise ValueError("req is required")
 
+        route = self._get_route(req)
+        if self._is_passthrough(route, req):
+            return passthrough_response(req.data)
+
+        pipelines = self._get_pipelines(route.aud, route.key)
+        if pipelines is None:
+            return self._not_ready_response(req)
+
+        return self._process(req, route.aud, pipelines, self._add_counter)
+
+    def process_batch(self, reqs: list) -> list:
+        """
+        Apply pipelines to a batch of payloads
+
+        Pipelines are resolved once per audience in the batch and metrics increments are
+        aggregated and applied once per batch. Returns a list of ProcessResponse in the
+        same order as the requests, each matching what process() returns for that request.
+        """
+        if reqs is None:
+            raise ValueError("reqs is required")
+
+        batch = metrics.CounterBatch()
+        resolved = {}
+        responses = []
+
+        for req in reqs:
+            if req is None:
+                raise ValueError("req is required")
+
+            route = self._get_route(req)
+            if self._is_passthrough(route, req):
+                responses.append(passthrough_response(req.data))
+                continue
+
+            if route.key not in resolved:
+                resolved[route.key] = self._get_pipelines(route.aud, route.key)
+
+            pipelines = resolved[route.key]
+            if pipelines is None:
+                responses.append(self._not_ready_response(req))
+                continue
+
+            responses.append(self._process(req, route.aud, pipelines, batch.add))
+
+        batch.flush(self.metrics)
+
+        return responses
+
+    def _get_route(self, req: ProcessRequest) -> plan.Route:
+        """Get the audience of a request, announcing it to the server the first time it is seen"""
+        route_key = (req.operation_type, req.operation_name, req.component_name)
+
+        route = self.routes.get(route_key)
+        if route is None:
+            aud = self._new_audience(req)
+            self._add_audience(aud)
+
+            route = self.routes.setdefault(
+                route_key, plan.Route(aud=aud, key=self._aud_key(aud))
+            )
+
+        return route
+
+    def _is_passthrough(self, route: plan.Route, req: ProcessRequest) -> bool:
+        """Can the request be answered without running or tailing anything?"""
+        pipelines = self.pipelines.get(route.key)
+        if pipelines is not None and len(pipelines) > 0:
+            return False
+
+        if route.key in self.pending_pipelines or self.tails.get(route.key):
+            return False
+
+        # Oversized payloads are counted as errors by _process()
+        return len(req.data) <= MAX_PAYLOAD_SIZE
+
+    @staticmethod
+    def _add_counter(handle: metrics.CounterHandle, value: float) -> None:
+        handle.add(value)
+
+    def _new_audience(self, req: ProcessRequest) -> protos.Audience:
+        return self.audience_registry.get(
+            self.cfg.service_name,
+            req.operation_type,
+            req.operation_name,
+            req.component_name,
+        )
+
+    @staticmethod
+    def _not_ready_response(req: ProcessRequest) -> ProcessResponse:
+        """Response returned by the fail_closed warmup policy"""
+        return protos.SdkResponse(
+            data=req.data,
+            status=protos.ExecStatus.EXEC_STATUS_ERROR,
+            status_message="Pipelines are not ready yet",
+            pipeline_status=[],
+        )
+
+    def _process(
+        self,
+        req: ProcessRequest,
+        aud: protos.Audience,
+        pipelines: plan.AudiencePlan,
+        add,
+    ) -> ProcessResponse:
+        """Run pipelines against a single payload, passing counter increments to add(handle, value)"""
+        started = time.perf_counter()
+
         resp = protos.SdkResponse(
-            data=copy(req.data),
+            data=req.data,
             status=protos.ExecStatus.EXEC_STATUS_TRUE,
             pipeline_status=[],
         )
 
         payload_size = len(req.data)  # No need to compute this multiple times
 
-        aud = protos.Audience(
-            service_name=self.cfg.service_name,
-            operation_type=protos.OperationType(req.operation_type),
-            operation_name=req.operation_name,
-            component_name=req.component_name,
-        )
-        self._add_audience(aud)
-
-        labels = {
-            "service": self.cfg.service_name,
-            "component": req.component_name,
-            "operation": req.operation_name,
-            "pipeline_name": "",
-            "pipeline_id": "",
-        }
-
-        bytes_counter = metrics.COUNTER_CONSUME_BYTES
-        errors_counter = metrics.COUNTER_CONSUME_ERRORS
-        total_counter = metrics.COUNTER_CONSUME_PROCESSED
-        rate_bytes = metrics.COUNTER_CONSUME_BYTES_RATE
-        rate_processed = metrics.COUNTER_CONSUME_PROCESSED_RATE
-
-        if req.operation_type == OPERATION_TYPE_PRODUCER:
-            bytes_counter = metrics.COUNTER_PRODUCE_BYTES
-            errors_counter = metrics.COUNTER_PRODUCE_ERRORS
-            total_counter = metrics.COUNTER_PRODUCE_PROCESSED
-            rate_bytes = metrics.COUNTER_PRODUCE_BYTES_RATE
-            rate_processed = metrics.COUNTER_PRODUCE_PROCESSED_RATE
-
         if payload_size > MAX_PAYLOAD_SIZE:
-            self.metrics.incr(
-                CounterEntry(
-                    name=errors_counter,
-                    value=1.0,
-                    labels=labels,
-                    aud=aud,
-                )
+            add(
+                self.metrics.counter(
+                    plan.counter_names(req.operation_type).errors,
+                    {
+                        "service": self.cfg.service_name,
+                        "component": req.component_name,
+                        "operation": req.operation_name,
+                        "pipeline_name": "",
+                        "pipeline_id": "",
+                    },
+                    aud,
+                ),
+                1.0,
             )
             return resp
 
-        # Get rules based on operation and component
-        pipelines = self._get_pipelines(aud)
-
         if len(pipelines) == 0:
             self._send_tail(
                 aud,
@@ -322,18 +576,21 @@ class StreamdalClient:
             )
             return resp
 
-        self.metrics.incr(CounterEntry(name=rate_bytes, value=1.0, labels={}, aud=aud))
-        self.metrics.incr(
-            CounterEntry(name=rate_processed, value=1.0, labels={}, aud=aud)
-        )
+        add(pipelines.rate_bytes, 1.0)
+        add(pipelines.rate_processed, 1.0)
 
         # Needed for send_tail()
-        original_data = copy(req.data)
+        original_data = req.data
 
         # Used for passing data between steps
         isr = None
 
+        step_timeout = float(self.cfg.step_timeout)
+        pipeline_timeout = float(self.cfg.pipeline_timeout)
+
         for pipeline in pipelines:
+            pipeline_started = time.perf_counter()
+
             pipeline_status = protos.PipelineStatus(
                 id=pipeline.id,
                 name=pipeline.name,
@@ -342,18 +599,13 @@ class StreamdalClient:
 
             self.log.debug("Running pipeline '{}'".format(pipeline.name))
 
-            labels["pipeline_id"] = pipeline.id
-            labels["pipeline_name"] = pipeline.name
+            add(pipeline.processed, 1.0)
+            add(pipeline.bytes, payload_size)
 
-            self.metrics.incr(
-                CounterEntry(name=total_counter, value=1.0, labels=labels, aud=aud)
-            )
-
-            self.metrics.incr(
-                CounterEntry(
-                    name=bytes_counter, value=payload_size, labels=labels, aud=aud
-                )
-            )
+            # Each step gets step_timeout, but no more than what is left of the pipeline's budget
+            deadline = time.monotonic() + pipeline_timeout
+            on_timeout = partial(add, pipeline.timeouts, 1.0)
+            on_recycle = partial(add, pipeline.recycles, 1.0)
 
             for step in pipeline.steps:
                 step_status = protos.StepStatus(
@@ -361,8 +613,16 @@ class StreamdalClient:
                     status=protos.ExecStatus.EXEC_STATUS_TRUE,
                 )
 
+                timeout = None
+                if not step.timeout_exempt:
+                    timeout = min(step_timeout, deadline - time.monotonic())
+
                 # Exec wasm
-                wasm_resp = self._call_wasm(step, resp.data, isr)
+                step_started = time.perf_counter()
+                wasm_resp = self._call_wasm(
+                    step, resp.data, isr, timeout, on_timeout, on_recycle
+                )
+                step.duration.observe(time.perf_counter() - step_started)
 
                 if self.cfg.dry_run:
                     self.log.debug(f"Running step '{step.name}' in dry-run mode")
@@ -397,20 +657,13 @@ class StreamdalClient:
                     continue
 
                 # Pull metadata from step into SDKResponse
-                if cond is not None:
-                    for k, v in cond.metadata.items():
-                        resp.metadata[k] = v
+                if cond.metadata:
+                    resp.metadata.update(cond.metadata)
 
                 # Failure conditions
-                self.metrics.incr(
-                    CounterEntry(name=errors_counter, value=1.0, labels=labels, aud=aud)
-                )
+                add(pipeline.errors, 1.0)
 
-                if (
-                    cond is not None
-                    and cond.abort
-                    == protos.AbortCondition.ABORT_CONDITION_ABORT_CURRENT
-                ):
+                if cond.abort_current:
                     # Abort current pipline
                     step_status.status = (
                         protos.AbortCondition.ABORT_CONDITION_ABORT_CURRENT
@@ -418,18 +671,12 @@ class StreamdalClient:
                     step_status.status_message = "Step returned: " + wasm_resp.exit_msg
                     pipeline_status.step_status.append(step_status)
                     resp.pipeline_status.append(pipeline_status)
+                    pipeline.duration.observe(time.perf_counter() - pipeline_started)
                     # Continue outer pipeline loop if there are additional pipelines
                     break
-                elif (
-                    cond is not None
-                    and cond.abort == protos.AbortCondition.ABORT_CONDITION_ABORT_ALL
-                ):
+                elif cond.abort_all:
                     # Abort all pipelines
-                    self.metrics.incr(
-                        CounterEntry(
-                            name=errors_counter, value=1.0, labels=labels, aud=aud
-                        )
-                    )
+                    add(pipeline.errors, 1.0)
 
                     # Exit function early
                     resp.status = exec_status
@@ -438,9 +685,13 @@ class StreamdalClient:
                     step_status.status = protos.AbortCondition.ABORT_CONDITION_ABORT_ALL
                     pipeline_status.step_status.append(step_status)
                     resp.pipeline_status.append(pipeline_status)
+                    pipeline.duration.observe(time.perf_counter() - pipeline_started)
+                    pipelines.duration.observe(time.perf_counter() - started)
                     return resp
 
                 pipeline_status.step_status.append(step_status)
+            else:
+                pipeline.duration.observe(time.perf_counter() - pipeline_started)
 
             resp.pipeline_status.append(pipeline_status)
 
@@ -449,18 +700,20 @@ class StreamdalClient:
         # The value of data will be modified each step above regardless of dry run, so that pipelines
         # can execute as expected. This is why we need to reset to the original data here.
         if self.cfg.dry_run:
-            resp.data = copy(req.data)
+            resp.data = req.data
+
+        pipelines.duration.observe(time.perf_counter() - started)
 
         return resp
 
     def _notify_condition(
         self,
-        pipeline: protos.Pipeline,
-        step: protos.PipelineStep,
+        pipeline: plan.PipelinePlan,
+        step: plan.StepPlan,
         aud: protos.Audience,
-        cond: protos.PipelineStepConditions,
+        cond: plan.ConditionPlan,
         payload: bytes,
-    ):
+    ) -> Future:
         if cond is None:
             return
 
@@ -473,84 +726,140 @@ class StreamdalClient:
         if self.cfg.dry_run:
             return
 
-        async def call():
-            self.metrics.incr(
-                CounterEntry(
-                    name=metrics.COUNTER_NOTIFY,
-                    value=1.0,
-                    aud=aud,
-                    labels={
-                        "service": self.cfg.service_name,
-                        "component_name": aud.component_name,
-                        "pipeline_name": pipeline.name,
-                        "pipeline_id": pipeline.id,
-                        "operation_name": aud.operation_name,
-                    },
-                )
-            )
+        pipeline.notify.add()
 
-            req = protos.NotifyRequest(
-                pipeline_id=pipeline.id,
-                audience=aud,
-                step_name=step.name,
-                occurred_at_unix_ts_utc=int(datetime.datetime.utcnow().timestamp()),
-                # TODO: include payload
-            )
+        req = protos.NotifyRequest(
+            pipeline_id=pipeline.id,
+            audience=aud,
+            step_name=step.name,
+            occurred_at_unix_ts_utc=int(datetime.datetime.utcnow().timestamp()),
+            # TODO: include payload
+        )
 
-            await self.grpc_stub.notify(
-                req, timeout=self.grpc_timeout, metadata=self._get_metadata()
-            )
+        async def call():
+            try:
+                await self.grpc_stub.notify(
+                    req, timeout=self.grpc_timeout, metadata=self._get_metadata()
+                )
+            except Exception as e:
+                self.log.warning(f"Failed to send notification: {e}")
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(call())
+        # Sent in the background, process() doesn't wait for the server
+        return self.reactor.submit(call())
 
-    def _get_pipelines(self, aud: protos.Audience) -> list:
+    def _get_pipelines(
+        self, aud: protos.Audience, aud_str: str = None
+    ) -> plan.AudiencePlan:
         """
         Get pipelines for a given mode and operation
 
-        :return: dict of pipelines in format dict[str:protos.Command]
+        :return: compiled pipelines for the audience, an empty list if there are none, or None
+            if its first pipelines are still being warmed up and the warmup policy is fail_closed,
+            or is wait and they were not ready within warmup_timeout seconds
         """
-        aud_str = common.aud_to_str(aud)
+        if aud_str is None:
+            aud_str = self._aud_key(aud)
 
         pipelines = self.pipelines.get(aud_str)
-        if pipelines is None:
+        if pipelines is not None:
+            return pipelines
+
+        # Pipelines that are still warming up are only used if there is nothing to fall back to
+        pending = self.pending_pipelines.get(aud_str)
+        if pending is None:
+            return []
+
+        if self.cfg.warmup_policy == WARMUP_POLICY_FAIL_OPEN:
             return []
+        elif self.cfg.warmup_policy == WARMUP_POLICY_FAIL_CLOSED:
+            return None
+
+        # Should warmup never finish, payloads are failed closed rather than waiting forever
+        if not pending.ready.wait(float(self.cfg.warmup_timeout)):
+            self.log.warning(
+                f"Pipelines for audience '{aud_str}' not ready "
+                f"after '{self.cfg.warmup_timeout}' seconds"
+            )
+            return None
+
+        return pending
+
+    def wait_for_pipelines(self, timeout: float = None) -> bool:
+        """
+        Wait until all pipelines received so far are compiled and ready to process payloads
 
-        return pipelines
+        :return: True if they are ready, False if timeout seconds passed first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.pipelines_lock:
+            pending = list(self.pending_pipelines.values())
+
+        for pipelines in pending:
+            remaining = (
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+            if not pipelines.ready.wait(remaining):
+                return False
+
+        return True
 
     def _get_metadata(self) -> dict:
         """Returns map of metadata needed for gRPC calls"""
         return {"auth-token": self.auth_token}
 
     def shutdown(self, *args):
-        """Shutdown the service"""
+        """
+        Shutdown the service. Workers are stopped and the remaining metrics are published
+        within shutdown_timeout seconds.
+        """
         self.log.debug("called shutdown()")
+        deadline = time.monotonic() + float(self.cfg.shutdown_timeout)
         self.exit.set()
-        self.metrics.shutdown(args)
 
-        # Shut down tail request workers
+        # Stop heartbeat and register, the register stream otherwise waits for the next
+        # command from the server
+        for task in self.tasks:
+            task.cancel()
+
+        # Shut down tail streams
+        futures = []
         for tails in self.tails.values():
             for tr in tails.values():
-                tr.exit.set()
+                tr.stop()
+                if tr.future is not None:
+                    futures.append(tr.future)
 
-        # Shut down heartbeat and register workers
-        for worker in self.workers:
-            self.log.debug(f"Waiting for worker {worker.name} to exit")
-            try:
-                if worker.is_alive():
-                    worker.join()
-            except RuntimeError:
-                self.log.error(f"Could not exit worker {worker.name}")
-                continue
+        # Let the tails send what they have queued
+        if len(futures) > 0:
+            wait(futures, common.time_left(deadline))
 
-        # Cleanup gRPC connections
-        self.grpc_channel.close()
-        self.register_channel.close()
+        # Publish the counters incremented since the last flush, while the reactor still
+        # runs the event loop the metrics are sent on
+        self.metrics.shutdown(common.time_left(deadline))
+
+        if self.exposition is not None:
+            self.exposition.shutdown()
+
+        # Stop warming pipelines and release anyone waiting on them
+        self.warmup_pool.shutdown(wait=False)
+        with self.pipelines_lock:
+            for pipelines in self.pending_pipelines.values():
+                pipelines.ready.set()
+
+        # Stop wasm worker processes
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+        # Stop advancing the wasm epoch, it is only needed while steps with a timeout run
+        wasm.stop_epoch_ticker(common.time_left(deadline))
+
+        # Cancel whatever calls are left and close the gRPC connection
+        self.reactor.stop(common.time_left(deadline))
 
         self.log.debug("exited shutdown()")
 
-    def _heartbeat(self):
+    async def _heartbeat(self):
         async def call():
             try:
                 audiences = []
@@ -571,18 +880,12 @@ class StreamdalClient:
                 # Lost connection. Retry will occur in register
                 self.log.debug(f"unable to send heartbeat: {e}")
 
-        asyncio.set_event_loop(self.grpc_loop)
+        # Cancelled by shutdown()
         while not self.exit.is_set():
-            self.grpc_loop.run_until_complete(call())
-            self.exit.wait(DEFAULT_HEARTBEAT_INTERVAL)
-
-        # Wait for all pending tasks to complete before exiting thread, to avoid exception
-        self.grpc_loop.run_until_complete(
-            asyncio.gather(*asyncio.all_tasks(self.grpc_loop))
-        )
+            await call()
+            await asyncio.sleep(DEFAULT_HEARTBEAT_INTERVAL)
 
-        self.grpc_channel.close()
-        self.log.debug("Heartbeat thread exiting")
+        self.log.debug("Heartbeat exiting")
 
     def _gen_client_info(self) -> protos.ClientInfo:
         return protos.ClientInfo(
@@ -605,28 +908,28 @@ class StreamdalClient:
 
         # Add audiences passed on config
         for aud in self.cfg.audiences:
-            aud = protos.Audience(
-                service_name=self.cfg.service_name,
-                operation_type=protos.OperationType(aud.operation_type),
-                operation_name=aud.operation_name,
-                component_name=aud.component_name,
+            aud = self.audience_registry.get(
+                self.cfg.service_name,
+                aud.operation_type,
+                aud.operation_name,
+                aud.component_name,
             )
 
             # Add to register request
             req.audiences.append(aud)
 
             # Note in local map that we've seen this audience
-            self.audiences[common.aud_to_str(aud)] = aud
+            self.audiences[self._aud_key(aud)] = aud
 
         return req
 
-    def _register(self) -> None:
+    async def _register(self) -> None:
         """Register the service with the Streamdal Server and receive a stream of commands to execute"""
 
         async def call():
             self.log.debug("Registering with streamdal server")
 
-            async for cmd in self.register_stub.register(
+            async for cmd in self.grpc_stub.register(
                 register_request=self._gen_register_request(),
                 timeout=None,
                 metadata=self._get_metadata(),
@@ -640,11 +943,11 @@ class StreamdalClient:
                     self.log.error(f"Received invalid command: {e}")
 
         self.log.debug("Starting register looper")
-        asyncio.set_event_loop(self.register_loop)
 
+        # Cancelled by shutdown()
         while not self.exit.is_set():
             try:
-                self.register_loop.run_until_complete(call())
+                await call()
             except Exception as e:
                 self.log.debug(
                     f"Register looper lost connection: {e}, retrying in {DEFAULT_GRPC_RECONNECT_INTERVAL}s..."
@@ -653,26 +956,13 @@ class StreamdalClient:
                     # Kill all in-progress tail requests since register() will send them downstream again
                     self._stop_all_tails()
 
-                    time.sleep(DEFAULT_GRPC_RECONNECT_INTERVAL)
-                    self.register_channel = Channel(
-                        host=self.host, port=self.port, loop=self.register_loop
-                    )
-                    self.grpc_channel = Channel(
-                        host=self.host, port=self.port, loop=self.grpc_loop
-                    )
-                    self._add_audiences()
+                    await asyncio.sleep(DEFAULT_GRPC_RECONNECT_INTERVAL)
+
+                    # The channel reconnects by itself on the next call
+                    await self._add_audiences()
                 except Exception as e:
                     self.log.error(f"reconnection failed: {e}")
 
-        # Wait for all pending tasks to complete before exiting thread, to avoid exception
-        self.register_loop.run_until_complete(
-            asyncio.gather(*asyncio.all_tasks(self.register_loop))
-        )
-
-        # Cleanup gRPC connections
-        self.register_channel.close()
-        self.register_loop.stop()
-
         self.log.debug("Exited register looper")
 
     def _handle_command(self, cmd: protos.Command):
@@ -730,15 +1020,108 @@ class StreamdalClient:
         """
         validation.set_pipelines(cmd)
 
-        aud_str = common.aud_to_str(cmd.audience)
+        # Plans and their counters share the audience object used by process()
+        cmd.audience = self.audience_registry.intern(cmd.audience)
+        aud_str = self._aud_key(cmd.audience)
 
-        self.pipelines[aud_str] = cmd.set_pipelines.pipelines
+        pipelines = plan.compile_pipelines(
+            cmd, self.cfg.service_name, self.metrics.counter, self.metrics.histogram
+        )
         self.log.debug(
             f"Set '{len(cmd.set_pipelines.pipelines)}' pipelines for audience '{aud_str}'"
         )
 
+        # Pools of the modules used by pipelines are kept until no pipelines use them
+        self.functions.acquire(pipelines.wasm_ids())
+
+        with self.pipelines_lock:
+            superseded = self.pending_pipelines.get(aud_str)
+            self.pending_pipelines[aud_str] = pipelines
+
+        # Pipelines that were still warming up will never be used
+        if superseded is not None:
+            self._release_functions(superseded)
+
+        # Pipelines without wasm modules to load are ready right away, others
+        # replace the current pipelines once their modules are warmed up
+        if len(pipelines.wasm_steps()) == 0:
+            self._warm_pipelines(aud_str, pipelines)
+            return True
+
+        try:
+            self.warmup_pool.submit(self._warm_pipelines, aud_str, pipelines)
+        except RuntimeError:
+            # Shut down, nothing will warm them up. They are used as they are.
+            pipelines.ready.set()
+
         return True
 
+    def _warm_pipelines(self, aud_str: str, pipelines: plan.AudiencePlan) -> None:
+        """Compile and instantiate the modules used by pipelines, then make them active"""
+        try:
+            for step in pipelines.wasm_steps():
+                try:
+                    self._warm_step(step)
+                except Exception as e:
+                    # The step returns the error when it runs, like it did before warmup
+                    self.log.error(
+                        f"Failed to warm up wasm module for step '{step.name}': {e}"
+                    )
+
+            replaced = None
+            with self.pipelines_lock:
+                # Newer pipelines may have been set for the audience in the meantime
+                if self.pending_pipelines.get(aud_str) is pipelines:
+                    del self.pending_pipelines[aud_str]
+                    replaced = self.pipelines.get(aud_str)
+                    self.pipelines[aud_str] = pipelines
+
+            # Before signalling readiness, so waiters see the modules of replaced pipelines released
+            if replaced is not None:
+                self._release_functions(replaced)
+        finally:
+            pipelines.ready.set()
+
+        self.log.debug(
+            f"Pipelines for audience '{aud_str}' are ready, "
+            f"'{wasm.modules.stats()['released_bytes']}' wasm module bytes released so far"
+        )
+
+    def _release_functions(self, pipelines: plan.AudiencePlan) -> None:
+        """Release the modules used by pipelines that are no longer used, evicting unused ones over budget"""
+        wasm.modules.release(pipelines.module_keys)
+
+        wasm_ids = pipelines.wasm_ids()
+        evicted = self.functions.release(wasm_ids)
+
+        # Worker processes have no pools to evict, their modules go once no plan uses them
+        if self.process_pool is not None:
+            for wasm_id in wasm_ids:
+                if not self.functions.referenced(wasm_id):
+                    self.process_pool.unregister(wasm_id)
+        if evicted == 0:
+            return
+
+        self.log.debug(f"Evicted '{evicted}' unused wasm modules")
+        self.metrics.counter(
+            metrics.COUNTER_WASM_EVICTIONS,
+            {"service": self.cfg.service_name},
+            pipelines.aud,
+        ).add(float(evicted))
+
+    def _warm_step(self, step: plan.StepPlan) -> None:
+        """Compile a step's wasm module and create its first instance"""
+        if self.process_pool is not None:
+            if step.wasm_id not in self.process_pool.modules:
+                self.process_pool.register(
+                    step.wasm_id, wasm.modules.source(step.module_key), step.module_key
+                )
+            self.process_pool.load(step.wasm_id)
+            return
+
+        pool = self._get_function(step)
+        pool.checkin(pool.checkout())
+
     def _handle_kv(self, cmd: protos.Command) -> bool:
         validation.kv_command(cmd)
 
@@ -754,22 +1137,47 @@ class StreamdalClient:
             elif i.action == protos.shared.KvAction.KV_ACTION_DELETE_ALL:
                 self.kv.purge()
 
+            # Keep the KV mirrors held by worker processes in sync
+            if self.process_pool is None:
+                continue
+
+            if i.action == protos.shared.KvAction.KV_ACTION_CREATE:
+                self.process_pool.kv_set(i.object.key, cmd.kv.request.value)
+            elif i.action == protos.shared.KvAction.KV_ACTION_UPDATE:
+                self.process_pool.kv_set(i.object.key, cmd.kv.request.value)
+            elif i.action == protos.shared.KvAction.KV_ACTION_DELETE:
+                self.process_pool.kv_delete(i.object.key)
+            elif i.action == protos.shared.KvAction.KV_ACTION_DELETE_ALL:
+                self.process_pool.kv_purge()
+
         return True
 
     def _call_wasm(
-        self, step: protos.PipelineStep, data: bytes, isr: protos.InterStepResult
+        self,
+        step: plan.StepPlan,
+        data: bytes,
+        isr: protos.InterStepResult,
+        timeout: float = None,
+        on_timeout=None,
+        on_recycle=None,
     ) -> protos.WasmResponse:
+        """
+        Run a step and return its response. Failures, including running past timeout seconds,
+        are returned as a WASM_EXIT_CODE_ERROR response so that the step's on_error applies.
+        on_timeout is called when the step timed out, on_recycle when the instance that ran
+        it was recycled.
+        """
         try:
-            req = protos.WasmRequest()
-            req.input_payload = copy(data)
-            req.step = copy(step)
-            req.inter_step_result = copy(isr)
+            if not isinstance(step, plan.StepPlan):
+                step = plan.compile_step(step)
 
-            response_bytes = self._exec_wasm(req)
-
-            # Unmarshal WASM response
-            return protos.WasmResponse().parse(response_bytes)
+            return self._exec_wasm(
+                step, data, None if isr is None else bytes(isr), timeout, on_recycle
+            )
         except Exception as e:
+            if isinstance(e, common.TimeoutException) and on_timeout is not None:
+                on_timeout()
+
             resp = protos.WasmResponse()
             resp.output_payload = ""
             resp.exit_msg = "Failed to execute WASM: {}".format(e)
@@ -777,84 +1185,118 @@ class StreamdalClient:
 
             return resp
 
-    def _get_function(self, step: protos.PipelineStep) -> (Instance, Store):
-        """Get a function from the internal map of functions"""
-        if self.functions.get(step.wasm_id) is not None:
-            return self.functions[step.wasm_id]
-
-        # Function not instantiated yet
-        cfg = Config()
-        engine = Engine(cfg)
-
-        linker = Linker(engine)
-        linker.define_wasi()
-
-        module = Module(linker.engine, wasm=step.wasm_bytes)
+    def _get_linker(self) -> Linker:
+        """Get the linker used to instantiate modules, creating it on first use"""
+        if self.linker is None:
+            self.linker = wasm.new_linker(self.host_func)
+
+        return self.linker
+
+    def _get_function(self, step: plan.StepPlan) -> wasm.InstancePool:
+        """Get the pool of instances for a step's wasm module from the internal map of functions"""
+        if step.function is not None:
+            return step.function
+
+        pool = self.functions.get(step.wasm_id)
+        if pool is None:
+            # Function not instantiated yet. Modules are compiled once per process
+            # on the shared engine and keyed by the hash of their contents.
+            linker = self._get_linker()
+            if step.module_key is None:
+                raise common.StreamdalException(
+                    f"step '{step.name}' has no wasm module"
+                )
+            module = wasm.modules.load(step.module_key)
+
+            # Recycled instances are replaced by instantiating the compiled module again
+            pool = wasm.InstancePool(
+                lambda: wasm.new_instance(linker, module),
+                self.cfg.wasm_pool_size,
+                max_calls=self.cfg.wasm_instance_max_calls,
+                max_memory=self.cfg.wasm_instance_max_memory,
+            )
 
-        wasi = WasiConfig()
-        wasi.inherit_stdout()
-        wasi.inherit_stdin()
-        wasi.inherit_stderr()
+            # Another thread may have created the pool in the meantime; keep whichever won
+            pool = self.functions.setdefault(step.wasm_id, pool, step.module_key)
 
-        store = Store(linker.engine)
-        store.set_wasi(wasi)
+        # Cache the handle on the plan so later payloads skip the lookup
+        step.function = pool
+        return pool
 
-        funcs = {
-            "httpRequest": self.host_func.http_request,
-            "kvExists": self.host_func.kv_exists,
-        }
+    def function_stats(self) -> dict:
+        """Return instance pool sizing and contention stats for each wasm module"""
+        return {wasm_id: pool.stats() for (wasm_id, pool) in self.functions.items()}
 
-        for name, func in funcs.items():
-            linker.define_func(
-                "env",
-                name,
-                FuncType([ValType.i32(), ValType.i32()], [ValType.i64()]),
-                func,
-                True,
-            )
+    def latency_stats(self) -> list:
+        """
+        Return a HistogramSnapshot of the process(), pipeline and step durations of each
+        audience, with p50, p99 and p999 in seconds. Payloads of audiences without pipelines
+        are not timed.
+        """
+        return self.metrics.histogram_snapshots()
 
-        instance = linker.instantiate(store, module)
+    def function_cache_stats(self) -> dict:
+        """
+        Return the number of cached wasm modules, evictions, resident instance memory, the
+        memory saved by holding module bytes once and only until they are compiled, and the
+        hits, misses and evictions of the compiled module disk cache (wasm_cache_dir)
+        """
+        stats = self.functions.stats()
+        stats.update(wasm.modules.stats())
+        return stats
 
-        self.functions[step.wasm_id] = (instance, store)
-        return instance, store
+    def _exec_wasm(
+        self,
+        step: plan.StepPlan,
+        data: bytes,
+        isr: bytes,
+        timeout: float = None,
+        on_recycle=None,
+    ) -> protos.WasmResponse:
+        """Execute a step's wasm function against a payload and encoded inter-step result"""
+        if self.process_pool is not None:
+            return self._exec_wasm_process(step, data, isr, timeout)
 
-    def _exec_wasm(self, req: protos.WasmRequest) -> bytes:
         try:
-            instance, store = self._get_function(req.step)
+            pool = self._get_function(step)
+            inst = pool.checkout()
         except Exception as e:
             raise common.StreamdalException(
                 "Failed to instantiate function: {}".format(e)
             )
 
-        req = copy(req)
-        req.step.wasm_bytes = None  # Don't need to write this
-
-        data = bytes(req)
-
-        # Get memory from module
-        memory = instance.exports(store)["memory"]
-        # memory.grow(store, 14)  # Set memory limit to 1MB
-
-        # Get alloc() from module
-        alloc = instance.exports(store)["alloc"]
-        # Allocate enough memory for the length of the data and receive memory pointer
-        start_ptr = alloc(store, len(data))
+        try:
+            # The step is encoded once at compile time, only the payload and
+            # inter-step result are written per message
+            resp = wasm.call_step(
+                inst, step.wasm_function, step.request_step_field, data, isr, timeout
+            )
+        except Exception:
+            # An interrupted or trapped call can leave the instance's memory in an
+            # inconsistent state, so it is replaced rather than reused
+            pool.discard(inst)
+            raise
 
-        # Write to memory starting at pointer returned bys alloc()
-        memory.write(store, data, start_ptr)
+        if pool.checkin(inst):
+            self.log.debug(f"Recycled wasm instance of step '{step.name}'")
+            if on_recycle is not None:
+                on_recycle()
 
-        # Execute the function
-        f = instance.exports(store)[req.step.wasm_function]
-        result_ptr = f(store, start_ptr, len(data))
+        return resp
 
-        # Read from result pointer
-        res = common.read_memory(memory, store, result_ptr, -1)
+    def _exec_wasm_process(
+        self, step: plan.StepPlan, data: bytes, isr: bytes, timeout: float = None
+    ) -> protos.WasmResponse:
+        """Execute a wasm step in one of the worker processes"""
+        if step.wasm_id not in self.process_pool.modules:
+            self.process_pool.register(
+                step.wasm_id, wasm.modules.source(step.module_key), step.module_key
+            )
 
-        # Dealloc result pointer
-        dealloc = instance.exports(store)["dealloc"]
-        dealloc(store, result_ptr, len(res))
+        req = wasm.encode_wasm_request(step.request_step_field, data, isr)
+        res = self.process_pool.execute(step.wasm_id, step.wasm_function, req, timeout)
 
-        return res
+        return wasm.decode_wasm_response(res)
 
     # ------------------------------------------------------------------------------------
 
@@ -889,7 +1331,7 @@ class StreamdalClient:
             # This can happen if the tail request came from internal.Register()
             # and we did not have the audience yet.
             if running_tail.active is False:
-                running_tail.start_tail_workers()
+                running_tail.start()
 
             tr = protos.TailResponse(
                 type=protos.TailResponseType.TAIL_RESPONSE_TYPE_PAYLOAD,
@@ -901,14 +1343,15 @@ class StreamdalClient:
                 original_data=original_data,
                 new_data=new_data,
             )
-            running_tail.queue.put_nowait(tr)
+            running_tail.put(tr)
 
     def _start_tail(self, cmd: protos.Command):
         validation.tail_request(cmd)
 
         req = cmd.tail.request
+        req.audience = self.audience_registry.intern(req.audience)
 
-        aud_str = common.aud_to_str(req.audience)
+        aud_str = self._aud_key(req.audience)
 
         # Do we already have this tail?
         if aud_str in self.tails:
@@ -923,7 +1366,7 @@ class StreamdalClient:
             request=req,
             log=self.log,
             exit=Event(),
-            streamdal_url=self.cfg.streamdal_url,
+            reactor=self.reactor,
             auth_token=self.auth_token,
             metrics=self.metrics,
             active=False,
@@ -932,12 +1375,12 @@ class StreamdalClient:
         # Check if we have this audience yet, if not, this TailCommand came from
         # internal.Register() and should only be cached for now instead of started
         if aud_str in self.audiences:
-            t.start_tail_workers()
+            t.start()
 
         self._set_active_tail(t)
 
     def _set_active_tail(self, t: Tail):
-        key = common.aud_to_str(t.request.audience)
+        key = self._aud_key(t.request.audience)
 
         if key not in self.tails:
             self.tails[key] = {}
@@ -945,7 +1388,7 @@ class StreamdalClient:
         self.tails[key][t.request.id] = t
 
     def _set_paused_tail(self, t: Tail):
-        key = common.aud_to_str(t.request.audience)
+        key = self._aud_key(t.request.audience)
 
         if key not in self.paused_tails:
             self.paused_tails[key] = {}
@@ -961,13 +1404,13 @@ class StreamdalClient:
         tails = self._get_active_tails_for_audience(aud)
         if tail_id in tails.keys():
             self.log.debug(f"Stopping active tail: {tail_id}")
-            tails[tail_id].exit.set()
+            tails[tail_id].stop()
             self._remove_active_tail(aud, tail_id)
 
         paused_tails = self._get_paused_tails_for_audience(aud)
         if tail_id in paused_tails.keys():
             self.log.debug(f"Stopping paused tail: {tail_id}")
-            paused_tails[tail_id].exit.set()
+            paused_tails[tail_id].stop()
             self._remove_paused_tail(aud, tail_id)
 
     def _stop_all_tails(self):
@@ -979,13 +1422,13 @@ class StreamdalClient:
         audiences = self.tails.values()
         for audience in audiences:
             for t in audience.values():
-                t.exit.set()
+                t.stop()
                 self._remove_active_tail(t.request.audience, t.request.id)
 
         audiences = self.paused_tails.values()
         for audience in audiences:
             for t in audience.values():
-                t.exit.set()
+                t.stop()
                 self._remove_paused_tail(t.request.audience, t.request.id)
 
     def _pause_tail(self, cmd: protos.Command):
@@ -1020,7 +1463,7 @@ class StreamdalClient:
         self,
         aud: protos.Audience,
     ) -> dict:
-        key = common.aud_to_str(aud)
+        key = self._aud_key(aud)
         if key in self.tails:
             return self.tails[key]
 
@@ -1030,14 +1473,14 @@ class StreamdalClient:
         self,
         aud: protos.Audience,
     ) -> dict:
-        key = common.aud_to_str(aud)
+        key = self._aud_key(aud)
         if key in self.paused_tails:
             return self.paused_tails[key]
 
         return {}
 
     def _remove_active_tail(self, aud: protos.Audience, tail_id: str) -> Tail:
-        key = common.aud_to_str(aud)
+        key = self._aud_key(aud)
         if key not in self.tails:
             return None
 
@@ -1052,7 +1495,7 @@ class StreamdalClient:
         return t
 
     def _remove_paused_tail(self, aud: protos.Audience, tail_id: str) -> Tail:
-        key = common.aud_to_str(aud)
+        key = self._aud_key(aud)
         if key not in self.paused_tails:
             return None
 
@@ -1067,21 +1510,20 @@ class StreamdalClient:
         return t
 
     def _get_schema(self, aud: protos.Audience) -> bytes:
-        schema = self.schemas.get(common.aud_to_str(aud))
+        schema = self.schemas.get(self._aud_key(aud))
         if schema is None:
             return b""
 
         return schema.json_schema
 
     def _set_schema(self, aud: protos.Audience, schema: bytes) -> None:
-        self.schemas[common.aud_to_str(aud)] = protos.Schema(json_schema=schema)
+        self.schemas[self._aud_key(aud)] = protos.Schema(json_schema=schema)
 
     def _handle_schema(
-        self, aud: protos.Audience, step: protos.PipelineStep, resp: protos.WasmResponse
+        self, aud: protos.Audience, step: plan.StepPlan, resp: protos.WasmResponse
     ) -> None:
         # Only handle schema steps
-        (step_type, _) = which_one_of(step, "step")
-        if step_type != "infer_schema":
+        if not step.infer_schema:
             return
 
         # Only successful schema inferences
@@ -1102,7 +1544,7 @@ class StreamdalClient:
             await self.grpc_stub.send_schema(
                 send_schema_request=req, metadata=self._get_metadata()
             )
-            self.log.debug(f"Published schema for audience '{common.aud_to_str(aud)}'")
+            self.log.debug(f"Published schema for audience '{self._aud_key(aud)}'")
 
         self._set_schema(aud, resp.output_step)
-        self.grpc_loop.create_task(call())
+        self.reactor.submit(call())
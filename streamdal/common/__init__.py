@@ -3,15 +3,27 @@ This module contains methods common to multiple sub-modules of the streamdal pac
 """
 
 import streamdal_protos.protos as protos
+import time
+from collections import OrderedDict
+from threading import Lock
 from wasmtime import Memory
 
 
+DEFAULT_MAX_AUDIENCES = 10000  # interned by AudienceRegistry
+
+
 class StreamdalException(Exception):
     """Raised for any exception caused by python-sdk"""
 
     pass
 
 
+class TimeoutException(StreamdalException):
+    """Raised when a wasm step runs past its timeout"""
+
+    pass
+
+
 def aud_to_str(aud: protos.Audience) -> str:
     """Convert an Audience to a string"""
     return "{}.{}.{}.{}".format(
@@ -30,6 +42,120 @@ def str_to_aud(aud: str) -> protos.Audience:
     )
 
 
+class AudienceRegistry:
+    """
+    AudienceRegistry interns audiences: every distinct audience is represented by a single
+    Audience object whose key, as returned by aud_to_str(), is computed once. Once more than
+    max_size audiences are interned, the least recently used ones are evicted. Callers can
+    keep using an evicted audience, only its key is computed again.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_AUDIENCES):
+        self.max_size = int(max_size)
+
+        # (service, operation_type, operation_name, component) -> Audience
+        self.audiences = {}
+
+        # aud_to_str() -> Audience, least recently used first
+        self.by_key = OrderedDict()
+
+        # aud_to_str() -> the fields tuples of self.audiences mapping to its Audience
+        self.fields = {}
+
+        # id(Audience) -> aud_to_str(), only for interned audiences so ids aren't reused
+        self.keys = {}
+
+        self.lock = Lock()
+
+    def get(
+        self,
+        service_name: str,
+        operation_type: int,
+        operation_name: str,
+        component_name: str,
+    ) -> protos.Audience:
+        """Return the interned Audience for the given fields, creating it on first use"""
+        fields = (service_name, int(operation_type), operation_name, component_name)
+
+        aud = self.audiences.get(fields)
+        if aud is not None:
+            return self._touch(aud)
+
+        return self._intern(
+            fields,
+            protos.Audience(
+                service_name=service_name,
+                operation_type=protos.OperationType(operation_type),
+                operation_name=operation_name,
+                component_name=component_name,
+            ),
+        )
+
+    def intern(self, aud: protos.Audience) -> protos.Audience:
+        """Return the interned Audience equal to aud, interning aud if there is none yet"""
+        if id(aud) in self.keys:
+            return self._touch(aud)
+
+        fields = (
+            aud.service_name,
+            int(aud.operation_type),
+            aud.operation_name,
+            aud.component_name,
+        )
+
+        interned = self.audiences.get(fields)
+        if interned is not None:
+            return self._touch(interned)
+
+        return self._intern(fields, aud)
+
+    def _touch(self, aud: protos.Audience) -> protos.Audience:
+        with self.lock:
+            key = self.keys.get(id(aud))
+            if key is not None:
+                self.by_key.move_to_end(key)
+
+        return aud
+
+    def _intern(self, fields: tuple, aud: protos.Audience) -> protos.Audience:
+        key = aud_to_str(aud)
+
+        with self.lock:
+            # Audiences differing only in case share a key, and therefore an object
+            aud = self.by_key.setdefault(key, aud)
+            self.by_key.move_to_end(key)
+            self.keys[id(aud)] = key
+            self.audiences[fields] = aud
+            self.fields.setdefault(key, set()).add(fields)
+
+            while len(self.by_key) > self.max_size:
+                (evicted, evicted_aud) = self.by_key.popitem(last=False)
+                del self.keys[id(evicted_aud)]
+                for f in self.fields.pop(evicted):
+                    del self.audiences[f]
+
+        return aud
+
+    def key(self, aud: protos.Audience) -> str:
+        """Return the key of an audience, without computing it again if it is interned"""
+        key = self.keys.get(id(aud))
+        if key is None:
+            return aud_to_str(aud)
+
+        return key
+
+    def __len__(self) -> int:
+        return len(self.by_key)
+
+
+def time_left(deadline: float) -> float:
+    """Return the seconds left until a time.monotonic() deadline, or None if there is no deadline"""
+    if deadline is None:
+        return None
+
+    return max(0.0, deadline - time.monotonic())
+
+
 def read_memory(memory: Memory, store, result_ptr: int, length: int = None) -> bytes:
     """
     This function has three operation modes:
@@ -0,0 +1,251 @@
+"""
+This module contains an optional HTTP server that exposes the client's metrics in the Prometheus
+text format, so that they can be scraped from the process itself rather than through the
+Streamdal server, including while the server is unreachable.
+"""
+
+import logging
+import math
+import re
+import streamdal_protos.protos as protos
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from streamdal.metrics import (
+    HISTOGRAM_BUCKETS,
+    HISTOGRAM_MAX_MICROS,
+    Metrics,
+    bucket_bounds,
+)
+from threading import Thread
+
+DEFAULT_PORT = 0  # Disabled
+METRIC_PREFIX = "streamdal_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+CHUNK_SIZE = 64 * 1024  # Bytes written to the connection at once
+
+INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+# Histograms are exposed with the same buckets for every series: powers of two microseconds,
+# up to the first one above HISTOGRAM_MAX_MICROS. Prometheus needs a fixed set of bounds to
+# aggregate buckets across series and over time.
+HISTOGRAM_BOUNDS = (HISTOGRAM_MAX_MICROS + 1).bit_length()
+
+# Index of the exposed bucket each histogram bucket is counted in, the first power of two that
+# is at least its upper bound
+BOUND_INDEX = [
+    (bucket_bounds(index)[1] - 1).bit_length() for index in range(HISTOGRAM_BUCKETS)
+]
+
+
+def format_value(value: float) -> str:
+    """Return a sample value as Prometheus writes it, which differs from repr() for inf and nan"""
+    if math.isnan(value):
+        return "NaN"
+
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(value)
+
+
+# The le label of each exposed bucket, in seconds
+BOUND_LABELS = [format_value((1 << k) / 1_000_000) for k in range(HISTOGRAM_BOUNDS)]
+
+
+def metric_name(name: str) -> str:
+    return METRIC_PREFIX + INVALID_NAME_CHARS.sub("_", name)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def series_labels(labels: dict, aud: protos.Audience) -> dict:
+    """
+    Return the labels of a series, including those of its audience, since series of different
+    audiences may otherwise have the same labels
+    """
+    if aud is None:
+        return labels
+
+    operation_type = protos.OperationType(aud.operation_type).name
+    return {
+        "service": aud.service_name,
+        "component": aud.component_name,
+        "operation_type": operation_type.replace("OPERATION_TYPE_", "").lower(),
+        "operation": aud.operation_name,
+        **labels,
+    }
+
+
+def encode_labels(labels: dict) -> str:
+    """Return labels as they appear between the braces of a sample line"""
+    return ",".join(
+        f'{INVALID_NAME_CHARS.sub("_", name)}="{escape(str(value))}"'
+        for name, value in labels.items()
+    )
+
+
+def sample(name: str, labels: str) -> str:
+    """Return the start of a sample line, up to the value"""
+    if labels == "":
+        return name + " "
+
+    return f"{name}{{{labels}}} "
+
+
+class Exposition:
+    """
+    Class Exposition renders the metrics of a Metrics in the Prometheus text format. The start
+    of each counter's sample line is encoded once and kept for as long as the counter exists,
+    so a scrape only formats the values.
+    """
+
+    metrics: Metrics
+    lines: dict
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+        # Counter handle to the encoded sample line up to the value. Handles are used rather
+        # than series keys since they hash faster, the publisher keeps one per series.
+        self.lines = {}
+
+    @staticmethod
+    def encode_line(handle) -> bytes:
+        entry = handle.entry
+        labels = encode_labels(series_labels(entry.labels, entry.aud))
+        return sample(metric_name(entry.name), labels).encode()
+
+    def render(self):
+        """Yield the exposition in chunks of about CHUNK_SIZE bytes"""
+        histograms = defaultdict(list)
+        for h in self.metrics.histogram_snapshots():
+            histograms[h.name].append(h)
+
+        # Histograms publish their count and sum as counters, which the histograms include
+        published = set()
+        for name in histograms:
+            published.update((name + "_count", name + "_sum"))
+
+        # Series IDs of the counters by name, since a name's series must be rendered together
+        (handles, totals) = self.metrics.counter_totals()
+        counters = defaultdict(list)
+        for id, handle in enumerate(handles):
+            if handle is not None and handle.entry.name not in published:
+                counters[handle.entry.name].append(id)
+
+        previous = self.lines
+        lines = {}
+        chunk = []
+        size = 0
+
+        for name, series in counters.items():
+            chunk.append(f"# TYPE {metric_name(name)} counter\n".encode())
+
+            for id in series:
+                handle = handles[id]
+                line = previous.get(handle)
+                if line is None:
+                    line = self.encode_line(handle)
+                lines[handle] = line
+
+                line += format_value(totals[id]).encode() + b"\n"
+                chunk.append(line)
+                size += len(line)
+
+                if size >= CHUNK_SIZE:
+                    yield b"".join(chunk)
+                    chunk = []
+                    size = 0
+
+        # Counters that no longer exist are forgotten
+        self.lines = lines
+
+        for name, snapshots in histograms.items():
+            chunk.append(self.render_histograms(name, snapshots))
+
+        yield b"".join(chunk)
+
+    @staticmethod
+    def render_histograms(name: str, snapshots: list) -> bytes:
+        """
+        Render histograms with the buckets of HISTOGRAM_BOUNDS, including the empty ones, so
+        that every series has the same bounds. Bounds are in seconds.
+        """
+        name = metric_name(name)
+        out = [f"# TYPE {name} histogram\n"]
+
+        for h in snapshots:
+            labels = encode_labels(series_labels(h.labels, h.aud))
+            sep = "," if labels else ""
+
+            counts = [0] * HISTOGRAM_BOUNDS
+            for index, count in enumerate(h.counts):
+                if count:
+                    counts[BOUND_INDEX[index]] += count
+
+            seen = 0
+            for le, count in zip(BOUND_LABELS, counts):
+                seen += count
+                out.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {seen}\n')
+
+            out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {h.count}\n')
+            out.append(f"{sample(name + '_sum', labels)}{format_value(h.sum)}\n")
+            out.append(f"{sample(name + '_count', labels)}{h.count}\n")
+
+        return "".join(out).encode()
+
+
+class ExpositionHandler(BaseHTTPRequestHandler):
+    """Serves the exposition of the server's Exposition at /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.end_headers()
+
+        # The response has no Content-Length, it ends when the connection is closed
+        for chunk in self.server.exposition.render():
+            self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        self.server.log.debug("metrics exposition: " + format % args)
+
+
+class ExpositionServer:
+    """
+    Class ExpositionServer serves the metrics of a Metrics at http://<host>:<port>/metrics in
+    a background thread. Port 0 binds a free port.
+    """
+
+    server: ThreadingHTTPServer
+    thread: Thread
+
+    def __init__(
+        self, metrics: Metrics, port: int, host: str = "", log: logging.Logger = None
+    ):
+        self.server = ThreadingHTTPServer((host, port), ExpositionHandler)
+        self.server.daemon_threads = True
+        self.server.exposition = Exposition(metrics)
+        self.server.log = log or logging.getLogger("streamdal-client")
+        self.thread = Thread(
+            target=self.server.serve_forever, name="streamdal-metrics", daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def shutdown(self) -> None:
+        """Stop serving and close the listening socket"""
+        if self.thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
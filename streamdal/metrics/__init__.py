@@ -1,15 +1,38 @@
+from array import array
 from dataclasses import dataclass, field
+import streamdal.common as common
 import streamdal_protos.protos as protos
-from threading import Thread, Lock, Event
-from queue import SimpleQueue, Empty
+from threading import Thread, Lock, Event, current_thread, local
 import asyncio
 import logging
-from datetime import datetime
-from copy import deepcopy, copy
+import math
+import sys
+import time
 
-WORKER_POOL_SIZE = 3
 DEFAULT_COUNTER_REAPER_INTERVAL = 10
 DEFAULT_COUNTER_TTL = 10
+DEFAULT_FLUSH_INTERVAL = 1  # 1 second
+DEFAULT_MAX_BATCH_SIZE = 500  # metrics per MetricsRequest
+DEFAULT_MAX_SERIES = 10000  # distinct counters
+DEFAULT_MAX_PENDING_REQUESTS = 4  # MetricsRequests in flight
+
+# Counters are expired by generation: every reaper run starts a new generation, and a counter
+# not incremented for this many whole generations is removed if it has nothing to publish
+COUNTER_TTL_GENERATIONS = math.ceil(
+    DEFAULT_COUNTER_TTL / DEFAULT_COUNTER_REAPER_INTERVAL
+)
+
+# What flush() does with values it can't send, because max_pending requests are still in
+# flight or because sending failed
+DROP_POLICY_HOLD = (
+    "hold"  # Keep them in their counters and send them with a later flush
+)
+DROP_POLICY_DROP = "drop"  # Discard them and count them in COUNTER_DROPPED_METRICS
+
+# Reasons metric values are dropped, the "reason" label of COUNTER_DROPPED_METRICS
+DROP_REASON_MAX_SERIES = "max_series"
+DROP_REASON_MAX_PENDING = "max_pending"
+DROP_REASON_PUBLISH_FAILED = "publish_failed"
 
 # Counter type constants
 COUNTER_CONSUME_BYTES = "counter_consume_bytes"
@@ -18,15 +41,33 @@ COUNTER_CONSUME_ERRORS = "counter_consume_errors"
 COUNTER_PRODUCE_BYTES = "counter_produce_bytes"
 COUNTER_PRODUCE_PROCESSED = "counter_produce_processed"
 COUNTER_PRODUCE_ERRORS = "counter_produce_errors"
+COUNTER_CONSUME_TIMEOUTS = "counter_consume_timeouts"
+COUNTER_PRODUCE_TIMEOUTS = "counter_produce_timeouts"
 COUNTER_NOTIFY = "counter_notify"
 
 COUNTER_DROPPED_TAIL_MESSAGES = "counter_dropped_tail_messages"
+COUNTER_WASM_EVICTIONS = "counter_wasm_evictions"
+COUNTER_WASM_RECYCLES = "counter_wasm_recycles"
+COUNTER_DROPPED_METRICS = "counter_dropped_metrics"
 
 COUNTER_CONSUME_BYTES_RATE = "counter_consume_bytes_rate"
 COUNTER_PRODUCE_BYTES_RATE = "counter_produce_bytes_rate"
 COUNTER_CONSUME_PROCESSED_RATE = "counter_consume_processed_rate"
 COUNTER_PRODUCE_PROCESSED_RATE = "counter_produce_processed_rate"
 
+# Histogram type constants. Histograms are published as two counters, <name>_count and
+# <name>_sum, quantiles are available in-process through Metrics.histogram_snapshots()
+HISTOGRAM_PROCESS_SECONDS = "histogram_process_seconds"
+HISTOGRAM_PIPELINE_SECONDS = "histogram_pipeline_seconds"
+HISTOGRAM_STEP_SECONDS = "histogram_step_seconds"
+
+# Histograms count durations in microseconds using log-linear buckets: below
+# HISTOGRAM_SUB_BUCKETS microseconds every bucket is one microsecond wide, above that each
+# power of two is split into HISTOGRAM_SUB_BUCKETS buckets, so quantiles are within ~3%.
+HISTOGRAM_SUB_BUCKET_BITS = 4
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS
+HISTOGRAM_MAX_MICROS = (1 << 32) - 1  # ~71 minutes, longer durations are clamped
+
 
 @dataclass
 class CounterEntry:
@@ -43,37 +84,454 @@ class CounterEntry:
     value: float = 0.0
 
 
-@dataclass
-class Counter:
-    """Class Counter is a data class that represents a single counter metric"""
+def bucket_index(micros: int) -> int:
+    """Return the histogram bucket for a duration in microseconds"""
+    if micros < HISTOGRAM_SUB_BUCKETS:
+        return max(micros, 0)
 
-    entry: CounterEntry
-    lock: Lock = Lock()
-    last_updated: datetime = datetime.utcnow()
-    value: float = 0.0
+    if micros > HISTOGRAM_MAX_MICROS:
+        micros = HISTOGRAM_MAX_MICROS
+
+    shift = micros.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1
+    return shift * HISTOGRAM_SUB_BUCKETS + (micros >> shift)
+
+
+def bucket_bounds(index: int) -> tuple:
+    """Return the (lower, upper) bounds in microseconds of a histogram bucket"""
+    if index < 2 * HISTOGRAM_SUB_BUCKETS:
+        return index, index + 1
+
+    shift = index // HISTOGRAM_SUB_BUCKETS - 1
+    sub = index - shift * HISTOGRAM_SUB_BUCKETS
+    return sub << shift, (sub + 1) << shift
+
+
+HISTOGRAM_BUCKETS = bucket_index(HISTOGRAM_MAX_MICROS) + 1
+
+
+class HistogramPart:
+    """Class HistogramPart holds the samples a single thread recorded into a histogram"""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.total = 0.0
+
+    def merge(self, other: "HistogramPart") -> None:
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+
+
+@dataclass(frozen=True)
+class HistogramSnapshot:
+    """Class HistogramSnapshot is a point in time copy of a histogram's samples"""
+
+    name: str
+    labels: dict
+    aud: protos.Audience
+    count: int
+    sum: float
+    counts: tuple
+
+    def quantile(self, q: float) -> float:
+        """Return the duration in seconds below which a q fraction of the samples fall"""
+        if self.count == 0:
+            return 0.0
+
+        rank = max(1, min(self.count, int(q * self.count + 0.5)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                (lower, upper) = bucket_bounds(index)
+                return (lower + upper) / 2 / 1_000_000
+
+        return HISTOGRAM_MAX_MICROS / 1_000_000
+
+    @property
+    def p50(self) -> float:
+        return self.quantile(0.5)
+
+    @property
+    def p99(self) -> float:
+        return self.quantile(0.99)
+
+    @property
+    def p999(self) -> float:
+        return self.quantile(0.999)
+
+
+class Histogram:
+    """
+    Class Histogram records durations for a single series. Each thread records into its own
+    HistogramPart, so observe() takes no lock; snapshot() adds the parts up.
 
-    def __init__(self, entry: CounterEntry):
+    generation is the last generation the histogram recorded samples in, histograms idle for
+    COUNTER_TTL_GENERATIONS generations are removed from Metrics by expire().
+    """
+
+    __slots__ = (
+        "metrics",
+        "key",
+        "entry",
+        "parts",
+        "retired",
+        "count_handle",
+        "sum_handle",
+        "published_count",
+        "published_sum",
+        "generation",
+    )
+
+    def __init__(self, metrics, key: tuple, entry: CounterEntry):
+        self.metrics = metrics
+        self.key = key
+        self.entry = entry
+        self.parts = []
+
+        # Samples of threads that have exited
+        self.retired = HistogramPart()
+
+        self.count_handle = metrics.counter(
+            entry.name + "_count", entry.labels, entry.aud
+        )
+        self.sum_handle = metrics.counter(entry.name + "_sum", entry.labels, entry.aud)
+        self.published_count = 0
+        self.published_sum = 0.0
+        self.generation = metrics.generation
+
+    def observe(self, seconds: float) -> None:
+        """Record a duration in seconds"""
+        shard = getattr(self.metrics.shard, "shard", None)
+        if shard is None or shard.retired:
+            shard = self.metrics._new_shard()
+
+        part = shard.histograms.get(self)
+        if part is None:
+            part = HistogramPart()
+            shard.histograms[self] = part
+            with self.metrics.lock:
+                self.parts.append(part)
+
+                # Expiring a histogram retires the shards, so one that was expired while
+                # its holder kept it comes back here
+                self.metrics.histograms.setdefault(self.key, self)
+                self.generation = self.metrics.generation
+
+        part.counts[bucket_index(int(seconds * 1_000_000))] += 1
+        part.count += 1
+        part.total += seconds
+
+    def retire(self, part: HistogramPart) -> None:
+        """Fold the part of an exited thread into the histogram. Called with metrics.lock held."""
+        self.retired.merge(part)
+        self.parts.remove(part)
+
+    def totals(self) -> tuple:
+        """Return the number of samples and their sum"""
+        with self.metrics.lock:
+            parts = [self.retired] + self.parts
+            return sum(p.count for p in parts), sum(p.total for p in parts)
+
+    def snapshot(self) -> HistogramSnapshot:
+        with self.metrics.lock:
+            parts = [self.retired] + self.parts
+            counts = tuple(map(sum, zip(*(p.counts for p in parts))))
+            count = sum(p.count for p in parts)
+            total = sum(p.total for p in parts)
+
+        return HistogramSnapshot(
+            name=self.entry.name,
+            labels=self.entry.labels,
+            aud=self.entry.aud,
+            count=count,
+            sum=total,
+            counts=counts,
+        )
+
+
+class CounterHandle:
+    """
+    Class CounterHandle is a counter resolved once by Metrics.counter(). add() writes to the
+    calling thread's counter shard without building a CounterEntry or a key for the counter.
+    """
+
+    __slots__ = ("metrics", "key", "entry")
+
+    def __init__(self, metrics, key: tuple, entry: CounterEntry):
+        self.metrics = metrics
+        self.key = key
         self.entry = entry
 
+    def add(self, value: float = 1.0) -> None:
+        """Increment the counter by the given value"""
+        shard = getattr(self.metrics.shard, "shard", None)
+        if shard is None or shard.retired:
+            shard = self.metrics._new_shard()
+
+        shard.add(self, value)
+
+
+class OverflowHandle(CounterHandle):
+    """
+    Class OverflowHandle is returned by Metrics.counter() for a series past max_series. While the
+    series doesn't fit, increments are counted in COUNTER_DROPPED_METRICS instead of adding their
+    value. Handles are held by callers, compiled pipelines among them, so capacity is checked
+    again on the first increment of each generation, once the reaper may have freed series, and
+    the handle forwards to the series' own handle from then on.
+    """
+
+    __slots__ = ("generation", "handle")
+
+    def __init__(self, metrics, key: tuple, entry: CounterEntry):
+        super().__init__(metrics, key, entry)
+        self.generation = metrics.generation
+        self.handle = None
+
+    def add(self, value: float = 1.0) -> None:
+        if self.handle is None and self.generation != self.metrics.generation:
+            self.resolve()
+
+        if self.handle is None:
+            self.metrics.overflow.add(1.0)
+        else:
+            self.handle.add(value)
+
+    def resolve(self) -> None:
+        """Resolve the series' handle if it fits under max_series now"""
+        self.generation = self.metrics.generation
+        entry = self.entry
+        handle = self.metrics.counter(entry.name, entry.labels, entry.aud)
+        if not isinstance(handle, OverflowHandle):
+            self.handle = handle
+
+
+class CounterBatch:
+    """
+    Class CounterBatch accumulates counter increments locally, so that a batch of
+    operations results in a single add() per distinct counter handle instead of one per increment.
+    """
+
+    handles: dict
+
+    def __init__(self):
+        self.handles = {}
+
+    def add(self, handle: CounterHandle, value: float = 1.0) -> None:
+        """Add a value to a counter handle in the batch"""
+        self.handles[handle] = self.handles.get(handle, 0.0) + value
+
+    def flush(self, metrics) -> None:
+        """Apply all accumulated increments to the given Metrics and empty the batch"""
+        handles = self.handles
+        self.handles = {}
+
+        for handle, value in handles.items():
+            handle.add(value)
+
+
+class CounterShard:
+    """
+    Class CounterShard holds running totals of the counters incremented by a single thread.
+
+    Only the owning thread writes to a shard and totals are never reset, so incr() needs no
+    lock: the publisher reads the totals and publishes the difference since its last read.
+
+    Once counters are reaped, shards are retired so that they don't keep reaped counters'
+    totals around: the owning thread starts a new shard and merge() drops the retired one.
+    retired counts the merges since the shard was retired, 0 while it is in use.
+    """
+
+    thread: Thread
+    totals: dict
+    merged: dict
+    histograms: dict
+    retired: int
+
+    def __init__(self):
+        self.thread = current_thread()
+        self.totals = {}
+        self.merged = {}
+        self.histograms = {}
+        self.retired = 0
+
+    def add(self, handle: CounterHandle, value: float) -> None:
+        """Add a value to a counter's total. Must only be called by the owning thread."""
+        total = self.totals.get(handle)
+        if total is None:
+            self.totals[handle] = value
+        else:
+            self.totals[handle] = total + value
+
+    def collect(self) -> list:
+        """Return (handle, value) for each counter incremented since the last collect()"""
+        collected = []
+
+        # Copying the items is atomic, the owning thread may add keys while we iterate
+        for handle, total in list(self.totals.items()):
+            value = total - self.merged.get(handle, 0.0)
+            if value == 0:
+                continue
+
+            self.merged[handle] = total
+            collected.append((handle, value))
+
+        return collected
+
+
+class CounterStore:
+    """
+    Class CounterStore holds the values of all counters in columns. A counter's series ID
+    indexes into values (what is yet to be published), totals (everything counted since the
+    series was created), generations (the reaper generation of its last increment, 0 if never
+    incremented) and handles, which holds the CounterHandle that created the series and so
+    carries its key and CounterEntry. IDs of removed series are reused.
+
+    lock is Metrics.lock: the store is only used with it held, and Counter views take it too.
+    """
+
+    __slots__ = (
+        "lock",
+        "index",
+        "values",
+        "totals",
+        "generations",
+        "handles",
+        "size",
+        "free",
+    )
+
+    def __init__(self, lock: Lock, capacity: int = 64):
+        self.lock = lock
+        self.index = {}
+        self.values = array("d", bytes(8 * capacity))
+        self.totals = array("d", bytes(8 * capacity))
+        self.generations = array("Q", bytes(8 * capacity))
+        self.handles = [None] * capacity
+        self.size = 0
+        self.free = []
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.index
+
+    def __getitem__(self, key: tuple) -> "Counter":
+        return Counter(self, self.index[key])
+
+    def get(self, key: tuple) -> "Counter":
+        """Return a view of the counter with the given key, or None"""
+        id = self.index.get(key)
+        return None if id is None else Counter(self, id)
+
+    def add(self, handle: CounterHandle) -> int:
+        """Return the series ID of a handle's counter, adding the counter if it doesn't exist"""
+        id = self.index.get(handle.key)
+        if id is not None:
+            return id
+
+        if self.free:
+            id = self.free.pop()
+        else:
+            if self.size == len(self.handles):
+                self._grow()
+            id = self.size
+            self.size += 1
+
+        self.index[handle.key] = id
+        self.handles[id] = handle
+        self.values[id] = 0.0
+        self.totals[id] = 0.0
+        self.generations[id] = 0
+
+        return id
+
+    def remove(self, key: tuple) -> int:
+        """Remove a counter and return the series ID it had"""
+        id = self.index.pop(key)
+        self.handles[id] = None
+        self.free.append(id)
+        return id
+
+    def _grow(self) -> None:
+        capacity = len(self.handles)
+        self.values.frombytes(bytes(8 * capacity))
+        self.totals.frombytes(bytes(8 * capacity))
+        self.generations.frombytes(bytes(8 * capacity))
+        self.handles.extend([None] * capacity)
+
+
+class Counter:
+    """
+    Class Counter is a view of a single counter in a CounterStore. Views are only valid until
+    their counter is reaped, since its series ID is then reused.
+    """
+
+    __slots__ = ("store", "id", "handle")
+
+    def __init__(self, store: CounterStore, id: int):
+        self.store = store
+        self.id = id
+        self.handle = store.handles[id]
+
+    @property
+    def entry(self) -> CounterEntry:
+        return self.handle.entry
+
     def incr(self, value: float):
         """Increment the counter by the given value"""
-        self.lock.acquire(blocking=True)
-        self.value += value
-        self.last_updated = datetime.utcnow()
-        self.lock.release()
+        with self.store.lock:
+            self.store.values[self.id] += value
+            self.store.totals[self.id] += value
 
     def reset(self):
         """Reset the counter to 0"""
-        self.lock.acquire(blocking=True)
-        self.value = 0.0
-        self.lock.release()
+        with self.store.lock:
+            self.store.values[self.id] = 0.0
+
+    def take(self) -> float:
+        """Return the current value of the counter and reset it to 0"""
+        with self.store.lock:
+            value = self.store.values[self.id]
+            self.store.values[self.id] = 0.0
+        return value
 
     def val(self) -> float:
         """Return the current value of the counter"""
-        self.lock.acquire(blocking=False)
-        value = copy(self.value)
-        self.lock.release()
-        return value
+        with self.store.lock:
+            return self.store.values[self.id]
+
+
+def aud_key(aud: protos.Audience) -> str:
+    """Return the audience part of a counter key, interned so that series of an audience share it"""
+    return "" if aud is None else sys.intern(common.aud_to_str(aud))
+
+
+def counter_key(name: str, labels: dict, aud: protos.Audience) -> tuple:
+    """
+    Return the key identifying a counter series. Unlike composite_id(), label names and the
+    audience are part of the key, so label sets with the same values don't collide.
+    """
+    return (name, aud_key(aud), tuple(sorted(labels.items())))
+
+
+def new_overflow_handle(metrics) -> CounterHandle:
+    """Return the handle counting increments of series past max_series"""
+    labels = {"reason": DROP_REASON_MAX_SERIES}
+    return CounterHandle(
+        metrics,
+        counter_key(COUNTER_DROPPED_METRICS, labels, None),
+        CounterEntry(name=COUNTER_DROPPED_METRICS, aud=None, labels=labels),
+    )
 
 
 def composite_id(entry: CounterEntry) -> str:
@@ -86,17 +544,46 @@ def composite_id(entry: CounterEntry) -> str:
     return "{}-{}".format(entry.name, "-".join(labels))
 
 
+@dataclass(frozen=True)
+class CounterSnapshot:
+    """Class CounterSnapshot is the total a counter has counted since it was created"""
+
+    name: str
+    labels: dict
+    aud: protos.Audience
+    value: float
+
+
+@dataclass(frozen=True)
+class MetricsSnapshot:
+    """Class MetricsSnapshot holds a CounterSnapshot and a HistogramSnapshot per series"""
+
+    counters: list
+    histograms: list
+
+
 class Metrics:
     """Class Metrics is used to manage counter metrics, and ship them to Streamdal server asynchronously"""
 
     loop: asyncio.AbstractEventLoop
     log: logging.Logger
     exit: Event
-    counters: dict = field(default_factory=dict)
+    counters: CounterStore
     stub: protos.InternalStub = None
     lock: Lock
-    publish_queue: SimpleQueue = SimpleQueue()
-    incr_queue: SimpleQueue = SimpleQueue()
+    shards: list
+    handles: dict
+    exempt: dict
+    histograms: dict
+    flush_interval: float
+    max_batch_size: int
+    max_series: int
+    max_pending: int
+    drop_policy: str
+    requests: set
+    overflow: CounterHandle
+    generation: int
+    buckets: dict
 
     def __init__(self, **kwargs):
         log = kwargs.get("log", logging.getLogger("streamdal-client"))
@@ -104,11 +591,28 @@ class Metrics:
 
         self.stub = kwargs.get("stub")
         self.log = log
-        self.counters = {}
         self.lock = Lock()
+        self.counters = CounterStore(self.lock)
+        self.shards = []
+        self.shard = local()
+        self.handles = {}
+        self.exempt = {}
+        self.entries = {}
+        self.histograms = {}
+        self.generation = 1
+        self.buckets = {}
         self.loop = kwargs.get("loop")
         self.auth_token = kwargs.get("auth_token")
         self.exit = kwargs.get("exit")
+        self.flush_interval = float(
+            kwargs.get("flush_interval", DEFAULT_FLUSH_INTERVAL)
+        )
+        self.max_batch_size = int(kwargs.get("max_batch_size", DEFAULT_MAX_BATCH_SIZE))
+        self.max_series = int(kwargs.get("max_series", DEFAULT_MAX_SERIES))
+        self.max_pending = int(kwargs.get("max_pending", DEFAULT_MAX_PENDING_REQUESTS))
+        self.drop_policy = kwargs.get("drop_policy", DROP_POLICY_HOLD)
+        self.requests = set()
+        self.overflow = new_overflow_handle(self)
 
         self.__start()
 
@@ -117,141 +621,460 @@ class Metrics:
 
         self.workers = []
 
-        for i in range(WORKER_POOL_SIZE):
-            incr_worker = Thread(
-                target=self.run_incrementer_worker, args=(i + 1,), daemon=False
-            )
-            incr_worker.start()
-            self.workers.append(incr_worker)
-
-            # Run counter incrementer. We use no blocking queue when increasing counters and then
-            # this background thread does the actual incrementing. This is to avoid blocking the caller of incr()
-            publish_worker = Thread(
-                target=self.run_publisher_worker, args=(i + 1,), daemon=False
-            )
-            publish_worker.start()
-            self.workers.append(publish_worker)
-
         # Run counter reaper, this cleans up old empty counters to prevent memory leaks
         reaper = Thread(target=self.run_reaper, daemon=False)
         reaper.start()
         self.workers.append(reaper)
 
-        # Run counter publisher. This reads values from counters,
-        # adds them to the publish queue and then resets the counter.
+        # Run counter publisher. This merges the counter shards of all threads and publishes
+        # the values of all counters in batches, resetting the counters.
         publisher = Thread(target=self.run_publisher, daemon=False)
         publisher.start()
         self.workers.append(publisher)
 
     def get_counter(self, entry: CounterEntry) -> Counter:
-        id = composite_id(entry)
-        self.lock.acquire(blocking=False)
-        c = self.counters.get(id)
-        self.lock.release()
-        return c
+        id = counter_key(entry.name, entry.labels, entry.aud)
+        with self.lock:
+            return self.counters.get(id)
 
     def new_counter(self, entry: CounterEntry) -> Counter:
-        c = Counter(entry)
+        key = counter_key(entry.name, entry.labels, entry.aud)
+        handle = CounterHandle(self, key, entry)
 
         self.lock.acquire(blocking=True)
-        self.counters[composite_id(entry)] = c
+        id = self.counters.add(handle)
+        self._touch(key, id)
         self.lock.release()
 
-        return c
+        return Counter(self.counters, id)
+
+    def _touch(self, key: tuple, id: int) -> None:
+        """Move a counter to the current generation's bucket. Called with the lock held."""
+        generations = self.counters.generations
+        if generations[id] == self.generation:
+            return
+
+        bucket = self.buckets.get(generations[id])
+        if bucket is not None:
+            bucket.discard(key)
+
+        generations[id] = self.generation
+        bucket = self.buckets.get(self.generation)
+        if bucket is None:
+            bucket = self.buckets[self.generation] = set()
+        bucket.add(key)
+
+        # Every stored series has a cached handle, so max_series counts the series brought
+        # back by handles held past their reaping too. Dropped counters aren't counted.
+        cache = self.exempt if key[0] == COUNTER_DROPPED_METRICS else self.handles
+        cache.setdefault(key, self.counters.handles[id])
+
+    def counter(
+        self, name: str, labels: dict, aud: protos.Audience = None
+    ) -> CounterHandle:
+        """
+        Return a handle for the counter with the given name, labels and audience. Callers that
+        increment the same counter repeatedly should hold on to the handle.
+        """
+        # Cached by series, so equal audiences and label sets share a handle however they are
+        # built. Callers on hot paths hold on to the handle rather than building the key.
+        key = counter_key(name, labels, aud)
+
+        handle = self.handles.get(key)
+        if handle is None:
+            # The cache holds one handle per distinct series, stored or not merged yet.
+            # Increments of counters past the limit are only counted as dropped.
+            if len(self.handles) >= self.max_series:
+                entry = CounterEntry(name=name, aud=aud, labels=dict(labels))
+                return OverflowHandle(self, key, entry)
+
+            handle = self._new_handle(self.handles, key, name, labels, aud)
+
+        return handle
+
+    def dropped(self, reason: str) -> CounterHandle:
+        """Return the handle of the counter of metric values dropped for the given reason"""
+        labels = {"reason": reason}
+        key = counter_key(COUNTER_DROPPED_METRICS, labels, None)
+
+        # Not subject to max_series, so drops can always be reported
+        handle = self.exempt.get(key)
+        if handle is None:
+            handle = self._new_handle(
+                self.exempt, key, COUNTER_DROPPED_METRICS, labels, None
+            )
+
+        return handle
+
+    def _new_handle(
+        self, cache: dict, key: tuple, name: str, labels: dict, aud: protos.Audience
+    ) -> CounterHandle:
+        # Labels are copied since callers may modify the dict afterwards
+        entry = CounterEntry(name=name, aud=aud, labels=dict(labels))
+        handle = CounterHandle(self, key, entry)
+
+        with self.lock:
+            return cache.setdefault(key, handle)
+
+    def histogram(
+        self, name: str, labels: dict, aud: protos.Audience = None
+    ) -> Histogram:
+        """
+        Return the histogram with the given name, labels and audience. Histograms without
+        samples for COUNTER_TTL_GENERATIONS generations are removed, as idle counters are,
+        and are added back once they record again.
+        """
+        key = counter_key(name, labels, aud)
+
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            entry = CounterEntry(name=name, aud=aud, labels=dict(labels))
+            histogram = Histogram(self, key, entry)
+            with self.lock:
+                histogram = self.histograms.setdefault(key, histogram)
+
+        return histogram
+
+    def histogram_snapshots(self) -> list:
+        """Return a HistogramSnapshot of every histogram"""
+        with self.lock:
+            histograms = list(self.histograms.values())
+
+        return [h.snapshot() for h in histograms]
+
+    def counter_totals(self) -> tuple:
+        """
+        Return copies of the handles and totals columns of the counters, as of the publisher's
+        last merge. Handles are None for unused series IDs. Only the copies are made while
+        holding the lock, and nothing is merged or reset.
+        """
+        with self.lock:
+            size = self.counters.size
+            return self.counters.handles[:size], self.counters.totals[:size]
+
+    def snapshot(self) -> MetricsSnapshot:
+        """
+        Return the totals of all counters and the samples of all histograms, without affecting
+        what is published. Counters are at most flush_interval seconds behind.
+        """
+        (handles, totals) = self.counter_totals()
+        counters = [
+            CounterSnapshot(
+                name=handle.entry.name,
+                labels=handle.entry.labels,
+                aud=handle.entry.aud,
+                value=total,
+            )
+            for handle, total in zip(handles, totals)
+            if handle is not None
+        ]
+
+        return MetricsSnapshot(counters=counters, histograms=self.histogram_snapshots())
 
     def incr(self, entry: CounterEntry) -> None:
+        """Increment a counter. The increment is written to the calling thread's shard."""
         # TODO: validate
-        self.incr_queue.put_nowait(entry)
+        # Looked up by audience object rather than by series key, which takes several times
+        # longer to build. Entries are cached with their audience, so its id() isn't reused.
+        key = (entry.name, id(entry.aud), tuple(entry.labels.items()))
+
+        cached = self.entries.get(key)
+        if cached is None:
+            cached = self._cache_entry(key, entry)
+
+        cached[1].add(entry.value)
+
+    def _cache_entry(self, key: tuple, entry: CounterEntry) -> tuple:
+        """Resolve the handle of an incr() key and cache it"""
+        # Handles of series over max_series are cached too, they resolve once there is room
+        cached = (entry.aud, self.counter(entry.name, entry.labels, entry.aud))
+
+        with self.lock:
+            # Callers building a new audience for every increment would fill the cache
+            if len(self.entries) >= self.max_series:
+                self.entries.clear()
+            self.entries[key] = cached
 
-    def shutdown(self, *args) -> None:
-        """Shutdown the metrics service, pushing all in-memory data before we allow exit"""
+        return cached
+
+    def _new_shard(self) -> CounterShard:
+        shard = CounterShard()
+        self.shard.shard = shard
+
+        with self.lock:
+            self.shards.append(shard)
+
+        return shard
+
+    def merge(self) -> None:
+        """Add the increments written to each thread's shard since the last merge to the counters"""
+        with self.lock:
+            shards = list(self.shards)
+
+        for shard in shards:
+            # Shards of threads that have exited can't receive increments anymore, so they
+            # are dropped once their remaining increments are merged. Retired shards are kept
+            # for one more merge, for increments their thread was making when they were retired.
+            alive = shard.thread.is_alive()
+            if shard.retired:
+                shard.retired += 1
+
+            for handle, value in shard.collect():
+                with self.lock:
+                    id = self.counters.add(handle)
+                    self._touch(handle.key, id)
+                    self.counters.values[id] += value
+                    self.counters.totals[id] += value
+
+            if not alive or shard.retired > 2:
+                with self.lock:
+                    for histogram, part in shard.histograms.items():
+                        histogram.retire(part)
+                    self.shards.remove(shard)
+
+    def shutdown(self, timeout: float = None) -> None:
+        """
+        Shutdown the metrics service, publishing all counters in a single MetricsRequest.
+        Waits at most timeout seconds for the workers and the request, or indefinitely if None.
+        """
         self.log.debug("Shutting down metrics service")
-        # TODO: flush before we exit the metrics service
+        deadline = None if timeout is None else time.monotonic() + timeout
         self.exit.set()
 
         for worker in self.workers:
             self.log.debug("Waiting for worker {} to exit".format(worker.name))
             try:
                 if worker.is_alive():
-                    worker.join()
+                    worker.join(common.time_left(deadline))
             except RuntimeError as e:
                 self.log.error("Could not exit worker {}".format(worker.name))
                 continue
 
-    def publish_metrics(self, entry: CounterEntry) -> None:
-        async def call(request: protos.MetricsRequest):
+            if worker.is_alive():
+                self.log.warning(f"Metrics worker {worker.name} did not exit in time")
+
+        # Publish everything counted since the last flush
+        try:
+            self.drain(self.take_counters(), common.time_left(deadline))
+        except Exception as e:
+            self.log.warning(f"Failed to publish metrics before shutdown: {e}")
+
+    def drain(self, batch: list, timeout: float = None) -> None:
+        """
+        Send a batch and wait for it and any requests scheduled by flush() to complete,
+        raising TimeoutError if that takes longer than timeout seconds
+        """
+
+        # Requests scheduled by flush() that haven't completed yet. Other calls share the
+        # loop, so only these are waited for.
+        pending = list(self.requests)
+
+        async def call():
+            if len(batch) > 0:
+                await self.send_metrics(batch)
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in pending))
+
+        if self.loop.is_running():
+            # The loop is being run by another thread, which will send the request
+            future = asyncio.run_coroutine_threadsafe(call(), self.loop)
             try:
-                await self.stub.metrics(
-                    request, metadata={"auth-token": self.auth_token}
-                )
-            except Exception as e:
-                self.log.warning("Failed to publish metrics")
+                future.result(timeout)
+            except BaseException:
+                future.cancel()
+                raise
+        else:
+            self.loop.run_until_complete(asyncio.wait_for(call(), timeout))
+
+    def publish_metrics(self, batch: list) -> None:
+        """Schedule sending (handle, value) pairs in a single MetricsRequest"""
+        if self.loop.is_running():
+            # The loop is being run by another thread, a concurrent future tracks the request
+            task = asyncio.run_coroutine_threadsafe(self.send_metrics(batch), self.loop)
+        else:
+            task = self.loop.create_task(self.send_metrics(batch))
+        self.requests.add(task)
+        task.add_done_callback(self.requests.discard)
+
+    def reject(self, batch: list, reason: str) -> None:
+        """Hold on to or drop (handle, value) pairs that can't be sent, per drop_policy"""
+        if self.drop_policy == DROP_POLICY_DROP:
+            self.dropped(reason).add(len(batch))
+            return
 
+        for handle, value in batch:
+            self.restore_counter(handle, value)
+
+    async def send_metrics(self, batch: list) -> None:
+        """
+        Send (handle, value) pairs in a single MetricsRequest. If sending fails, the values
+        are held for the next flush or dropped, depending on drop_policy.
+        """
         req = protos.MetricsRequest()
         req.metrics = [
             protos.Metric(
-                name=entry.name,
-                value=entry.value,
-                labels=entry.labels,
-                audience=entry.aud,
+                name=handle.entry.name,
+                value=value,
+                labels=handle.entry.labels,
+                audience=handle.entry.aud,
             )
+            for handle, value in batch
         ]
 
-        self.loop.create_task(call(req))
+        try:
+            await self.stub.metrics(req, metadata={"auth-token": self.auth_token})
+        except Exception as e:
+            self.log.warning(f"Failed to publish {len(batch)} metrics: {e}")
+            self.reject(batch, DROP_REASON_PUBLISH_FAILED)
 
-    def run_publisher_worker(self, id: int) -> None:
-        """Counter worker pool is responsible for listening to incr() requests and publish queue"""
-        self.log.debug("Starting counter worker {}".format(id))
-        while not self.exit.is_set():
-            self.exit.wait(1)
+    def restore_counter(self, handle: CounterHandle, value: float) -> None:
+        """Add an unpublished value back to a counter, even if it was reaped in the meantime"""
+        with self.lock:
+            id = self.counters.add(handle)
+            self._touch(handle.key, id)
+            self.counters.values[id] += value
 
-            # Get entry from the queue. This is blocking to avoid having to handle queue.Empty exceptions
-            try:
-                entry = self.publish_queue.get(block=False)
-            except Empty:
+    def take_counters(self) -> list:
+        """Merge all shards and return (handle, value) for each non-zero counter, resetting them"""
+        self.add_histogram_totals()
+        self.merge()
+
+        batch = []
+
+        with self.lock:
+            values = self.counters.values
+            handles = self.counters.handles
+
+            for id, value in enumerate(values):
+                # We don't need to publish empty counters
+                # run_reaper() will clean these up if they remain zero for a while
+                if value == 0:
+                    continue
+
+                values[id] = 0.0
+                batch.append((handles[id], value))
+
+        return batch
+
+    def flush(self) -> int:
+        """
+        Publish the values of all non-zero counters and reset them, using one MetricsRequest
+        per max_batch_size counters. Returns the number of requests sent.
+
+        No more than max_pending requests are in flight at once, values that would need
+        another request are held or dropped depending on drop_policy.
+        """
+        batch = self.take_counters()
+        requests = 0
+
+        for i in range(0, len(batch), self.max_batch_size):
+            chunk = batch[i : i + self.max_batch_size]
+            if len(self.requests) >= self.max_pending:
+                self.reject(chunk, DROP_REASON_MAX_PENDING)
                 continue
 
-            try:
-                self.publish_metrics(entry)
-            except Exception as e:
-                self.log.error("Failed to publish metrics: {}".format(e))
+            self.publish_metrics(chunk)
+            requests += 1
+
+        return requests
+
+    def add_histogram_totals(self) -> None:
+        """Add the samples recorded since the last flush to the _count and _sum counters of each histogram"""
+        with self.lock:
+            histograms = list(self.histograms.values())
+
+        for histogram in histograms:
+            (count, total) = histogram.totals()
+            if count == histogram.published_count:
+                continue
+
+            histogram.count_handle.add(count - histogram.published_count)
+            histogram.sum_handle.add(total - histogram.published_sum)
+            histogram.published_count = count
+            histogram.published_sum = total
+            histogram.generation = self.generation
 
-        self.log.debug("Exiting counter worker {}".format(id))
+    def remove_handles(self, keys: list) -> None:
+        """Drop cached handles of the given counters"""
+        with self.lock:
+            for key in keys:
+                self.handles.pop(key, None)
+                self.exempt.pop(key, None)
 
-    def remove_counter(self, id: str) -> None:
+            # Rebuilt by incr() as it is called, rather than searched for the removed handles
+            if keys:
+                self.entries.clear()
+
+    def remove_counter(self, id: tuple) -> None:
         """Remove a counter from the internal map"""
         self.lock.acquire(blocking=True)
-        del self.counters[id]
+        series = self.counters.remove(id)
+        bucket = self.buckets.get(self.counters.generations[series])
+        if bucket is not None:
+            bucket.discard(id)
         self.lock.release()
 
-    def run_publisher(self) -> None:
+    def expire(self) -> list:
         """
-        Counter ticker is a background task that reads values from counters,
-        adds them to the publish queue, and then resets the counter's value to zero.
+        Start a new generation and remove the counters that haven't been incremented for
+        COUNTER_TTL_GENERATIONS generations, unless they hold values that are yet to be
+        published. Only the bucket of the expiring generation is visited, so the cost depends
+        on the number of idle counters rather than on the number of counters. Histograms that
+        haven't recorded samples for as long are removed too.
+
+        Returns the keys of the removed counters.
         """
-        self.log.debug("Starting publisher")
-        while not self.exit.is_set():
-            self.lock.acquire(blocking=True)
-            counters = list(self.counters.values())
-            self.lock.release()
+        removed = []
 
-            for counter in counters:
-                # We don't need to publish empty counters
-                # run_reaper() will clean these up if they remain zero for a while
-                if counter.val() == 0:
+        with self.lock:
+            self.generation += 1
+            expiring = self.buckets.pop(
+                self.generation - 1 - COUNTER_TTL_GENERATIONS, ()
+            )
+
+            for key in expiring:
+                id = self.counters.index.get(key)
+                if id is None:
+                    continue
+
+                if self.counters.values[id] != 0:
+                    # Held after a failed or rejected publish, keep it until it's sent
+                    self._touch(key, id)
                     continue
 
-                # Ensure a fresh copy of the CounterEntry
-                entry = deepcopy(counter.entry)
-                entry.value = counter.val()
+                self.counters.remove(key)
+                removed.append(key)
+
+            # Histograms are far fewer than counters, so they are all visited
+            oldest = self.generation - 1 - COUNTER_TTL_GENERATIONS
+            idle = [k for k, h in self.histograms.items() if h.generation <= oldest]
+            for key in idle:
+                del self.histograms[key]
+
+            if removed or idle:
+                # Threads move on to new shards, so the removed counters' totals and the
+                # removed histograms' parts are let go
+                for shard in self.shards:
+                    if not shard.retired:
+                        shard.retired = 1
+
+        # Handles still held by callers keep working, their counter is recreated on use
+        self.remove_handles(removed)
 
-                # Reset counter's value to 0
-                counter.reset()
+        return removed
 
-                # Put in the publish queue for a publisher worker to pick up
-                self.publish_queue.put_nowait(entry)
+    def run_publisher(self) -> None:
+        """
+        Counter publisher is a background task that publishes the values of all counters
+        every flush_interval seconds, and then resets the counters' values to zero.
+        """
+        self.log.debug("Starting publisher")
+        while not self.exit.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                self.log.error("Failed to publish metrics: {}".format(e))
 
-            self.exit.wait(1)
+            self.exit.wait(self.flush_interval)
 
         self.log.debug("Exiting publisher")
 
@@ -262,44 +1085,7 @@ class Metrics:
             # Sleep on startup and then and between each loop run
             self.exit.wait(DEFAULT_COUNTER_REAPER_INTERVAL)
 
-            # Get all counters
-            # Loop over each counter, get the value,
-            #   if value > 0, continue
-            #   if now() - last_updated > 10 seconds, remove counter
-            self.lock.acquire(blocking=True)
-            items = self.counters.copy()
-            self.lock.release()
-
-            for name in items:
-                counter = items[name]
-                if counter.val() > 0:
-                    continue
-
-                if (datetime.utcnow() - counter.last_updated).total_seconds() > 10:
-                    self.remove_counter(name)
-
-                    self.log.debug("reaped stale counter '{}'".format(name))
+            for key in self.expire():
+                self.log.debug("reaped stale counter '{}'".format(key))
 
         self.log.debug("Exiting reaper")
-
-    def run_incrementer_worker(self, id: int) -> None:
-        """
-        Incrementer is a background task that listens to incr() requests sent to incr_queue and increments counters
-        """
-        self.log.debug("Starting incrementer {}".format(id))
-
-        while not self.exit.is_set():
-            try:
-                entry = self.incr_queue.get(block=False)
-            except Empty:
-                self.exit.wait(1)
-                continue
-
-            counter = self.get_counter(entry)
-            if counter is None:
-                counter = self.new_counter(entry)
-                counter.incr(entry.value)
-            else:
-                counter.incr(entry.value)
-
-        self.log.info("Exiting incrementer {}".format(id))
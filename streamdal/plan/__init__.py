@@ -0,0 +1,320 @@
+"""
+This module contains the execution plans that pipelines are compiled into when they are set,
+so that process() only has to touch precomputed state for each payload.
+"""
+
+import streamdal.metrics as metrics
+import streamdal.wasm as wasm
+import streamdal_protos.protos as protos
+from betterproto import which_one_of
+from copy import copy
+from dataclasses import dataclass, field
+from streamdal.metrics import CounterHandle, Histogram
+from threading import Event
+
+
+@dataclass(frozen=True)
+class CounterNames:
+    """Names of the counters incremented by process() for an operation type"""
+
+    bytes: str
+    errors: str
+    timeouts: str
+    processed: str
+    rate_bytes: str
+    rate_processed: str
+
+
+CONSUMER_COUNTERS = CounterNames(
+    bytes=metrics.COUNTER_CONSUME_BYTES,
+    errors=metrics.COUNTER_CONSUME_ERRORS,
+    timeouts=metrics.COUNTER_CONSUME_TIMEOUTS,
+    processed=metrics.COUNTER_CONSUME_PROCESSED,
+    rate_bytes=metrics.COUNTER_CONSUME_BYTES_RATE,
+    rate_processed=metrics.COUNTER_CONSUME_PROCESSED_RATE,
+)
+
+PRODUCER_COUNTERS = CounterNames(
+    bytes=metrics.COUNTER_PRODUCE_BYTES,
+    errors=metrics.COUNTER_PRODUCE_ERRORS,
+    timeouts=metrics.COUNTER_PRODUCE_TIMEOUTS,
+    processed=metrics.COUNTER_PRODUCE_PROCESSED,
+    rate_bytes=metrics.COUNTER_PRODUCE_BYTES_RATE,
+    rate_processed=metrics.COUNTER_PRODUCE_PROCESSED_RATE,
+)
+
+
+def counter_names(operation_type: int) -> CounterNames:
+    """Return the counters used for the given operation type"""
+    if operation_type == protos.OperationType.OPERATION_TYPE_PRODUCER:
+        return PRODUCER_COUNTERS
+
+    return CONSUMER_COUNTERS
+
+
+@dataclass(frozen=True)
+class Route:
+    """
+    Audience of an (operation_type, operation_name, component_name) triple, built once so that
+    process() doesn't allocate an Audience or serialize it to a key for every payload
+    """
+
+    aud: protos.Audience
+    key: str
+
+
+@dataclass(frozen=True)
+class ConditionPlan:
+    """Decoded on_true/on_false/on_error condition of a step"""
+
+    abort: protos.AbortCondition
+    notify: bool
+    metadata: dict
+    abort_current: bool
+    abort_all: bool
+
+
+@dataclass
+class StepPlan:
+    """
+    Compiled pipeline step. Everything except the function handle is fixed at compile time;
+    the handle is resolved on first use and then reused for every payload.
+
+    step does not carry the wasm module; it is registered with wasm.modules and referred to
+    by module_key, which is None for steps without a module. duration is shared by the steps
+    of an audience with the same step type and set by compile_pipeline().
+    """
+
+    step: protos.PipelineStep
+    name: str
+    step_type: str
+    wasm_id: str
+    wasm_function: str
+    module_key: str
+    infer_schema: bool
+    timeout_exempt: bool
+    request_step_field: bytes
+    on_true: ConditionPlan
+    on_false: ConditionPlan
+    on_error: ConditionPlan
+    duration: Histogram = None
+    function: object = None
+
+
+@dataclass(frozen=True)
+class PipelinePlan:
+    """Compiled pipeline with prebuilt labels, counter handles and duration histogram"""
+
+    pipeline: protos.Pipeline
+    id: str
+    name: str
+    steps: tuple
+    aud: protos.Audience
+    labels: dict
+    counters: CounterNames
+    processed: CounterHandle
+    bytes: CounterHandle
+    errors: CounterHandle
+    timeouts: CounterHandle
+    recycles: CounterHandle
+    notify: CounterHandle
+    duration: Histogram
+
+
+@dataclass(frozen=True)
+class AudiencePlan:
+    """
+    All compiled pipelines for an audience, in execution order. ready is set once the
+    modules used by its steps have been compiled and instantiated. module_keys has the hash
+    of each module registration made while compiling, to release once the plan is replaced.
+    """
+
+    aud: protos.Audience
+    pipelines: tuple
+    rate_bytes: CounterHandle
+    rate_processed: CounterHandle
+    duration: Histogram
+    module_keys: tuple = ()
+    ready: Event = field(default_factory=Event, compare=False, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.pipelines)
+
+    def __iter__(self):
+        return iter(self.pipelines)
+
+    def wasm_ids(self) -> list:
+        """Return the distinct wasm_ids used by the plan's steps"""
+        ids = []
+        for pipeline in self.pipelines:
+            for step in pipeline.steps:
+                if step.wasm_id and step.wasm_id not in ids:
+                    ids.append(step.wasm_id)
+
+        return ids
+
+    def wasm_steps(self) -> list:
+        """Return one step per distinct wasm module used by the plan"""
+        steps = {}
+        for pipeline in self.pipelines:
+            for step in pipeline.steps:
+                if step.module_key is not None and step.wasm_id not in steps:
+                    steps[step.wasm_id] = step
+
+        return list(steps.values())
+
+
+def compile_condition(cond: protos.PipelineStepConditions) -> ConditionPlan:
+    if cond is None:
+        cond = protos.PipelineStepConditions()
+
+    return ConditionPlan(
+        abort=cond.abort,
+        notify=cond.notify,
+        metadata=dict(cond.metadata),
+        abort_current=cond.abort == protos.AbortCondition.ABORT_CONDITION_ABORT_CURRENT,
+        abort_all=cond.abort == protos.AbortCondition.ABORT_CONDITION_ABORT_ALL,
+    )
+
+
+def register_module(wasm_bytes: bytes, keys: dict = None, wasm_id: str = None) -> str:
+    """
+    Register module bytes with the shared module registry and return their hash. keys maps
+    id() of bytes objects to their hash, so steps sharing a bytes object only hash it once.
+    """
+    if not wasm_bytes:
+        return None
+
+    if keys is None:
+        return wasm.modules.register(wasm_bytes, wasm_id=wasm_id)
+
+    key = keys.get(id(wasm_bytes))
+    if key is None:
+        key = wasm.modules.register(wasm_bytes, wasm_id=wasm_id)
+        keys[id(wasm_bytes)] = key
+
+    return key
+
+
+def compile_step(step: protos.PipelineStep, keys: dict = None) -> StepPlan:
+    (step_type, _) = which_one_of(step, "step")
+
+    module_key = register_module(step.wasm_bytes, keys, step.wasm_id)
+
+    # The step as sent to the wasm module, without the module itself
+    request_step = copy(step)
+    request_step.wasm_bytes = None
+
+    return StepPlan(
+        step=request_step,
+        name=step.name,
+        step_type=step_type,
+        wasm_id=step.wasm_id,
+        wasm_function=step.wasm_function,
+        module_key=module_key,
+        infer_schema=step_type == "infer_schema",
+        # HTTP requests wait on the network rather than compute, so step and
+        # pipeline timeouts would interrupt them while they wait for a response
+        timeout_exempt=step_type == "http_request",
+        request_step_field=wasm.encode_step(bytes(request_step)),
+        on_true=compile_condition(step.on_true),
+        on_false=compile_condition(step.on_false),
+        on_error=compile_condition(step.on_error),
+    )
+
+
+def audience_labels(aud: protos.Audience, service_name: str) -> dict:
+    return {
+        "service": service_name,
+        "component": aud.component_name,
+        "operation": aud.operation_name,
+    }
+
+
+def compile_pipeline(
+    pipeline: protos.Pipeline,
+    aud: protos.Audience,
+    service_name: str,
+    counter,
+    histogram,
+    keys: dict = None,
+) -> PipelinePlan:
+    """
+    Compile a pipeline. counter(name, labels, aud) and histogram(name, labels, aud) return
+    the handle of a counter and a histogram, usually Metrics.counter and Metrics.histogram.
+    """
+    counters = counter_names(aud.operation_type)
+    steps = tuple(compile_step(step, keys) for step in pipeline.steps)
+
+    for step in steps:
+        step.duration = histogram(
+            metrics.HISTOGRAM_STEP_SECONDS,
+            {**audience_labels(aud, service_name), "step_type": step.step_type},
+            aud,
+        )
+
+    # Keep the pipeline without the module bytes of its steps
+    pipeline = copy(pipeline)
+    pipeline.steps = [step.step for step in steps]
+
+    labels = {
+        **audience_labels(aud, service_name),
+        "pipeline_name": pipeline.name,
+        "pipeline_id": pipeline.id,
+    }
+
+    return PipelinePlan(
+        pipeline=pipeline,
+        id=pipeline.id,
+        name=pipeline.name,
+        steps=steps,
+        aud=aud,
+        labels=labels,
+        counters=counters,
+        processed=counter(counters.processed, labels, aud),
+        bytes=counter(counters.bytes, labels, aud),
+        errors=counter(counters.errors, labels, aud),
+        timeouts=counter(counters.timeouts, labels, aud),
+        recycles=counter(metrics.COUNTER_WASM_RECYCLES, labels, aud),
+        notify=counter(
+            metrics.COUNTER_NOTIFY,
+            {
+                "service": service_name,
+                "component_name": aud.component_name,
+                "pipeline_name": pipeline.name,
+                "pipeline_id": pipeline.id,
+                "operation_name": aud.operation_name,
+            },
+            aud,
+        ),
+        duration=histogram(metrics.HISTOGRAM_PIPELINE_SECONDS, labels, aud),
+    )
+
+
+def compile_pipelines(
+    cmd: protos.Command, service_name: str, counter, histogram
+) -> AudiencePlan:
+    """
+    Compile the pipelines of a SetPipelinesCommand into an AudiencePlan. counter and histogram
+    are passed on to compile_pipeline().
+    """
+    aud = cmd.audience
+    counters = counter_names(aud.operation_type)
+    keys = {}
+    pipelines = tuple(
+        compile_pipeline(pipeline, aud, service_name, counter, histogram, keys)
+        for pipeline in cmd.set_pipelines.pipelines
+    )
+
+    return AudiencePlan(
+        aud=aud,
+        pipelines=pipelines,
+        rate_bytes=counter(counters.rate_bytes, {}, aud),
+        rate_processed=counter(counters.rate_processed, {}, aud),
+        duration=histogram(
+            metrics.HISTOGRAM_PROCESS_SECONDS,
+            audience_labels(aud, service_name),
+            aud,
+        ),
+        module_keys=tuple(keys.values()),
+    )
@@ -0,0 +1,399 @@
+"""
+This module contains an opt-in backend that executes wasm steps in a pool of worker processes,
+so that pipelines can use more than one CPU core. Each worker holds its own compiled modules
+and a mirror of the KV store, and payloads travel through a shared memory slot per worker
+instead of being pickled.
+"""
+
+import logging
+import multiprocessing
+import os
+import streamdal.common as common
+import streamdal.wasm as wasm
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+
+DEFAULT_PROCESS_POOL_SIZE = os.cpu_count() or 4
+DEFAULT_SLOT_SIZE = 4 * 1024 * 1024  # 4 megabytes, fits a max size payload
+DEFAULT_WORKER_START_TIMEOUT = 30  # 30 seconds
+
+# Messages sent to workers
+OP_EXEC = "exec"
+OP_LOAD = "load"
+OP_UNLOAD = "unload"
+OP_KV_SET = "kv_set"
+OP_KV_DELETE = "kv_delete"
+OP_KV_PURGE = "kv_purge"
+OP_STOP = "stop"
+
+# Replies sent by workers. OP_READY is sent once a worker has started up. OP_RESULT means the response was written to the shared memory
+# slot, OP_RESULT_INLINE means it did not fit and is carried in the message itself.
+OP_READY = "ready"
+OP_RESULT = "result"
+OP_RESULT_INLINE = "result_inline"
+OP_ERROR = "error"
+
+
+def _worker_main(conn, shm_name: str, cache_dir: str, kv_items: list) -> None:
+    """Entrypoint of a worker process. Serves requests from the parent until told to stop."""
+    import streamdal.hostfunc as hostfunc
+    from streamdal.kv import KV
+
+    shm = SharedMemory(name=shm_name)
+
+    if cache_dir != "":
+        wasm.modules.disk = wasm.DiskCache(cache_dir)
+
+    kv = KV()
+    for key, value in kv_items:
+        kv.set(key, value)
+
+    linker = wasm.new_linker(hostfunc.HostFunc(kv=kv))
+    modules = {}
+    instances = {}
+
+    conn.send((OP_READY,))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+
+        op = msg[0]
+
+        if op == OP_EXEC:
+            (_, key, function, length, data, wasm_bytes, timeout) = msg
+            try:
+                if wasm_bytes is not None:
+                    modules[key] = wasm.modules.get(wasm_bytes)
+
+                inst = instances.get(key)
+                if inst is None:
+                    if key not in modules:
+                        raise common.StreamdalException(f"module '{key}' is not loaded")
+
+                    inst = wasm.new_instance(linker, modules[key])
+                    instances[key] = inst
+
+                # Requests in the slot are copied straight from shared memory into wasm memory
+                if data is None:
+                    data = shm.buf[:length]
+
+                res = wasm.call(inst, function, data, timeout)
+
+                if len(res) <= shm.size:
+                    shm.buf[: len(res)] = res
+                    conn.send((OP_RESULT, len(res)))
+                else:
+                    conn.send((OP_RESULT_INLINE, res))
+            except Exception as e:
+                # A failed call can leave the instance in an inconsistent state
+                instances.pop(key, None)
+                conn.send((OP_ERROR, str(e), isinstance(e, common.TimeoutException)))
+            finally:
+                # Release the view of the slot, shared memory can't be closed while one exists
+                data = None
+        elif op == OP_LOAD:
+            (_, key, wasm_bytes) = msg
+            try:
+                if key not in modules:
+                    modules[key] = wasm.modules.get(wasm_bytes)
+                if key not in instances:
+                    instances[key] = wasm.new_instance(linker, modules[key])
+            except Exception:
+                # Reported by the first OP_EXEC for the module instead
+                pass
+        elif op == OP_UNLOAD:
+            modules.pop(msg[1], None)
+            instances.pop(msg[1], None)
+        elif op == OP_KV_SET:
+            kv.set(msg[1], msg[2])
+        elif op == OP_KV_DELETE:
+            kv.delete(msg[1])
+        elif op == OP_KV_PURGE:
+            kv.purge()
+        elif op == OP_STOP:
+            break
+
+    shm.close()
+
+
+class Worker:
+    """Worker is the parent's handle on a single worker process"""
+
+    process: multiprocessing.Process
+    shm: SharedMemory
+    loaded: set
+    ready: bool
+    lock: Lock
+
+    def __init__(self, ctx, slot_size: int, cache_dir: str, kv_items: list):
+        self.shm = SharedMemory(create=True, size=slot_size)
+        (self.conn, child_conn) = ctx.Pipe()
+        self.loaded = set()
+        self.ready = False
+
+        # Serializes writes to the pipe between the thread using this worker and KV broadcasts
+        self.lock = Lock()
+
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.shm.name, cache_dir, kv_items),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout: float = DEFAULT_WORKER_START_TIMEOUT) -> None:
+        """Wait for the worker process to finish starting up"""
+        if self.ready:
+            return
+
+        if not self.conn.poll(timeout):
+            raise common.StreamdalException(
+                "timed out waiting for wasm worker to start"
+            )
+
+        msg = self.conn.recv()
+        if msg[0] != OP_READY:
+            raise common.StreamdalException(
+                f"unexpected message from wasm worker: {msg[0]}"
+            )
+
+        self.ready = True
+
+    def send(self, msg: tuple) -> None:
+        with self.lock:
+            self.conn.send(msg)
+
+    def close(self) -> None:
+        try:
+            self.send((OP_STOP,))
+        except Exception:
+            pass
+
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+
+        self.conn.close()
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ProcessPool:
+    """
+    ProcessPool executes encoded WasmRequests in worker processes. Callers check a worker out
+    for the duration of a single step, so up to `size` steps run on separate cores at once.
+    """
+
+    size: int
+    workers: list
+    modules: dict
+    log: logging.Logger
+
+    def __init__(self, size: int = DEFAULT_PROCESS_POOL_SIZE, **kwargs):
+        self.size = int(size)
+        self.slot_size = int(kwargs.get("slot_size", DEFAULT_SLOT_SIZE))
+        self.cache_dir = kwargs.get("cache_dir", "")
+        self.kv = kwargs.get("kv")
+        self.log = kwargs.get("log", logging.getLogger("streamdal-python-sdk"))
+
+        # Workers are spawned rather than forked, the parent has gRPC and metrics threads running
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers = []
+        self.modules = {}
+        self.lock = Lock()
+        self.pool = wasm.InstancePool(self._start_worker, self.size)
+
+        # Start all workers up front so the first steps don't pay for process startup.
+        # They are all spawned before waiting on any of them, so they start in parallel.
+        started = [self.pool.checkout() for _ in range(self.size)]
+        for worker in started:
+            self.pool.checkin(worker)
+
+        try:
+            for worker in started:
+                worker.wait_ready()
+        except Exception:
+            self.shutdown()
+            raise
+
+    def _start_worker(self) -> Worker:
+        # Snapshot the KV store and register the worker under the same lock that KV
+        # broadcasts take, so the worker can't miss an update made while it starts
+        with self.lock:
+            kv_items = []
+            if self.kv is not None:
+                kv_items = [(k, self.kv.get(k)[0]) for k in list(self.kv.keys())]
+
+            worker = Worker(self.ctx, self.slot_size, self.cache_dir, kv_items)
+            self.workers.append(worker)
+
+        return worker
+
+    def _stop_worker(self, worker: Worker) -> None:
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+        worker.close()
+
+    def register(self, wasm_id: str, wasm_bytes: bytes, key: str = None) -> None:
+        """Remember the module bytes for a wasm_id so that workers can load it on first use"""
+        if wasm_id in self.modules:
+            return
+
+        if not wasm_bytes:
+            raise common.StreamdalException(f"wasm module '{wasm_id}' has no bytes")
+
+        if key is None:
+            key = wasm.module_hash(wasm_bytes)
+
+        self.modules[wasm_id] = (key, wasm_bytes)
+
+    def unregister(self, wasm_id: str) -> None:
+        """
+        Forget the module bytes of a wasm_id no pipeline uses anymore. Workers drop the module
+        too, unless another registered wasm_id has the same bytes.
+        """
+        with self.lock:
+            module = self.modules.pop(wasm_id, None)
+            if module is None:
+                return
+
+            key = module[0]
+            if any(k == key for (k, _) in self.modules.values()):
+                return
+
+            workers = [w for w in self.workers if key in w.loaded]
+            for worker in workers:
+                worker.loaded.discard(key)
+
+        for worker in workers:
+            try:
+                worker.send((OP_UNLOAD, key))
+            except Exception as e:
+                self.log.debug(f"Failed to unload module from wasm worker: {e}")
+
+    def load(self, wasm_id: str) -> None:
+        """
+        Have all workers compile and instantiate a registered module ahead of its first use.
+        Workers load it in the background; requests sent afterwards are served once it is loaded.
+        """
+        module = self.modules.get(wasm_id)
+        if module is None:
+            raise common.StreamdalException(
+                f"wasm module '{wasm_id}' is not registered"
+            )
+
+        (key, wasm_bytes) = module
+
+        with self.lock:
+            workers = [w for w in self.workers if key not in w.loaded]
+            for worker in workers:
+                worker.loaded.add(key)
+
+        for worker in workers:
+            try:
+                worker.send((OP_LOAD, key, wasm_bytes))
+            except Exception as e:
+                worker.loaded.discard(key)
+                self.log.debug(f"Failed to send module to wasm worker: {e}")
+
+    def execute(
+        self, wasm_id: str, function: str, data: bytes, timeout: float = None
+    ) -> bytes:
+        """
+        Run an exported function of a registered module in a worker process. Raises
+        TimeoutException if it runs for longer than timeout seconds.
+        """
+        module = self.modules.get(wasm_id)
+        if module is None:
+            raise common.StreamdalException(
+                f"wasm module '{wasm_id}' is not registered"
+            )
+
+        (key, wasm_bytes) = module
+
+        worker = self.pool.checkout()
+        try:
+            # Workers that replaced a failed one may still be starting up
+            worker.wait_ready()
+
+            # Only ship the module bytes the first time this worker sees the module
+            send_bytes = None if key in worker.loaded else wasm_bytes
+
+            if len(data) <= self.slot_size:
+                worker.shm.buf[: len(data)] = data
+                worker.send(
+                    (OP_EXEC, key, function, len(data), None, send_bytes, timeout)
+                )
+            else:
+                worker.send(
+                    (OP_EXEC, key, function, len(data), data, send_bytes, timeout)
+                )
+
+            reply = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # Worker died, replace it on the next checkout
+            self.pool.discard(worker)
+            self._stop_worker(worker)
+            raise common.StreamdalException(f"wasm worker process failed: {e}")
+        except BaseException:
+            # The reply for this request may still arrive, so the worker can't be reused
+            self.pool.discard(worker)
+            self._stop_worker(worker)
+            raise
+
+        try:
+            if reply[0] == OP_ERROR:
+                # Send the module bytes again next time in case loading it failed
+                worker.loaded.discard(key)
+                if reply[2]:
+                    raise common.TimeoutException(reply[1])
+                raise common.StreamdalException(reply[1])
+
+            worker.loaded.add(key)
+
+            if reply[0] == OP_RESULT_INLINE:
+                return reply[1]
+
+            return bytes(worker.shm.buf[: reply[1]])
+        finally:
+            self.pool.checkin(worker)
+
+    def kv_set(self, key: str, value) -> None:
+        """Mirror a KV set to all workers"""
+        self._broadcast((OP_KV_SET, key, value))
+
+    def kv_delete(self, key: str) -> None:
+        """Mirror a KV delete to all workers"""
+        self._broadcast((OP_KV_DELETE, key))
+
+    def kv_purge(self) -> None:
+        """Mirror a KV purge to all workers"""
+        self._broadcast((OP_KV_PURGE,))
+
+    def _broadcast(self, msg: tuple) -> None:
+        with self.lock:
+            workers = list(self.workers)
+
+        for worker in workers:
+            try:
+                worker.send(msg)
+            except Exception as e:
+                self.log.debug(f"Failed to send '{msg[0]}' to wasm worker: {e}")
+
+    def shutdown(self) -> None:
+        """Stop all worker processes and release their shared memory"""
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+
+        for worker in workers:
+            worker.close()
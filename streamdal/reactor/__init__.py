@@ -0,0 +1,107 @@
+"""
+This module contains the I/O reactor of the client: a single thread running an event loop with
+one gRPC channel to the Streamdal server. Every call the client makes, including the register
+and tail streams, is multiplexed over that channel's HTTP/2 connection, and is submitted from
+whichever thread needs it through a thread-safe future.
+"""
+
+import asyncio
+import logging
+import streamdal_protos.protos as protos
+from concurrent.futures import Future
+from grpclib.client import Channel
+from threading import Lock, Thread
+
+
+class Reactor:
+    """
+    Class Reactor runs an event loop in a dedicated thread, along with the gRPC channel and stub
+    all calls to the Streamdal server share. Coroutines are submitted to it from any thread.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    channel: Channel
+    stub: protos.InternalStub
+    thread: Thread
+    log: logging.Logger
+    stopped: bool
+    lock: Lock
+
+    def __init__(self, host: str, port: int, log: logging.Logger = None):
+        self.log = log or logging.getLogger("streamdal-client")
+        self.loop = asyncio.new_event_loop()
+
+        # The channel connects on the first call and reconnects after losing its connection
+        self.channel = Channel(host=host, port=port, loop=self.loop)
+        self.stub = protos.InternalStub(channel=self.channel)
+        self.thread = Thread(target=self.run, name="streamdal-io", daemon=True)
+
+        # Guards stopped, so that nothing is scheduled on the loop once stop() has been called
+        self.stopped = False
+        self.lock = Lock()
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def run(self) -> None:
+        """Run the event loop until stop() is called, then cancel whatever is still running"""
+        asyncio.set_event_loop(self.loop)
+        self.log.debug("Starting I/O reactor")
+
+        try:
+            self.loop.run_forever()
+
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True)
+            )
+        finally:
+            # Closing the channel schedules closing its transport, which needs one more run
+            self.channel.close()
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+        self.log.debug("Exiting I/O reactor")
+
+    def submit(self, coro) -> Future:
+        """
+        Schedule a coroutine on the reactor's loop, returning a future of its result. Once the
+        reactor is stopped the coroutine is closed without running and the future is cancelled.
+        """
+        with self.lock:
+            if not self.stopped:
+                return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        coro.close()
+        future = Future()
+        future.cancel()
+        return future
+
+    def call(self, coro, timeout: float = None):
+        """
+        Run a coroutine on the reactor's loop and wait for its result, raising TimeoutError
+        and cancelling it if that takes longer than timeout seconds
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self, timeout: float = None) -> None:
+        """Stop the loop, cancel its remaining tasks and close the channel"""
+        with self.lock:
+            self.stopped = True
+
+        if not self.thread.is_alive():
+            return
+
+        # Calls submitted before stopped was set are queued ahead of this, and get cancelled
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+        if self.thread.is_alive():
+            self.log.warning("I/O reactor did not exit in time")
@@ -3,21 +3,26 @@ import asyncio
 import streamdal_protos.protos as protos
 import time
 import token_bucket
-from streamdal.metrics import Metrics, CounterEntry, COUNTER_DROPPED_TAIL_MESSAGES
-from grpclib.client import Channel
+from concurrent.futures import Future
+from streamdal.metrics import Metrics, COUNTER_DROPPED_TAIL_MESSAGES
+from streamdal.reactor import Reactor
 from grpclib.exceptions import ProtocolError
 from queue import SimpleQueue, Empty
-from threading import Lock, Event, Thread
+from threading import Lock, Event
 
-# The number of tail worker threads to start
-NUM_TAIL_WORKERS = 2
 MIN_TAIL_RESPONSE_INTERVAL = 10_000_000  # 10ms
+TAIL_POLL_INTERVAL = 1  # 1 second, how often a waiting stream re-checks its queue
+
+
+def wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
 
 
 class Tail:
     request: protos.TailRequest
     auth_token: str
-    streamdal_url: str
+    reactor: Reactor
     metrics: Metrics
     lock: Lock = Lock()
     exit: Event = Event()
@@ -26,11 +31,15 @@ class Tail:
     log: logging.Logger = logging.getLogger("streamdal-python-sdk")
     active: bool = False
     limiter: token_bucket.Limiter
+    future: Future = None
+
+    # Resolved by put() when the stream is waiting for a message, set on the reactor's loop
+    waiter: asyncio.Future = None
 
     def __init__(
         self,
         request: protos.TailRequest,
-        streamdal_url: str,
+        reactor: Reactor,
         exit: Event,
         auth_token: str,
         log: logging.Logger,
@@ -42,7 +51,7 @@ class Tail:
         self.exit = exit
         self.log = log
         self.auth_token = auth_token
-        self.streamdal_url = streamdal_url
+        self.reactor = reactor
         self.metrics = metrics
         self.active = active
 
@@ -54,51 +63,69 @@ class Tail:
         if request.sample_options is not None:
             pass
 
-    def tail_iterator(self):
-        while not self.exit.is_set():
+    def put(self, msg) -> None:
+        """Queue a message to send, waking the stream if it is waiting. Called from any thread."""
+        self.queue.put_nowait(msg)
+
+        waiter = self.waiter
+        if waiter is not None:
+            self.waiter = None
+            self.reactor.loop.call_soon_threadsafe(wake, waiter)
+
+    async def tail_iterator(self):
+        """
+        Yield the queued messages until the None put by stop(), so that the messages queued
+        before the tail was stopped are still sent
+        """
+        while True:
             try:
-                yield self.queue.get(timeout=1)
+                msg = self.queue.get_nowait()
             except Empty:
-                pass
+                await self.wait()
+                continue
+
+            if msg is None:
+                return
+
+            yield msg
 
             self.last_msg = time.time_ns()
 
-    def start_tail_workers(self):
-        for i in range(NUM_TAIL_WORKERS):
-            incr_worker = Thread(
-                target=self.start_tail_worker, args=(i + 1,), daemon=False
-            )
-            incr_worker.start()
+    async def wait(self) -> None:
+        """Wait for put() to queue a message, without blocking the other calls on the loop"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiter = waiter
 
-        self.active = True
+        # A message queued before the waiter was visible to put() doesn't wake it
+        if not self.queue.empty():
+            self.waiter = None
+            return
 
-    def start_tail_worker(self, worker_id: int):
-        self.log.debug(f"Starting tail worker {worker_id}")
+        await asyncio.wait([waiter], timeout=TAIL_POLL_INTERVAL)
+        self.waiter = None
 
-        # Create gRPC channel and stub
-        (host, port) = self.streamdal_url.split(":")
-        loop = asyncio.new_event_loop()
-        channel = Channel(host=host, port=port, loop=loop)
-        stub = protos.InternalStub(channel=channel)
+    def start(self) -> None:
+        """Start streaming the tail's messages to the server on the reactor"""
+        self.future = self.reactor.submit(self.run())
+        self.active = True
+
+    async def run(self) -> None:
+        self.log.debug(f"Starting tail stream {self.request.id}")
+        dropped = self.metrics.counter(
+            COUNTER_DROPPED_TAIL_MESSAGES, {}, self.request.audience
+        )
 
-        async def call():
+        while not self.exit.is_set():
             try:
                 # If we're sending too fast, drop the message
                 if time.time_ns() - self.last_msg < MIN_TAIL_RESPONSE_INTERVAL:
-                    self.metrics.incr(
-                        CounterEntry(
-                            name=COUNTER_DROPPED_TAIL_MESSAGES,
-                            value=1.0,
-                            labels={},
-                            aud=self.request.audience,
-                        )
-                    )
+                    dropped.add()
 
                     self.log.warning(
                         f"Dropping tail response for {self.request.id}, too fast"
                     )
 
-                await stub.send_tail(
+                await self.reactor.stub.send_tail(
                     tail_response_iterator=self.tail_iterator(),
                     metadata={"auth-token": self.auth_token},
                 )
@@ -109,12 +136,12 @@ class Tail:
             except ProtocolError:
                 pass
 
-        while not self.exit.is_set():
-            loop.run_until_complete(call())
-
-        channel.close()
+        self.log.debug(f"Tail stream {self.request.id} exiting")
 
-        self.log.debug(f"Tail worker {worker_id} exiting")
+    def stop(self) -> None:
+        """Stop the tail's stream, waking it if it is waiting for a message"""
+        self.exit.set()
+        self.put(None)
 
     def should_send(self) -> bool:
         """
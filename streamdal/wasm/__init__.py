@@ -0,0 +1,1089 @@
+"""
+This module contains the wasmtime engine and compiled module cache that are shared by all pipeline steps
+"""
+
+import ctypes
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
+import streamdal.common as common
+import streamdal_protos.protos as protos
+from wasmtime import (
+    Config,
+    Engine,
+    FuncType,
+    Instance,
+    Linker,
+    Module,
+    Store,
+    Trap,
+    TrapCode,
+    ValType,
+    WasiConfig,
+)
+
+DISK_CACHE_FILE_EXT = ".cwasm"
+DEFAULT_DISK_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512 megabytes
+DEFAULT_POOL_SIZE = os.cpu_count() or 4
+DEFAULT_UNUSED_MAX_COUNT = 8
+DEFAULT_UNUSED_MAX_BYTES = 128 * 1024 * 1024  # 128 megabytes
+DEFAULT_INSTANCE_MAX_CALLS = 100000
+DEFAULT_INSTANCE_MAX_MEMORY = 64 * 1024 * 1024  # 64 megabytes
+
+# Options applied to the wasmtime Config of the shared engine. Serialized modules are only
+# compatible with an engine built from the same options, so these are part of the disk cache key.
+# Epoch interruption lets a background thread interrupt wasm that runs past its deadline.
+ENGINE_OPTIONS = {"epoch_interruption": True}
+
+# How often the engine's epoch is advanced, this is the resolution of step timeouts
+EPOCH_TICK_INTERVAL = 1 / 1000  # 1 millisecond
+
+# Deadline used for calls without a timeout. With epoch interruption enabled a Store traps
+# as soon as its deadline is reached, so every call needs one.
+NO_DEADLINE = 1 << 48
+
+_engine = None
+_engine_lock = Lock()
+
+# The epoch only needs to advance while a call with a deadline runs. The ticker thread waits
+# on _ticker_cond while there are none, and exits once stopped with none running.
+_ticker = None
+_ticker_cond = Condition()
+_ticker_calls = 0
+_ticker_stop = False
+
+
+def get_engine() -> Engine:
+    """Return the process-wide wasmtime Engine, creating it on first use"""
+    global _engine
+
+    if _engine is not None:
+        return _engine
+
+    with _engine_lock:
+        if _engine is None:
+            cfg = Config()
+            for name, value in ENGINE_OPTIONS.items():
+                setattr(cfg, name, value)
+
+            _engine = Engine(cfg)
+
+    return _engine
+
+
+def _tick(engine: Engine) -> None:
+    global _ticker
+
+    while True:
+        with _ticker_cond:
+            while _ticker_calls == 0:
+                if _ticker_stop:
+                    _ticker = None
+                    return
+                _ticker_cond.wait()
+
+        time.sleep(EPOCH_TICK_INTERVAL)
+        engine.increment_epoch()
+
+
+@contextmanager
+def epoch_ticking(timeout: float = None):
+    """Keep the shared engine's epoch advancing while a call with a timeout runs"""
+    global _ticker, _ticker_calls, _ticker_stop
+
+    if timeout is None:
+        yield
+        return
+
+    engine = get_engine()
+
+    with _ticker_cond:
+        _ticker_calls += 1
+        if _ticker is None:
+            _ticker_stop = False
+            _ticker = Thread(
+                target=_tick, args=(engine,), name="streamdal-epoch", daemon=True
+            )
+            _ticker.start()
+        elif _ticker_calls == 1:
+            _ticker_cond.notify()
+
+    try:
+        yield
+    finally:
+        with _ticker_cond:
+            _ticker_calls -= 1
+
+
+def stop_epoch_ticker(timeout: float = None) -> None:
+    """
+    Stop the thread that advances the epoch once no call with a timeout is running, waiting
+    at most timeout seconds for it. The next such call starts it again.
+    """
+    global _ticker_stop
+
+    with _ticker_cond:
+        ticker = _ticker
+        _ticker_stop = True
+        _ticker_cond.notify()
+
+    if ticker is not None:
+        ticker.join(timeout)
+
+
+def deadline_ticks(timeout: float = None) -> int:
+    """Return the number of epoch ticks a call may run for, given a timeout in seconds"""
+    if timeout is None:
+        return NO_DEADLINE
+
+    # The first tick may come at any point within the current interval, so one
+    # more tick is needed to guarantee the call gets its full timeout
+    return max(1, math.ceil(timeout / EPOCH_TICK_INTERVAL)) + 1
+
+
+def wasmtime_version() -> str:
+    """Return the installed wasmtime version"""
+    try:
+        from importlib.metadata import version
+
+        return version("wasmtime")
+    except Exception:
+        return "unknown"
+
+
+def engine_fingerprint() -> str:
+    """Return a short hash identifying the wasmtime version and engine options"""
+    options = ",".join("{}={}".format(k, v) for k, v in sorted(ENGINE_OPTIONS.items()))
+    data = "{};{}".format(wasmtime_version(), options).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def module_hash(wasm_bytes: bytes) -> str:
+    """Return the content hash used to identify a compiled module"""
+    return hashlib.sha256(wasm_bytes).hexdigest()
+
+
+class DiskCache:
+    """
+    DiskCache stores serialized, precompiled modules in a directory so that later process starts
+    can load them instead of recompiling. Files are keyed by module hash and engine fingerprint,
+    and the least recently used files are evicted once the directory grows beyond max_bytes.
+
+    Only files written by DiskCache are ever deserialized; the directory must not be writable
+    by untrusted users, since wasmtime trusts serialized modules.
+    """
+
+    path: str
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    log: logging.Logger
+
+    def __init__(
+        self, path: str, max_bytes: int = DEFAULT_DISK_CACHE_MAX_BYTES, **kwargs
+    ):
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.log = kwargs.get("log", logging.getLogger("streamdal-python-sdk"))
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def file_path(self, key: str) -> str:
+        """Return the cache file path for the given module hash"""
+        return os.path.join(
+            self.path, "{}.{}{}".format(key, engine_fingerprint(), DISK_CACHE_FILE_EXT)
+        )
+
+    def load(self, engine: Engine, key: str) -> Module:
+        """Load a precompiled module from disk, returning None on a cache miss"""
+        path = self.file_path(key)
+
+        try:
+            # deserialize_file() memory-maps the file instead of reading it into memory
+            module = Module.deserialize_file(engine, path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            self.log.debug(f"Discarding unreadable cached module '{path}': {e}")
+            self._remove(path)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # Bump mtime so eviction treats this entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self.lock:
+            self.hits += 1
+
+        return module
+
+    def store(self, key: str, module: Module) -> None:
+        """Serialize a compiled module to disk, then evict old entries if over budget"""
+        path = self.file_path(key)
+
+        try:
+            data = module.serialize()
+
+            # Write to a temporary file and rename so readers never see a partial file
+            (fd, tmp_path) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.log.debug(f"Failed to write cached module '{path}': {e}")
+            return
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used cache files until the cache fits within max_bytes"""
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.path):
+            if not name.endswith(DISK_CACHE_FILE_EXT):
+                continue
+
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            if self._remove(path):
+                total -= size
+                with self.lock:
+                    self.evictions += 1
+
+    def stats(self) -> dict:
+        """Return cache hit, miss and eviction counts"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class ModuleCache:
+    """
+    ModuleCache holds compiled wasm modules keyed by the content hash of their bytes,
+    so that steps referencing the same wasm module only compile it once.
+
+    It is also the registry of module bytes: pipelines register the bytes of their modules
+    and refer to them by hash from then on. Each distinct module's bytes are held once, and
+    only until the module is compiled. Registrations are reference counted: a module and its
+    bytes are kept until every registration of them is released.
+    """
+
+    engine: Engine
+    modules: dict
+    sources: dict
+    refs: dict
+    registered: dict
+    disk: DiskCache
+    lock: Lock
+    released_bytes: int
+    deduplicated_bytes: int
+
+    def __init__(self, engine: Engine = None, disk: DiskCache = None):
+        self.engine = engine
+        self.disk = disk
+        self.modules = {}
+        self.sources = {}
+        self.refs = {}
+        self.registered = {}
+        self.lock = Lock()
+        self.compile_locks = {}
+        self.released_bytes = 0
+        self.deduplicated_bytes = 0
+
+    def register(self, wasm_bytes: bytes, key: str = None, wasm_id: str = None) -> str:
+        """
+        Keep a module's bytes until it is compiled, returning the hash to refer to it by. Every
+        registration must be paired with a release() of the hash.
+        """
+        if key is None:
+            key = module_hash(wasm_bytes)
+
+        with self.lock:
+            self.refs[key] = self.refs.get(key, 0) + 1
+            wasm_ids = self.registered.setdefault(key, set())
+
+            if key not in self.modules and key not in self.sources:
+                self.sources[key] = wasm_bytes
+            elif wasm_id is None or wasm_id not in wasm_ids:
+                # The same wasm_id registers its module again every time its pipelines are
+                # set, which only saves memory the first time
+                self.deduplicated_bytes += len(wasm_bytes)
+
+            if wasm_id is not None:
+                wasm_ids.add(wasm_id)
+
+        return key
+
+    def release(self, keys) -> None:
+        """Release a registration of each hash, dropping modules no registration is left for"""
+        with self.lock:
+            for key in keys:
+                refs = self.refs.get(key, 0) - 1
+                if refs > 0:
+                    self.refs[key] = refs
+                    continue
+
+                self.refs.pop(key, None)
+                self.registered.pop(key, None)
+                self.sources.pop(key, None)
+                self.modules.pop(key, None)
+
+    def source(self, key: str) -> bytes:
+        """Return the registered bytes of a module that has not been compiled yet, or None"""
+        return self.sources.get(key)
+
+    def load(self, key: str) -> Module:
+        """Return the compiled module for a registered hash, compiling it if necessary"""
+        return self._get(key, None)
+
+    def get(self, wasm_bytes: bytes, key: str = None) -> Module:
+        """Return the compiled module for the given wasm bytes, compiling it if necessary"""
+        if key is None:
+            key = module_hash(wasm_bytes)
+
+        return self._get(key, wasm_bytes)
+
+    def _get(self, key: str, wasm_bytes: bytes) -> Module:
+        module = self.modules.get(key)
+        if module is not None:
+            return module
+
+        # Compile outside the cache lock so that different modules can compile in parallel,
+        # while concurrent callers for the same module wait for a single compilation
+        with self.lock:
+            compile_lock = self.compile_locks.setdefault(key, Lock())
+
+        with compile_lock:
+            module = self.modules.get(key)
+            if module is None:
+                module = self._compile(key, wasm_bytes or self.sources.get(key))
+                self.modules[key] = module
+
+        with self.lock:
+            self.compile_locks.pop(key, None)
+
+            # The compiled module replaces the registered bytes
+            source = self.sources.pop(key, None)
+            if source is not None:
+                self.released_bytes += len(source)
+
+        return module
+
+    def _compile(self, key: str, wasm_bytes: bytes) -> Module:
+        """Compile a module, going through the disk cache when one is configured"""
+        engine = self.engine or get_engine()
+
+        if self.disk is None:
+            if wasm_bytes is None:
+                raise common.StreamdalException(
+                    f"wasm module '{key}' is not registered"
+                )
+
+            return Module(engine, wasm_bytes)
+
+        module = self.disk.load(engine, key)
+        if module is not None:
+            return module
+
+        if wasm_bytes is None:
+            raise common.StreamdalException(f"wasm module '{key}' is not registered")
+
+        module = Module(engine, wasm_bytes)
+        self.disk.store(key, module)
+
+        return module
+
+    def discard(self, key: str) -> None:
+        """
+        Drop a compiled module from the cache unless it is still registered, callers holding it
+        can keep using it
+        """
+        with self.lock:
+            if key not in self.refs:
+                self.modules.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Return the number of compiled modules, how much module bytes memory was saved, and the
+        hits, misses and evictions of the disk cache, which are 0 without one
+        """
+        disk = {"hits": 0, "misses": 0, "evictions": 0}
+        if self.disk is not None:
+            disk = self.disk.stats()
+
+        with self.lock:
+            return {
+                "modules": len(self.modules),
+                "source_bytes": sum(len(b) for b in self.sources.values()),
+                "released_bytes": self.released_bytes,
+                "deduplicated_bytes": self.deduplicated_bytes,
+                "disk_cache_hits": disk["hits"],
+                "disk_cache_misses": disk["misses"],
+                "disk_cache_evictions": disk["evictions"],
+            }
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+
+class WasmInstance:
+    """
+    WasmInstance is a single instantiation of a module together with the Store that owns
+    its linear memory. A Store is not thread-safe, so an instance must only be used by
+    one thread at a time; InstancePool takes care of handing them out.
+    """
+
+    instance: Instance
+    store: Store
+    calls: int
+    memory_size: int
+
+    def __init__(self, instance: Instance, store: Store):
+        self.instance = instance
+        self.store = store
+        self.calls = 0
+
+        # Exports can be called directly without a deadline; call() sets one per call
+        store.set_epoch_deadline(NO_DEADLINE)
+
+        exports = instance.exports(store)
+        self.exports = exports
+        self.memory = exports["memory"]
+        self.alloc = exports["alloc"]
+        self.dealloc = exports["dealloc"]
+        self.funcs = {}
+
+        # Size of linear memory when the instance was last returned to its pool
+        self.memory_size = self.memory.data_len(store)
+
+    def func(self, name: str):
+        """Return an exported function, caching the lookup"""
+        f = self.funcs.get(name)
+        if f is None:
+            f = self.exports[name]
+            self.funcs[name] = f
+
+        return f
+
+
+class InstancePool:
+    """
+    InstancePool hands out instances of a single module to concurrent callers. Instances are
+    created on demand up to max_size; once that many are in use, callers wait for one to be
+    returned. wasmtime releases the GIL while wasm executes, so steps using different
+    instances run in parallel.
+
+    Linear memory never shrinks, so an instance that has served max_calls calls or grown
+    past max_memory bytes is dropped when it is checked in, and replaced by a fresh one on
+    a later checkout. A limit of 0 disables it.
+    """
+
+    max_size: int
+    max_calls: int
+    max_memory: int
+    idle: list
+    instances: list
+    created: int
+    checkouts: int
+    waits: int
+    wait_time: float
+    recycles: int
+    closed: bool
+
+    def __init__(
+        self,
+        factory,
+        max_size: int = DEFAULT_POOL_SIZE,
+        max_calls: int = 0,
+        max_memory: int = 0,
+    ):
+        if int(max_size) < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.factory = factory
+        self.max_size = int(max_size)
+        self.max_calls = int(max_calls)
+        self.max_memory = int(max_memory)
+        self.idle = []
+        self.instances = []
+        self.closed = False
+        self.cond = Condition(Lock())
+        self.created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.recycles = 0
+
+    def checkout(self) -> WasmInstance:
+        """Take an idle instance from the pool, creating one if the pool is not full yet"""
+        with self.cond:
+            self.checkouts += 1
+
+            if len(self.idle) == 0 and self.created >= self.max_size:
+                self.waits += 1
+                started = time.monotonic()
+                while len(self.idle) == 0 and self.created >= self.max_size:
+                    self.cond.wait()
+                self.wait_time += time.monotonic() - started
+
+            if len(self.idle) > 0:
+                return self.idle.pop()
+
+            # Reserve a slot, then instantiate outside the lock
+            self.created += 1
+
+        try:
+            inst = self.factory()
+        except Exception:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+        with self.cond:
+            self.instances.append(inst)
+
+        return inst
+
+    def checkin(self, inst: WasmInstance) -> bool:
+        """Return an instance to the pool. Returns True if it was recycled instead of reused."""
+        memory = getattr(inst, "memory", None)
+        if memory is not None:
+            inst.memory_size = memory.data_len(inst.store)
+
+        recycle = self._should_recycle(inst)
+
+        with self.cond:
+            if self.closed:
+                self._remove(inst)
+            elif recycle:
+                self._remove(inst)
+                self.recycles += 1
+            else:
+                self.idle.append(inst)
+            self.cond.notify()
+
+        return recycle
+
+    def _should_recycle(self, inst: WasmInstance) -> bool:
+        if self.max_calls > 0 and getattr(inst, "calls", 0) >= self.max_calls:
+            return True
+
+        return self.max_memory > 0 and getattr(inst, "memory_size", 0) > self.max_memory
+
+    def discard(self, inst: WasmInstance) -> None:
+        """Drop an instance that must not be reused, freeing its slot in the pool"""
+        with self.cond:
+            self._remove(inst)
+            self.cond.notify()
+
+    def _remove(self, inst: WasmInstance) -> None:
+        self.created -= 1
+        if inst in self.instances:
+            self.instances.remove(inst)
+
+    def close(self) -> None:
+        """Drop idle instances; instances still in use are dropped when they are checked in"""
+        with self.cond:
+            self.closed = True
+            for inst in self.idle:
+                self._remove(inst)
+            self.idle = []
+            self.cond.notify_all()
+
+    def resident_bytes(self) -> int:
+        """Return the linear memory used by the pool's instances, as of their last checkin"""
+        with self.cond:
+            return sum(getattr(inst, "memory_size", 0) for inst in self.instances)
+
+    @contextmanager
+    def instance(self):
+        """Context manager that checks an instance out and returns it afterwards"""
+        inst = self.checkout()
+        try:
+            yield inst
+        finally:
+            self.checkin(inst)
+
+    def stats(self) -> dict:
+        """Return pool sizing and contention statistics"""
+        with self.cond:
+            return {
+                "max_size": self.max_size,
+                "size": self.created,
+                "idle": len(self.idle),
+                "in_use": self.created - len(self.idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "recycles": self.recycles,
+                "resident_bytes": sum(
+                    getattr(inst, "memory_size", 0) for inst in self.instances
+                ),
+                "instances": [
+                    {
+                        "calls": getattr(inst, "calls", 0),
+                        "memory_bytes": getattr(inst, "memory_size", 0),
+                    }
+                    for inst in self.instances
+                ],
+            }
+
+
+class FunctionCache:
+    """
+    FunctionCache holds the instance pool of each wasm module, keyed by wasm_id. Pools are
+    reference counted by the pipelines that use them. Pools that no pipeline uses are kept
+    in LRU order so they can be reused if a pipeline switches back. Once there are more than
+    max_unused of them, or their instances use more than max_unused_bytes of linear memory,
+    the least recently used ones are evicted. Evicting a pool releases its instances and its
+    compiled module.
+    """
+
+    pools: dict
+    refs: dict
+    unused: OrderedDict
+    module_keys: dict
+    max_unused: int
+    max_unused_bytes: int
+    evictions: int
+
+    def __init__(
+        self,
+        max_unused: int = DEFAULT_UNUSED_MAX_COUNT,
+        max_unused_bytes: int = DEFAULT_UNUSED_MAX_BYTES,
+    ):
+        self.max_unused = int(max_unused)
+        self.max_unused_bytes = int(max_unused_bytes)
+        self.pools = {}
+        self.refs = {}
+        self.unused = OrderedDict()
+        self.module_keys = {}
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, wasm_id: str) -> InstancePool:
+        """Return the pool for a wasm_id, or None"""
+        pool = self.pools.get(wasm_id)
+        if pool is not None and wasm_id in self.unused:
+            with self.lock:
+                if wasm_id in self.unused:
+                    self.unused.move_to_end(wasm_id)
+
+        return pool
+
+    def setdefault(
+        self, wasm_id: str, pool: InstancePool, module_key: str = None
+    ) -> InstancePool:
+        """Add a pool for a wasm_id unless one exists, returning the pool that is kept"""
+        with self.lock:
+            existing = self.pools.get(wasm_id)
+            if existing is not None:
+                return existing
+
+            self.pools[wasm_id] = pool
+            if module_key is not None:
+                self.module_keys[wasm_id] = module_key
+
+            if self.refs.get(wasm_id, 0) == 0:
+                self.unused[wasm_id] = None
+                self._evict()
+
+        return pool
+
+    def acquire(self, wasm_ids) -> None:
+        """Take a reference on each wasm_id for a pipeline plan that uses it"""
+        with self.lock:
+            for wasm_id in wasm_ids:
+                self.refs[wasm_id] = self.refs.get(wasm_id, 0) + 1
+                self.unused.pop(wasm_id, None)
+
+    def release(self, wasm_ids) -> int:
+        """Drop a reference on each wasm_id, evicting unused pools over budget. Returns the number evicted."""
+        with self.lock:
+            for wasm_id in wasm_ids:
+                refs = self.refs.get(wasm_id, 0) - 1
+                if refs > 0:
+                    self.refs[wasm_id] = refs
+                    continue
+
+                self.refs.pop(wasm_id, None)
+                if wasm_id in self.pools:
+                    self.unused[wasm_id] = None
+                    self.unused.move_to_end(wasm_id)
+
+            return self._evict()
+
+    def _evict(self) -> int:
+        evicted = 0
+        unused_bytes = sum(self.pools[w].resident_bytes() for w in self.unused)
+
+        while len(self.unused) > 0 and (
+            len(self.unused) > self.max_unused or unused_bytes > self.max_unused_bytes
+        ):
+            (wasm_id, _) = self.unused.popitem(last=False)
+            pool = self.pools.pop(wasm_id)
+            unused_bytes -= pool.resident_bytes()
+            pool.close()
+
+            # Other wasm_ids can share the module when they carry the same bytes
+            module_key = self.module_keys.pop(wasm_id, None)
+            if module_key is not None and module_key not in self.module_keys.values():
+                modules.discard(module_key)
+
+            evicted += 1
+
+        self.evictions += evicted
+        return evicted
+
+    def referenced(self, wasm_id: str) -> bool:
+        """Return whether a pipeline plan holds a reference on a wasm_id"""
+        return wasm_id in self.refs
+
+    def resident_bytes(self) -> int:
+        """Return the linear memory used by the instances of all pools"""
+        return sum(pool.resident_bytes() for pool in list(self.pools.values()))
+
+    def stats(self) -> dict:
+        """Return pool counts, evictions, instance recycles and resident instance bytes"""
+        with self.lock:
+            return {
+                "functions": len(self.pools),
+                "referenced": len(self.pools) - len(self.unused),
+                "unused": len(self.unused),
+                "evictions": self.evictions,
+                "recycles": sum(pool.recycles for pool in self.pools.values()),
+                "resident_bytes": self.resident_bytes(),
+            }
+
+    def items(self):
+        return list(self.pools.items())
+
+    def __contains__(self, wasm_id: str) -> bool:
+        return wasm_id in self.pools
+
+    def __len__(self) -> int:
+        return len(self.pools)
+
+
+def new_linker(host_func) -> Linker:
+    """Create a linker on the shared engine with WASI and the SDK's host functions defined"""
+    linker = Linker(get_engine())
+    linker.define_wasi()
+
+    funcs = {
+        "httpRequest": host_func.http_request,
+        "kvExists": host_func.kv_exists,
+    }
+
+    for name, func in funcs.items():
+        linker.define_func(
+            "env",
+            name,
+            FuncType([ValType.i32(), ValType.i32()], [ValType.i64()]),
+            func,
+            True,
+        )
+
+    return linker
+
+
+def new_instance(linker: Linker, module: Module) -> WasmInstance:
+    """Instantiate a module in a fresh Store"""
+    wasi = WasiConfig()
+    wasi.inherit_stdout()
+    wasi.inherit_stdin()
+    wasi.inherit_stderr()
+
+    store = Store(linker.engine)
+    store.set_wasi(wasi)
+    store.set_epoch_deadline(NO_DEADLINE)
+
+    return WasmInstance(linker.instantiate(store, module), store)
+
+
+# Wire tags of the WasmRequest fields, as (field_number << 3) | wire type 2 (length-delimited)
+_TAG_STEP = b"\x0a"
+_TAG_INPUT_PAYLOAD = b"\x12"
+_TAG_INTER_STEP_RESULT = b"\x22"
+
+
+def _varint(n: int) -> bytes:
+    """Encode a non-negative integer as a protobuf varint"""
+    if n < 0x80:
+        return bytes((n,))
+
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+    return bytes(out)
+
+
+def encode_field(tag: bytes, value: bytes) -> bytes:
+    """Encode a length-delimited protobuf field"""
+    return tag + _varint(len(value)) + value
+
+
+def encode_step(step_bytes: bytes) -> bytes:
+    """
+    Encode the step field of a WasmRequest from an already serialized PipelineStep.
+    The result only depends on the step, so it can be computed once and reused for every payload.
+    """
+    if len(step_bytes) == 0:
+        return b""
+
+    return encode_field(_TAG_STEP, step_bytes)
+
+
+def _request_parts(step_field: bytes, payload: bytes, isr_bytes: bytes) -> list:
+    """Return the byte strings that make up an encoded WasmRequest, in order"""
+    parts = [step_field]
+
+    if len(payload) > 0:
+        parts.append(_TAG_INPUT_PAYLOAD)
+        parts.append(_varint(len(payload)))
+        parts.append(payload)
+
+    # inter_step_result is an optional field, so it is sent even when empty
+    if isr_bytes is not None:
+        parts.append(_TAG_INTER_STEP_RESULT)
+        parts.append(_varint(len(isr_bytes)))
+        parts.append(isr_bytes)
+
+    return parts
+
+
+def encode_wasm_request(
+    step_field: bytes, payload: bytes, isr_bytes: bytes = None
+) -> bytes:
+    """
+    Build an encoded WasmRequest by concatenating a step field from encode_step() with the
+    payload and the serialized inter-step result. Produces the same bytes as encoding a
+    WasmRequest message with betterproto.
+    """
+    return b"".join(_request_parts(step_field, payload, isr_bytes))
+
+
+def _read_varint(buf, pos: int) -> tuple:
+    """Decode a protobuf varint at pos, returning the value and the position after it"""
+    result = 0
+    shift = 0
+
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (result, pos)
+        shift += 7
+
+
+def decode_wasm_response(buf) -> protos.WasmResponse:
+    """
+    Decode an encoded WasmResponse from bytes or a memoryview. Each field is copied out of
+    buf exactly once, so buf may be a view over wasm memory that is released afterwards.
+    """
+    resp = protos.WasmResponse()
+
+    pos = 0
+    end = len(buf)
+
+    while pos < end:
+        (key, pos) = _read_varint(buf, pos)
+        field = key >> 3
+        wire_type = key & 0x07
+
+        if wire_type == 0:
+            (value, pos) = _read_varint(buf, pos)
+            if field == 2:
+                try:
+                    resp.exit_code = protos.WasmExitCode(value)
+                except ValueError:
+                    resp.exit_code = value
+        elif wire_type == 2:
+            (length, pos) = _read_varint(buf, pos)
+            value = buf[pos : pos + length]
+            pos += length
+
+            if field == 1:
+                resp.output_payload = bytes(value)
+            elif field == 3:
+                resp.exit_msg = str(value, "utf-8")
+            elif field == 4:
+                resp.output_step = bytes(value)
+            elif field == 5:
+                resp.inter_step_result = protos.InterStepResult().parse(bytes(value))
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise common.StreamdalException(
+                f"unsupported wire type {wire_type} in WasmResponse"
+            )
+
+    if pos != end:
+        raise common.StreamdalException("truncated WasmResponse")
+
+    return resp
+
+
+def memory_view(inst: WasmInstance) -> memoryview:
+    """
+    Return a writable view over the whole linear memory of an instance. The view is only
+    valid until the memory grows or the instance is used again, so it must not be kept
+    beyond a single call.
+    """
+    store = inst.store
+    size = inst.memory.data_len(store)
+    ptr = inst.memory.data_ptr(store)
+
+    return memoryview(
+        (ctypes.c_ubyte * size).from_address(ctypes.addressof(ptr.contents))
+    ).cast("B")
+
+
+def _write(inst: WasmInstance, parts) -> tuple:
+    """Allocate memory in the instance and write parts into it back to back, returning (ptr, length)"""
+    length = sum(len(part) for part in parts)
+
+    # Allocate enough memory for the length of the data and receive memory pointer
+    ptr = inst.alloc(inst.store, length)
+
+    # alloc() may have grown memory, so the view is taken afterwards
+    view = memory_view(inst)
+    if ptr + length > len(view):
+        raise common.StreamdalException("WASM memory pointer out of bounds")
+
+    pos = ptr
+    for part in parts:
+        view[pos : pos + len(part)] = part
+        pos += len(part)
+
+    return (ptr, length)
+
+
+def _execute(inst: WasmInstance, function: str, ptr: int, length: int, read):
+    """Run a function on data at ptr, pass a view of its result to read() and free the result"""
+    store = inst.store
+
+    # Execute the function, it returns the result pointer and length packed into an i64
+    result = inst.func(function)(store, ptr, length)
+
+    # Don't interrupt the cleanup of a call that finished in time
+    store.set_epoch_deadline(NO_DEADLINE)
+    result_ptr = result >> 32
+    result_len = result & 0xFFFFFFFF
+
+    view = memory_view(inst)
+    if result_ptr + result_len > len(view):
+        raise common.StreamdalException("WASM memory pointer out of bounds")
+
+    try:
+        res = read(view[result_ptr : result_ptr + result_len])
+    finally:
+        view.release()
+
+    # Dealloc result pointer
+    inst.dealloc(store, result_ptr, result_len)
+
+    inst.calls += 1
+
+    return res
+
+
+def _run(inst: WasmInstance, function: str, parts, read, timeout: float):
+    """Write parts into the instance and execute function on them within timeout seconds"""
+    if timeout is not None and timeout <= 0:
+        raise common.TimeoutException("step timed out before it started")
+
+    inst.store.set_epoch_deadline(deadline_ticks(timeout))
+
+    try:
+        with epoch_ticking(timeout):
+            (ptr, length) = _write(inst, parts)
+            return _execute(inst, function, ptr, length, read)
+    except Trap as e:
+        if e.trap_code == TrapCode.INTERRUPT:
+            raise common.TimeoutException(
+                f"step exceeded its timeout of {timeout * 1000:.0f}ms"
+            )
+        raise
+
+
+def call(
+    inst: WasmInstance, function: str, data: bytes, timeout: float = None
+) -> bytes:
+    """
+    Write an encoded WasmRequest into the instance's memory, run the given function
+    and return the encoded WasmResponse it produced. Raises TimeoutException if the
+    function runs for longer than timeout seconds; the instance must not be reused then.
+    """
+    return _run(inst, function, (data,), bytes, timeout)
+
+
+def call_step(
+    inst: WasmInstance,
+    function: str,
+    step_field: bytes,
+    payload: bytes,
+    isr_bytes: bytes = None,
+    timeout: float = None,
+) -> protos.WasmResponse:
+    """
+    Run a step against a payload. The WasmRequest is written straight into the instance's
+    memory from the encoded step field, the payload and the inter-step result, and the
+    WasmResponse is decoded from a view of that memory, so the payload is copied once on
+    the way in and the output payload once on the way out.
+    """
+    parts = _request_parts(step_field, payload, isr_bytes)
+    return _run(inst, function, parts, decode_wasm_response, timeout)
+
+
+# Process-wide module cache used by all StreamdalClient instances
+modules = ModuleCache()
@@ -28,6 +28,70 @@ class TestCommon:
         assert parsed.operation_name == aud.operation_name
         assert parsed.operation_type == aud.operation_type
 
+    def test_audience_registry_get(self):
+        registry = common.AudienceRegistry()
+
+        aud = registry.get("testing", 2, "test-topic", "kafka")
+
+        assert registry.get("testing", 2, "test-topic", "kafka") is aud
+        assert aud.operation_type == protos.OperationType.OPERATION_TYPE_PRODUCER
+        assert registry.key(aud) == "testing.kafka.2.test-topic"
+        assert registry.get("testing", 1, "test-topic", "kafka") is not aud
+        assert len(registry) == 2
+
+    def test_audience_registry_intern(self):
+        registry = common.AudienceRegistry()
+        aud = registry.get("testing", 2, "test-topic", "kafka")
+
+        # Audiences received from the server map to the object used by process()
+        received = protos.Audience(
+            component_name="kafka",
+            service_name="testing",
+            operation_name="test-topic",
+            operation_type=protos.OperationType.OPERATION_TYPE_PRODUCER,
+        )
+        assert registry.intern(received) is aud
+        assert registry.intern(aud) is aud
+
+        # Audiences differing only in case share a key
+        upper = registry.get("Testing", 2, "Test-Topic", "kafka")
+        assert upper is aud
+        assert len(registry) == 1
+
+    def test_audience_registry_evicts(self):
+        registry = common.AudienceRegistry(max_size=2)
+        first = registry.get("testing", 2, "first", "kafka")
+        second = registry.get("testing", 2, "Second", "kafka")
+        registry.get("testing", 2, "second", "kafka")
+
+        # Looking up an audience makes it the most recently used
+        assert registry.get("testing", 2, "first", "kafka") is first
+        registry.get("testing", 2, "third", "kafka")
+
+        assert len(registry) == 2
+        assert registry.audiences.keys() == {
+            ("testing", 2, "first", "kafka"),
+            ("testing", 2, "third", "kafka"),
+        }
+        assert id(second) not in registry.keys
+
+        # Evicted audiences still have a key, and are interned again as new ones
+        assert registry.key(second) == "testing.kafka.2.second"
+        assert registry.get("testing", 2, "second", "kafka") is not second
+        assert len(registry) == 2
+
+    def test_audience_registry_key_not_interned(self):
+        registry = common.AudienceRegistry()
+        aud = protos.Audience(
+            component_name="kafka",
+            service_name="testing",
+            operation_name="test-topic",
+            operation_type=protos.OperationType.OPERATION_TYPE_PRODUCER,
+        )
+
+        assert registry.key(aud) == common.aud_to_str(aud)
+        assert len(registry) == 0
+
     def test_read_memory_within_bounds(self):
         """Test reading within bounds of memory"""
         store = Store()
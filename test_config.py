@@ -1,5 +1,5 @@
 import pytest
-from streamdal import StreamdalConfig
+from streamdal import EXECUTION_MODE_PROCESS, StreamdalConfig
 
 
 class TestStreamdalConfig:
@@ -39,3 +39,154 @@ class TestStreamdalConfig:
                 streamdal_token="",
             )
             cfg.validate()
+
+    def test_execution_mode(self):
+        with pytest.raises(ValueError, match="execution_mode must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                execution_mode="threads",
+            )
+            cfg.validate()
+
+        cfg = StreamdalConfig(
+            service_name="writer",
+            streamdal_url="localhost:8082",
+            streamdal_token="fake token",
+            execution_mode=EXECUTION_MODE_PROCESS,
+        )
+        assert cfg.validate() is None
+
+    def test_timeouts(self):
+        with pytest.raises(ValueError, match="step_timeout must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                step_timeout=0,
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="pipeline_timeout must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                pipeline_timeout="-1",
+            )
+            cfg.validate()
+
+    def test_instance_limits(self):
+        with pytest.raises(ValueError, match="wasm_instance_max_calls must not be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                wasm_instance_max_calls=-1,
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="wasm_instance_max_memory must not be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                wasm_instance_max_memory="-1",
+            )
+            cfg.validate()
+
+    def test_metrics_publishing(self):
+        with pytest.raises(ValueError, match="metrics_flush_interval must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                metrics_flush_interval=0,
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="metrics_max_batch_size must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                metrics_max_batch_size="0",
+            )
+            cfg.validate()
+
+    def test_metrics_limits(self):
+        with pytest.raises(ValueError, match="metrics_max_series must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                metrics_max_series=0,
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="metrics_max_pending must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                metrics_max_pending="0",
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="metrics_drop_policy must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                metrics_drop_policy="block",
+            )
+            cfg.validate()
+
+    def test_metrics_port(self):
+        with pytest.raises(ValueError, match="metrics_port must be between"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                metrics_port=70000,
+            )
+            cfg.validate()
+
+    def test_shutdown_timeout(self):
+        with pytest.raises(ValueError, match="shutdown_timeout must not be negative"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                shutdown_timeout=-1,
+            )
+            cfg.validate()
+
+    def test_warmup(self):
+        with pytest.raises(ValueError, match="warmup_policy must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                warmup_policy="later",
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="warmup_threads must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                warmup_threads=0,
+            )
+            cfg.validate()
+
+        with pytest.raises(ValueError, match="warmup_timeout must be"):
+            cfg = StreamdalConfig(
+                service_name="writer",
+                streamdal_url="localhost:8082",
+                streamdal_token="fake token",
+                warmup_timeout=0,
+            )
+            cfg.validate()
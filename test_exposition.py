@@ -0,0 +1,160 @@
+import asyncio
+import math
+import urllib.error
+import urllib.request
+
+import pytest
+import streamdal_protos.protos as protos
+from streamdal.exposition import (
+    BOUND_LABELS,
+    Exposition,
+    ExpositionServer,
+    format_value,
+)
+from streamdal.metrics import Metrics
+from threading import Event
+from unittest.mock import Mock
+
+
+class TestExposition:
+    metrics: Metrics
+
+    @pytest.fixture(autouse=True)
+    def before_each(self):
+        # With exit already set the background workers return immediately
+        exit = Event()
+        exit.set()
+
+        self.metrics = Metrics(loop=asyncio.new_event_loop(), exit=exit, log=Mock())
+        self.aud = protos.Audience(
+            service_name="test",
+            component_name="kafka",
+            operation_type=protos.OperationType.OPERATION_TYPE_CONSUMER,
+            operation_name="orders",
+        )
+
+    def render(self, exposition: Exposition) -> str:
+        return b"".join(exposition.render()).decode()
+
+    def test_render_counters(self):
+        self.metrics.counter(
+            "counter_consume_bytes", {"pipeline_id": "a"}, self.aud
+        ).add(3.0)
+        self.metrics.counter(
+            "counter_consume_bytes", {"pipeline_id": 'say "hi"'}, self.aud
+        ).add(1.0)
+        self.metrics.dropped("max_series").add(2.0)
+        self.metrics.take_counters()
+
+        lines = self.render(Exposition(self.metrics)).splitlines()
+
+        assert lines == [
+            "# TYPE streamdal_counter_consume_bytes counter",
+            'streamdal_counter_consume_bytes{service="test",component="kafka",'
+            'operation_type="consumer",operation="orders",pipeline_id="a"} 3.0',
+            'streamdal_counter_consume_bytes{service="test",component="kafka",'
+            'operation_type="consumer",operation="orders",pipeline_id="say \\"hi\\""} 1.0',
+            "# TYPE streamdal_counter_dropped_metrics counter",
+            'streamdal_counter_dropped_metrics{reason="max_series"} 2.0',
+        ]
+
+    def test_render_totals(self):
+        exposition = Exposition(self.metrics)
+        handle = self.metrics.counter("test", {}, None)
+
+        handle.add(2.0)
+        self.metrics.take_counters()
+        assert "streamdal_test 2.0" in self.render(exposition)
+
+        # Publishing resets counters, the exposition shows their totals
+        handle.add(1.0)
+        self.metrics.take_counters()
+        self.metrics.take_counters()
+        assert "streamdal_test 3.0" in self.render(exposition)
+        assert set(exposition.lines) == {handle}
+
+        # Lines of reaped counters are let go of
+        self.metrics.remove_counter(handle.key)
+        self.render(exposition)
+        assert exposition.lines == {}
+
+    def test_render_histograms(self):
+        histogram = self.metrics.histogram("histogram_step_seconds", {}, None)
+        histogram.observe(0.000_003)
+        histogram.observe(0.000_003)
+        histogram.observe(0.5)
+        self.metrics.take_counters()
+
+        lines = self.render(Exposition(self.metrics)).splitlines()
+
+        # Every bucket is exposed, cumulative, with bounds in powers of two microseconds
+        assert lines[0] == "# TYPE streamdal_histogram_step_seconds histogram"
+        assert lines[1:4] == [
+            'streamdal_histogram_step_seconds_bucket{le="1e-06"} 0',
+            'streamdal_histogram_step_seconds_bucket{le="2e-06"} 0',
+            'streamdal_histogram_step_seconds_bucket{le="4e-06"} 2',
+        ]
+        assert 'streamdal_histogram_step_seconds_bucket{le="0.262144"} 2' in lines
+        assert 'streamdal_histogram_step_seconds_bucket{le="0.524288"} 3' in lines
+        assert len(lines) == 1 + len(BOUND_LABELS) + 3
+        assert lines[-3:] == [
+            'streamdal_histogram_step_seconds_bucket{le="+Inf"} 3',
+            "streamdal_histogram_step_seconds_sum 0.500006",
+            "streamdal_histogram_step_seconds_count 3",
+        ]
+
+    def test_render_parses(self):
+        parser = pytest.importorskip("prometheus_client.parser")
+
+        self.metrics.histogram("histogram_step_seconds", {"step": "a"}, None).observe(
+            0.000_003
+        )
+        self.metrics.histogram("histogram_step_seconds", {"step": "b"}, None).observe(
+            2.5
+        )
+        self.metrics.counter("test", {}, None).add(math.inf)
+        self.metrics.take_counters()
+
+        families = {
+            f.name: f
+            for f in parser.text_string_to_metric_families(
+                self.render(Exposition(self.metrics))
+            )
+        }
+
+        # Both series have the same buckets, whatever they recorded
+        bounds = {"a": [], "b": []}
+        for s in families["streamdal_histogram_step_seconds"].samples:
+            if s.name.endswith("_bucket"):
+                bounds[s.labels["step"]].append(s.labels["le"])
+
+        assert bounds["a"] == bounds["b"]
+        assert bounds["a"][-1] == "+Inf"
+        assert len(bounds["a"]) == len(BOUND_LABELS) + 1
+
+        assert families["streamdal_test"].samples[0].value == math.inf
+
+    def test_format_value(self):
+        assert format_value(1.5) == "1.5"
+        assert format_value(math.inf) == "+Inf"
+        assert format_value(-math.inf) == "-Inf"
+        assert format_value(math.nan) == "NaN"
+
+    def test_server(self):
+        self.metrics.counter("test", {}, None).add(1.0)
+        self.metrics.take_counters()
+
+        server = ExpositionServer(self.metrics, 0, host="127.0.0.1")
+        server.start()
+        try:
+            url = f"http://127.0.0.1:{server.port}"
+            with urllib.request.urlopen(url + "/metrics", timeout=5) as res:
+                assert res.headers["Content-Type"].startswith("text/plain")
+                assert b"streamdal_test 1.0\n" in res.read()
+
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + "/other", timeout=5)
+        finally:
+            server.shutdown()
+
+        assert not server.thread.is_alive()
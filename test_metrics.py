@@ -4,9 +4,26 @@ import time
 
 import pytest
 import streamdal_protos.protos as protos
-from streamdal.metrics import Metrics, CounterEntry, Counter, composite_id
-from threading import Event, Lock
-from queue import SimpleQueue
+from streamdal.metrics import (
+    COUNTER_DROPPED_METRICS,
+    COUNTER_TTL_GENERATIONS,
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_MAX_PENDING_REQUESTS,
+    DEFAULT_MAX_SERIES,
+    DROP_POLICY_DROP,
+    DROP_POLICY_HOLD,
+    Metrics,
+    CounterBatch,
+    CounterEntry,
+    CounterStore,
+    OverflowHandle,
+    bucket_bounds,
+    bucket_index,
+    composite_id,
+    counter_key,
+    new_overflow_handle,
+)
+from threading import Event, Lock, local
 from unittest.mock import AsyncMock, Mock
 
 
@@ -17,11 +34,26 @@ class TestMetrics:
     def before_each(self):
         metrics = object.__new__(Metrics)
         metrics.exit = Event()
-        metrics.counters = {}
         metrics.stub = AsyncMock()
         metrics.lock = Lock()
-        metrics.publish_queue = SimpleQueue()
-        metrics.incr_queue = SimpleQueue()
+        metrics.counters = CounterStore(metrics.lock)
+        metrics.shards = []
+        metrics.shard = local()
+        metrics.handles = {}
+        metrics.exempt = {}
+        metrics.entries = {}
+        metrics.histograms = {}
+        metrics.generation = 1
+        metrics.buckets = {}
+        metrics.flush_interval = 0.01
+        metrics.max_batch_size = DEFAULT_MAX_BATCH_SIZE
+        metrics.max_series = DEFAULT_MAX_SERIES
+        metrics.max_pending = DEFAULT_MAX_PENDING_REQUESTS
+        metrics.drop_policy = DROP_POLICY_HOLD
+        metrics.requests = set()
+        metrics.overflow = new_overflow_handle(metrics)
+        metrics.loop = asyncio.new_event_loop()
+        metrics.auth_token = "test"
         metrics.log = Mock()
 
         self.metrics = metrics
@@ -82,19 +114,15 @@ class TestMetrics:
         assert counter.val() == 0.0
 
     def test_incr_metrics(self):
-        worker = threading.Thread(
-            target=self.metrics.run_incrementer_worker, args=(1,), daemon=False
-        )
-        worker.start()
-
         entry = CounterEntry(
             name="test", labels={"type": "bytes"}, value=3.0, aud=protos.Audience()
         )
 
         self.metrics.incr(entry=entry)
 
-        # Allow inrcrementor worker time to pick up the job
-        time.sleep(2)
+        # Increments stay in the thread's shard until the publisher merges them
+        assert len(self.metrics.counters) == 0
+        self.metrics.merge()
 
         c = self.metrics.get_counter(
             CounterEntry(
@@ -104,12 +132,155 @@ class TestMetrics:
             )
         )
 
-        self.metrics.exit.set()
-        worker.join()
-
         assert c is not None
         assert c.val() == 3.0
 
+        # Only increments made since the last merge are added
+        self.metrics.incr(entry=entry)
+        self.metrics.merge()
+        self.metrics.merge()
+
+        assert c.val() == 6.0
+
+    def test_incr_metrics_threads(self):
+        aud = protos.Audience()
+        entry = CounterEntry(name="test", labels={"type": "bytes"}, value=1.0, aud=aud)
+        merged = threading.Event()
+
+        def work():
+            for _ in range(1000):
+                self.metrics.incr(entry)
+
+        def merge():
+            while not merged.is_set():
+                self.metrics.merge()
+
+        # Merge concurrently with the increments to make sure none are lost or counted twice
+        merger = threading.Thread(target=merge)
+        merger.start()
+
+        workers = [threading.Thread(target=work) for _ in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        merged.set()
+        merger.join()
+        self.metrics.merge()
+
+        assert self.metrics.get_counter(entry).val() == 8000.0
+
+        # Shards of exited threads are dropped once merged
+        assert len(self.metrics.shards) == 0
+
+    def test_incr_copies_labels(self):
+        labels = {"type": "bytes"}
+        self.metrics.incr(
+            CounterEntry(name="test", labels=labels, value=1.0, aud=protos.Audience())
+        )
+        labels["type"] = "changed"
+
+        self.metrics.merge()
+
+        (key,) = self.metrics.counters
+        counter = self.metrics.counters[key]
+        assert counter.entry.labels == {"type": "bytes"}
+
+    def test_counter_handle(self):
+        aud = protos.Audience(service_name="test")
+        labels = {"pipeline_id": "one"}
+
+        handle = self.metrics.counter("test", labels, aud)
+        labels["pipeline_id"] = "two"
+
+        # Handles are cached and don't change with the caller's labels
+        assert self.metrics.counter("test", {"pipeline_id": "one"}, aud) is handle
+        assert handle.entry.labels == {"pipeline_id": "one"}
+
+        handle.add(2.0)
+        handle.add()
+        self.metrics.incr(
+            CounterEntry(name="test", labels={"pipeline_id": "one"}, value=1.0, aud=aud)
+        )
+        self.metrics.merge()
+
+        assert len(self.metrics.counters) == 1
+        assert self.metrics.counters[handle.key].val() == 4.0
+
+    def test_counter_handle_per_series(self):
+        handle = self.metrics.counter(
+            "test", {"a": "x", "b": "y"}, protos.Audience(service_name="test")
+        )
+
+        # Rebuilt audiences and reordered labels resolve to the cached handle
+        for _ in range(10):
+            aud = protos.Audience(service_name="test")
+            assert self.metrics.counter("test", {"b": "y", "a": "x"}, aud) is handle
+
+        assert list(self.metrics.handles) == [handle.key]
+
+    def test_counter_key(self):
+        aud = protos.Audience(service_name="test")
+
+        # composite_id() only uses label values, so these would share a counter
+        assert counter_key("test", {"a": "x", "b": ""}, aud) != counter_key(
+            "test", {"a": "", "b": "x"}, aud
+        )
+        assert counter_key("test", {"a": "x", "b": "y"}, aud) == counter_key(
+            "test", {"b": "y", "a": "x"}, aud
+        )
+        assert counter_key("test", {}, aud) != counter_key(
+            "test", {}, protos.Audience(service_name="other")
+        )
+
+    def test_counter_batch_handles(self):
+        handle = self.metrics.counter("test", {}, protos.Audience())
+
+        batch = CounterBatch()
+        batch.add(handle, 1.0)
+        batch.add(handle, 2.0)
+
+        # Nothing is counted until the batch is flushed
+        self.metrics.merge()
+        assert len(self.metrics.counters) == 0
+
+        batch.flush(self.metrics)
+        self.metrics.merge()
+
+        assert self.metrics.counters[handle.key].val() == 3.0
+        assert len(batch.handles) == 0
+
+    def test_incr_cached(self):
+        aud = protos.Audience(service_name="test")
+        labels = {"pipeline_id": "one", "step": "a"}
+        entry = CounterEntry(name="test", aud=aud, labels=labels, value=1.0)
+
+        self.metrics.incr(entry)
+        self.metrics.incr(entry)
+        (cached_aud, handle) = self.metrics.entries[
+            ("test", id(aud), tuple(labels.items()))
+        ]
+        assert cached_aud is aud
+        assert handle is self.metrics.counter("test", labels, aud)
+
+        # Equal audiences and labels in another order resolve to the same series
+        self.metrics.incr(
+            CounterEntry(
+                name="test",
+                aud=protos.Audience(service_name="test"),
+                labels={"step": "a", "pipeline_id": "one"},
+                value=1.0,
+            )
+        )
+        self.metrics.merge()
+        assert self.metrics.counters[handle.key].val() == 3.0
+        assert len(self.metrics.handles) == 1
+
+        # Reaping counters lets go of the cached handles
+        self.metrics.remove_handles([handle.key])
+        assert self.metrics.entries == {}
+
     # TODO: fix broken test
     # def test_publish_metrics(self):
     #     fake_stub = AsyncMock()
@@ -126,21 +297,493 @@ class TestMetrics:
     #
     #     fake_stub.metrics.assert_called_once()
 
+    def run_loop(self):
+        """Run the tasks scheduled on the metrics loop to completion"""
+        loop = self.metrics.loop
+        loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop)))
+
+    def incr_counters(self, count: int) -> None:
+        for i in range(count):
+            self.metrics.incr(
+                CounterEntry(
+                    name="test",
+                    labels={"pipeline_id": str(i)},
+                    value=float(i + 1),
+                    aud=protos.Audience(),
+                )
+            )
+
     def test_run_publisher(self):
-        counter = Counter(
-            entry=CounterEntry(name="test", labels={}, aud=protos.Audience()),
+        counter = self.metrics.new_counter(
+            CounterEntry(name="test", labels={}, aud=protos.Audience())
         )
         counter.incr(1.0)
-        self.metrics.counters = {"test-test": counter}
 
         worker = threading.Thread(target=self.metrics.run_publisher, daemon=False)
         worker.start()
 
-        time.sleep(2)
+        time.sleep(0.1)
         self.metrics.exit.set()
         worker.join()
+        self.run_loop()
+
+        self.metrics.stub.metrics.assert_called_once()
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert [(m.name, m.value) for m in req.metrics] == [("test", 1.0)]
+        assert counter.val() == 0.0
+
+    def test_flush_batches_counters(self):
+        self.incr_counters(5)
+
+        assert self.metrics.flush() == 1
+        self.run_loop()
+
+        # All counters are sent in a single request
+        self.metrics.stub.metrics.assert_called_once()
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert sorted(m.value for m in req.metrics) == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+        # Nothing left to send
+        assert self.metrics.flush() == 0
+
+    def test_flush_max_batch_size(self):
+        self.metrics.max_batch_size = 2
+        self.incr_counters(5)
+
+        assert self.metrics.flush() == 3
+        self.run_loop()
+
+        sizes = [
+            len(c.args[0].metrics) for c in self.metrics.stub.metrics.call_args_list
+        ]
+        assert sorted(sizes) == [1, 2, 2]
+
+    def test_flush_failure_retried(self):
+        self.metrics.stub.metrics.side_effect = Exception("unavailable")
+        self.incr_counters(2)
+
+        self.metrics.flush()
+        self.run_loop()
+
+        # Values that failed to send are merged with new increments and sent again
+        self.metrics.stub.metrics.side_effect = None
+        self.incr_counters(1)
+
+        self.metrics.flush()
+        self.run_loop()
+
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert sorted(m.value for m in req.metrics) == [2.0, 2.0]
+
+    def test_histogram_buckets(self):
+        for micros in [0, 1, 15, 16, 33, 100, 1000, 123456, 2**32 - 1]:
+            (lower, upper) = bucket_bounds(bucket_index(micros))
+            assert lower <= micros < upper
+            # Buckets are at most 1/16th of their lower bound wide
+            assert upper - lower <= max(1, lower / 16)
+
+        # Durations past the last bucket are clamped
+        assert bucket_index(2**40) == bucket_index(2**32 - 1)
+
+    def test_histogram_snapshot(self):
+        histogram = self.metrics.histogram("test", {"step_type": "detective"})
+
+        for i in range(1, 1001):
+            histogram.observe(i / 1_000_000)  # 1us to 1ms
+
+        snapshot = self.metrics.histogram_snapshots()[0]
+        assert snapshot.name == "test"
+        assert snapshot.count == 1000
+        assert snapshot.sum == pytest.approx(0.5005)
+        assert snapshot.p50 == pytest.approx(0.0005, rel=0.04)
+        assert snapshot.p99 == pytest.approx(0.00099, rel=0.04)
+        assert snapshot.p999 == pytest.approx(0.000999, rel=0.04)
+
+        # The same series is returned for the same name and labels
+        assert self.metrics.histogram("test", {"step_type": "detective"}) is histogram
+
+    def test_histogram_threads(self):
+        histogram = self.metrics.histogram("test", {})
+
+        def work():
+            for _ in range(1000):
+                histogram.observe(0.001)
+
+        workers = [threading.Thread(target=work) for _ in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert histogram.snapshot().count == 4000
+
+        # Samples of exited threads are kept once their shards are dropped
+        self.metrics.merge()
+        assert len(self.metrics.shards) == 0
+        assert len(histogram.parts) == 0
+        assert histogram.snapshot().count == 4000
+
+    def test_flush_histograms(self):
+        histogram = self.metrics.histogram("test", {}, protos.Audience())
+        histogram.observe(0.25)
+        histogram.observe(0.5)
+
+        self.metrics.flush()
+        self.run_loop()
+
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert {m.name: m.value for m in req.metrics} == {
+            "test_count": 2.0,
+            "test_sum": 0.75,
+        }
+
+        # Only samples recorded since the last flush are published
+        histogram.observe(1.0)
+        self.metrics.flush()
+        self.run_loop()
+
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert {m.name: m.value for m in req.metrics} == {
+            "test_count": 1.0,
+            "test_sum": 1.0,
+        }
+
+    def test_snapshot(self):
+        aud = protos.Audience(service_name="test")
+        handle = self.metrics.counter("test", {"pipeline_id": "a"}, aud)
+        histogram = self.metrics.histogram("duration", {}, aud)
+        handle.add(2.0)
+        histogram.observe(0.5)
+        self.metrics.flush()
+        self.run_loop()
+
+        # Totals are kept across publishes, and taking a snapshot publishes nothing
+        handle.add(1.0)
+        self.metrics.merge()
+        snapshot = self.metrics.snapshot()
+        self.metrics.snapshot()
+
+        counters = {c.name: c for c in snapshot.counters}
+        assert counters["test"].value == 3.0
+        assert counters["test"].labels == {"pipeline_id": "a"}
+        assert counters["test"].aud is aud
+        assert counters["duration_count"].value == 1.0
+        assert [(h.name, h.count) for h in snapshot.histograms] == [("duration", 1)]
+
+        self.metrics.flush()
+        self.run_loop()
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert [(m.name, m.value) for m in req.metrics] == [("test", 1.0)]
+
+    def dropped(self, reason: str) -> float:
+        counter = self.metrics.counters.get(
+            counter_key(COUNTER_DROPPED_METRICS, {"reason": reason}, None)
+        )
+        return 0.0 if counter is None else counter.val()
+
+    def test_max_series(self):
+        self.metrics.max_series = 2
+        a = self.metrics.counter("a", {})
+        b = self.metrics.counter("b", {})
+        c = self.metrics.counter("c", {})
+        d = self.metrics.counter("d", {})
+
+        # Increments of counters past the limit are counted as dropped
+        assert isinstance(c, OverflowHandle) and isinstance(d, OverflowHandle)
+        assert self.metrics.counter("a", {}) is a
+
+        a.add(5.0)
+        c.add(5.0)
+        d.add(5.0)
+        self.metrics.merge()
+
+        assert self.metrics.counters[a.key].val() == 5.0
+        assert self.dropped("max_series") == 2.0
+        assert len(self.metrics.handles) == 2
+
+    def test_max_series_distinct(self):
+        self.metrics.max_series = 100
+
+        # A series incremented with a new Audience every time counts once
+        for _ in range(200):
+            self.metrics.incr(
+                CounterEntry(
+                    name="test",
+                    labels={"a": "x", "b": "y"},
+                    value=1.0,
+                    aud=protos.Audience(service_name="test"),
+                )
+            )
+        self.metrics.merge()
+
+        assert len(self.metrics.handles) == 1
+        assert not isinstance(self.metrics.counter("other", {}), OverflowHandle)
+
+    def test_max_series_reaped_handle(self):
+        self.metrics.max_series = 2
+        held = self.metrics.counter("held", {})
+        held.add()
+        self.metrics.take_counters()
+        self.metrics.remove_counter(held.key)
+        self.metrics.remove_handles([held.key])
+
+        # Adding to a handle held past reaping brings its series back, and it counts again
+        held.add()
+        self.metrics.merge()
+        assert self.metrics.handles == {held.key: held}
+
+        assert not isinstance(self.metrics.counter("a", {}), OverflowHandle)
+        assert isinstance(self.metrics.counter("b", {}), OverflowHandle)
+
+    def test_max_series_resolves(self):
+        self.metrics.max_series = 1
+        a = self.metrics.counter("a", {})
+        a.add()
+        self.metrics.merge()
+        self.metrics.take_counters()
+
+        # Held like the handles of a compiled pipeline
+        b = self.metrics.counter("b", {})
+        b.add(5.0)
+        self.metrics.merge()
+        assert self.dropped("max_series") == 1.0
+
+        # Capacity is only checked again in the next generation, after the reaper ran
+        self.metrics.expire()
+        self.metrics.expire()
+        assert self.metrics.handles == {}
+
+        b.add(5.0)
+        self.metrics.merge()
+        assert self.metrics.counters[b.key].val() == 5.0
+        assert self.dropped("max_series") == 1.0
+        assert b.handle is self.metrics.handles[b.key]
+
+    def test_max_pending_hold(self):
+        self.metrics.max_pending = 1
+        self.metrics.max_batch_size = 2
+        self.incr_counters(3)
+
+        # Only one request may be in flight, the remaining value is kept for later
+        assert self.metrics.flush() == 1
+        self.run_loop()
+
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert len(req.metrics) == 2
+
+        assert self.metrics.flush() == 1
+        self.run_loop()
+
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert len(req.metrics) == 1
+
+    def test_max_pending_drop(self):
+        self.metrics.max_pending = 1
+        self.metrics.max_batch_size = 2
+        self.metrics.drop_policy = DROP_POLICY_DROP
+        self.incr_counters(5)
+
+        assert self.metrics.flush() == 1
+        self.metrics.merge()
+
+        # Two batches didn't fit, each counts the values it carried
+        assert self.dropped("max_pending") == 3.0
+
+    def test_publish_failed_drop(self):
+        self.metrics.drop_policy = DROP_POLICY_DROP
+        self.metrics.stub.metrics.side_effect = Exception("unavailable")
+        self.incr_counters(2)
+
+        self.metrics.flush()
+        self.run_loop()
+        self.metrics.merge()
+
+        assert self.dropped("publish_failed") == 2.0
+        assert len(self.metrics.requests) == 0
+
+    def test_shutdown_flushes(self):
+        self.metrics.workers = [
+            threading.Thread(target=self.metrics.run_publisher),
+            threading.Thread(target=self.metrics.run_reaper),
+        ]
+        self.metrics.flush_interval = 10
+        self.metrics.max_batch_size = 2
+        for w in self.metrics.workers:
+            w.start()
+
+        self.incr_counters(5)
+
+        started = time.monotonic()
+        self.metrics.shutdown(timeout=1)
+
+        # Waiting workers are woken up rather than waited out
+        assert time.monotonic() - started < 0.5
+        assert not any(w.is_alive() for w in self.metrics.workers)
+
+        # Everything left is sent in a single request, regardless of max_batch_size
+        self.metrics.stub.metrics.assert_called_once()
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert sorted(m.value for m in req.metrics) == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+    def test_shutdown_timeout(self):
+        async def hang(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        self.metrics.workers = []
+        self.metrics.stub.metrics.side_effect = hang
+        self.incr_counters(1)
+
+        started = time.monotonic()
+        self.metrics.shutdown(timeout=0.1)
+
+        assert time.monotonic() - started < 0.5
+        self.metrics.log.warning.assert_called_once()
+
+    def test_drain_running_loop(self):
+        loop = self.metrics.loop
+        runner = threading.Thread(target=loop.run_forever)
+        runner.start()
+
+        try:
+            self.incr_counters(2)
+            self.metrics.drain(self.metrics.take_counters(), timeout=1)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            runner.join()
+
+        # Sent by the thread running the loop
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert sorted(m.value for m in req.metrics) == [1.0, 2.0]
+
+    def test_flush_running_loop(self):
+        loop = self.metrics.loop
+        runner = threading.Thread(target=loop.run_forever)
+        runner.start()
+
+        # Other calls sharing the loop aren't waited for by drain()
+        other = asyncio.run_coroutine_threadsafe(asyncio.sleep(10), loop)
+
+        try:
+            self.incr_counters(2)
+            assert self.metrics.flush() == 1
+            self.metrics.drain([], timeout=1)
+            assert len(self.metrics.requests) == 0
+        finally:
+            other.cancel()
+            loop.call_soon_threadsafe(loop.stop)
+            runner.join()
+
+        req = self.metrics.stub.metrics.call_args.args[0]
+        assert sorted(m.value for m in req.metrics) == [1.0, 2.0]
+
+    def test_counter_store(self):
+        store = CounterStore(self.metrics.lock, capacity=2)
+        handles = [self.metrics.counter("test", {"id": str(i)}) for i in range(3)]
+
+        ids = [store.add(h) for h in handles]
+        assert ids == [0, 1, 2]
+        assert store.add(handles[1]) == 1
+        assert len(store.values) == len(store.handles) == 4
+
+        store.values[1] = 5.0
+        assert store[handles[1].key].val() == 5.0
+        assert store[handles[1].key].entry is handles[1].entry
+
+        # IDs of removed counters are reused
+        assert store.remove(handles[0].key) == 0
+        assert handles[0].key not in store
+        assert store.add(self.metrics.counter("other", {})) == 0
+        assert store.values[0] == 0.0
+        assert len(store) == 3
+
+    def test_expire(self):
+        idle = self.metrics.counter("idle", {})
+        busy = self.metrics.counter("busy", {})
+        idle.add()
+        busy.add()
+        self.metrics.take_counters()
+
+        # Counters are only expired after a whole generation without increments
+        for _ in range(COUNTER_TTL_GENERATIONS):
+            assert self.metrics.expire() == []
+            busy.add()
+            self.metrics.take_counters()
+
+        assert self.metrics.expire() == [idle.key]
+        assert set(self.metrics.counters) == {busy.key}
+
+        # The handle is no longer cached, but still counts if held on to
+        assert self.metrics.counter("idle", {}) is not idle
+        idle.add(2.0)
+        self.metrics.merge()
+        assert self.metrics.counters[idle.key].val() == 2.0
+
+    def test_expire_keeps_unpublished(self):
+        self.metrics.max_pending = 0
+        handle = self.metrics.counter("test", {})
+        handle.add(3.0)
+
+        # The value can't be sent, so the counter is kept until it is
+        self.metrics.flush()
+        for _ in range(COUNTER_TTL_GENERATIONS + 2):
+            assert self.metrics.expire() == []
+
+        assert self.metrics.counters[handle.key].val() == 3.0
+
+    def test_expire_rotates_shards(self):
+        histogram = self.metrics.histogram("test", {})
+        stale = self.metrics.counter("stale", {})
+        live = self.metrics.counter("live", {})
+        stale.add()
+        live.add()
+        histogram.observe(0.5)
+        self.metrics.take_counters()
+        (shard,) = self.metrics.shards
+
+        for _ in range(COUNTER_TTL_GENERATIONS + 1):
+            live.add()
+            self.metrics.take_counters()
+            self.metrics.expire()
+
+        # The thread moves on to a new shard without the reaped counter's total
+        assert shard.retired
+        live.add()
+        histogram.observe(1.5)
+        assert self.metrics.shard.shard is not shard
+        assert stale not in self.metrics.shard.shard.totals
+
+        self.metrics.merge()
+        self.metrics.merge()
+        assert self.metrics.shards == [self.metrics.shard.shard]
+
+        # Nothing is lost with the retired shard
+        assert self.metrics.counters[live.key].val() == 1.0
+        assert histogram.totals() == (2, 2.0)
+
+    def test_expire_histograms(self):
+        idle = self.metrics.histogram("idle", {})
+        busy = self.metrics.histogram("busy", {})
+        unused = self.metrics.histogram("unused", {})
+        idle.observe(0.5)
+        busy.observe(0.5)
+        self.metrics.take_counters()
+
+        # Histograms are only expired after a whole generation without samples
+        for _ in range(COUNTER_TTL_GENERATIONS):
+            self.metrics.expire()
+            busy.observe(0.5)
+            self.metrics.take_counters()
+
+        assert set(self.metrics.histograms) == {idle.key, busy.key, unused.key}
+        self.metrics.expire()
+        assert set(self.metrics.histograms) == {busy.key}
 
-        assert self.metrics.publish_queue.qsize() == 1
+        # A histogram held on to comes back with its next sample, keeping its totals
+        idle.observe(1.5)
+        assert self.metrics.histograms[idle.key] is idle
+        assert self.metrics.histogram("idle", {}) is idle
+        self.metrics.merge()
+        assert idle.totals() == (2, 2.0)
 
     # TODO: fix broken test
     # def test_run_reaper(self):
@@ -0,0 +1,713 @@
+import os
+import pytest
+import streamdal.common as common
+import streamdal.wasm as wasm
+import streamdal_protos.protos as protos
+import time
+from threading import Lock, Thread
+from wasmtime import Instance, Store
+
+WASM_PAGE_SIZE = 65536
+
+# Minimal module implementing the alloc/dealloc/f ABI expected by the SDK
+WAT = b"""
+(module
+  (memory (export "memory") 1)
+  (global $next (mut i32) (i32.const 1024))
+  (data (i32.const 0) "\\10\\01\\1a\\02ok")
+  (func (export "alloc") (param $len i32) (result i32)
+    (local $ptr i32)
+    (local.set $ptr (global.get $next))
+    (global.set $next (i32.add (global.get $next) (local.get $len)))
+    (if (i32.gt_u (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+      (then
+        (drop (memory.grow
+          (i32.add
+            (i32.div_u
+              (i32.sub (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+              (i32.const 65536))
+            (i32.const 1))))))
+    (local.get $ptr))
+  (func (export "dealloc") (param i32 i32))
+  (func (export "f") (param i32 i32) (result i64)
+    (i64.const 6))
+)
+"""
+
+# Module whose f() never returns
+SPIN_WAT = b"""
+(module
+  (memory (export "memory") 1)
+  (func (export "alloc") (param i32) (result i32)
+    (i32.const 1024))
+  (func (export "dealloc") (param i32 i32))
+  (func (export "f") (param i32 i32) (result i64)
+    (loop $spin (br $spin))
+    (i64.const 0))
+)
+"""
+
+# Module that returns the input payload of a WasmRequest as the output payload of its response,
+# by skipping the step field and rewriting the input_payload tag in place. The result pointer
+# passed to dealloc is kept in the "freed" global.
+PASSTHROUGH_WAT = b"""
+(module
+  (memory (export "memory") 1)
+  (global $next (mut i32) (i32.const 1024))
+  (global $freed (export "freed") (mut i32) (i32.const 0))
+  (func (export "alloc") (param $len i32) (result i32)
+    (local $ptr i32)
+    (local.set $ptr (global.get $next))
+    (global.set $next (i32.add (global.get $next) (local.get $len)))
+    (if (i32.gt_u (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+      (then
+        (drop (memory.grow
+          (i32.add
+            (i32.div_u
+              (i32.sub (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+              (i32.const 65536))
+            (i32.const 1))))))
+    (local.get $ptr))
+  (func (export "dealloc") (param $ptr i32) (param i32)
+    (global.set $freed (local.get $ptr)))
+  (func (export "f") (param $ptr i32) (param $len i32) (result i64)
+    (local $p i32) (local $n i32) (local $shift i32) (local $b i32)
+    (local.set $p (local.get $ptr))
+    (if (i32.eq (i32.load8_u (local.get $p)) (i32.const 0x0a))
+      (then
+        (local.set $p (i32.add (local.get $p) (i32.const 1)))
+        (block $done
+          (loop $next
+            (local.set $b (i32.load8_u (local.get $p)))
+            (local.set $p (i32.add (local.get $p) (i32.const 1)))
+            (local.set $n
+              (i32.or (local.get $n)
+                (i32.shl (i32.and (local.get $b) (i32.const 0x7f)) (local.get $shift))))
+            (local.set $shift (i32.add (local.get $shift) (i32.const 7)))
+            (br_if $next (i32.ge_u (local.get $b) (i32.const 0x80)))))
+        (local.set $p (i32.add (local.get $p) (local.get $n)))))
+    (i32.store8 (local.get $p) (i32.const 0x0a))
+    (i64.or
+      (i64.shl (i64.extend_i32_u (local.get $p)) (i64.const 32))
+      (i64.extend_i32_u
+        (i32.sub (i32.add (local.get $ptr) (local.get $len)) (local.get $p)))))
+)
+"""
+
+
+class TestModuleCache:
+    def test_engine_is_shared(self):
+        assert wasm.get_engine() is wasm.get_engine()
+
+    def test_module_hash(self):
+        assert wasm.module_hash(WAT) == wasm.module_hash(bytes(WAT))
+        assert wasm.module_hash(WAT) != wasm.module_hash(WAT + b" ")
+
+    def test_same_bytes_compile_once(self):
+        cache = wasm.ModuleCache()
+
+        first = cache.get(WAT)
+        second = cache.get(bytes(WAT))
+
+        assert first is second
+        assert len(cache) == 1
+
+    def test_different_bytes_compile_separately(self):
+        cache = wasm.ModuleCache()
+
+        first = cache.get(WAT)
+        second = cache.get(WAT + b" ")
+
+        assert first is not second
+        assert len(cache) == 2
+
+    def test_concurrent_get(self):
+        cache = wasm.ModuleCache()
+        results = []
+
+        workers = [
+            Thread(target=lambda: results.append(cache.get(WAT))) for _ in range(8)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert len(results) == 8
+        assert all(m is results[0] for m in results)
+        assert len(cache) == 1
+
+    def test_register_deduplicates(self):
+        cache = wasm.ModuleCache()
+
+        key = cache.register(WAT)
+
+        assert key == wasm.module_hash(WAT)
+        assert cache.register(bytes(WAT)) == key
+        assert cache.source(key) == WAT
+        assert cache.stats() == {
+            "modules": 0,
+            "source_bytes": len(WAT),
+            "released_bytes": 0,
+            "deduplicated_bytes": len(WAT),
+            "disk_cache_hits": 0,
+            "disk_cache_misses": 0,
+            "disk_cache_evictions": 0,
+        }
+
+    def test_register_deduplicates_once_per_wasm_id(self):
+        cache = wasm.ModuleCache()
+
+        # Setting the same pipelines again saves nothing more
+        key = cache.register(WAT, wasm_id="a")
+        cache.register(bytes(WAT), wasm_id="a")
+        assert cache.stats()["deduplicated_bytes"] == 0
+
+        cache.register(bytes(WAT), wasm_id="b")
+        cache.register(bytes(WAT), wasm_id="b")
+        assert cache.stats()["deduplicated_bytes"] == len(WAT)
+
+        # Forgotten along with the module
+        cache.release([key] * 4)
+        assert cache.registered == {}
+
+    def test_load_releases_source(self):
+        cache = wasm.ModuleCache()
+        key = cache.register(WAT)
+
+        module = cache.load(key)
+
+        assert module is cache.load(key)
+        assert cache.source(key) is None
+        assert cache.stats()["source_bytes"] == 0
+        assert cache.stats()["released_bytes"] == len(WAT)
+
+    def test_load_unregistered(self):
+        cache = wasm.ModuleCache()
+
+        with pytest.raises(common.StreamdalException):
+            cache.load(wasm.module_hash(WAT))
+
+    def test_discard(self):
+        cache = wasm.ModuleCache()
+        key = cache.register(WAT)
+        cache.load(key)
+        other = cache.register(WAT + b" ")
+
+        cache.discard(key)
+        cache.discard(other)
+
+        # Modules stay while registered, bytes that have not been compiled yet too
+        assert len(cache) == 1
+        assert cache.source(other) == WAT + b" "
+
+        cache.release([key])
+        cache.discard(key)
+        assert len(cache) == 0
+        assert cache.load(other) is not None
+
+    def test_release(self):
+        cache = wasm.ModuleCache()
+        key = cache.register(WAT)
+        cache.register(WAT)
+        other = cache.register(WAT + b" ")
+        cache.load(key)
+
+        # Kept until every registration is released
+        cache.release([key, other])
+        assert cache.load(key) is not None
+        assert cache.source(other) is None
+
+        cache.release([key])
+        assert len(cache) == 0
+        assert cache.refs == {}
+        with pytest.raises(common.StreamdalException):
+            cache.load(key)
+
+    def test_shared_bytes_discard(self):
+        cache = wasm.ModuleCache()
+
+        # Two wasm_ids with the same bytes, the first is compiled and its pool evicted
+        key = cache.register(WAT)
+        assert cache.register(bytes(WAT)) == key
+        cache.load(key)
+        cache.release([key])
+        cache.discard(key)
+
+        # The other one is still registered and loads
+        assert cache.load(key) is not None
+
+
+class TestDiskCache:
+    def test_cold_then_warm_start(self, tmp_path):
+        disk = wasm.DiskCache(str(tmp_path))
+
+        # First process start: nothing on disk, module is compiled and written out
+        cold = wasm.ModuleCache(disk=disk)
+        cold.get(WAT)
+
+        assert disk.stats() == {"hits": 0, "misses": 1, "evictions": 0}
+        assert os.path.exists(disk.file_path(wasm.module_hash(WAT)))
+
+        # Later process start: module is deserialized from disk instead of recompiled
+        warm = wasm.ModuleCache(disk=disk)
+        module = warm.get(WAT)
+
+        assert module is not None
+        assert [e.name for e in module.exports] == ["memory", "alloc", "dealloc", "f"]
+        assert disk.stats() == {"hits": 1, "misses": 1, "evictions": 0}
+        assert warm.stats()["disk_cache_hits"] == 1
+        assert warm.stats()["disk_cache_misses"] == 1
+
+    def test_key_includes_engine_fingerprint(self, tmp_path):
+        disk = wasm.DiskCache(str(tmp_path))
+        path = disk.file_path("abc")
+
+        assert os.path.basename(path).startswith("abc.")
+        assert wasm.engine_fingerprint() in path
+
+    def test_corrupt_file_is_discarded(self, tmp_path):
+        disk = wasm.DiskCache(str(tmp_path))
+        path = disk.file_path(wasm.module_hash(WAT))
+        with open(path, "wb") as f:
+            f.write(b"not a module")
+
+        cache = wasm.ModuleCache(disk=disk)
+
+        assert cache.get(WAT) is not None
+        assert disk.stats()["misses"] == 1
+        assert os.path.getsize(path) > len(b"not a module")
+
+    def test_eviction(self, tmp_path):
+        disk = wasm.DiskCache(str(tmp_path), max_bytes=1)
+        cache = wasm.ModuleCache(disk=disk)
+
+        cache.get(WAT)
+        cache.get(WAT + b" ")
+
+        # Budget is smaller than a single module, so everything is evicted
+        assert disk.stats()["evictions"] == 2
+        assert [n for n in os.listdir(tmp_path) if n.endswith(".cwasm")] == []
+
+
+class TestInstancePool:
+    @staticmethod
+    def new_pool(max_size: int, **kwargs) -> wasm.InstancePool:
+        engine = wasm.get_engine()
+        module = wasm.modules.get(WAT)
+
+        def factory():
+            store = Store(engine)
+            return wasm.WasmInstance(Instance(store, module, []), store)
+
+        return wasm.InstancePool(factory, max_size, **kwargs)
+
+    def test_invalid_size(self):
+        with pytest.raises(ValueError, match="max_size must be at least 1"):
+            wasm.InstancePool(lambda: None, 0)
+
+    def test_reuses_instances(self):
+        pool = self.new_pool(2)
+
+        with pool.instance() as first:
+            pass
+        with pool.instance() as second:
+            pass
+
+        assert first is second
+        assert pool.stats()["size"] == 1
+        assert pool.stats()["checkouts"] == 2
+
+    def test_instance_exports(self):
+        pool = self.new_pool(1)
+
+        with pool.instance() as inst:
+            ptr = inst.alloc(inst.store, 16)
+            assert ptr == 1024
+            assert inst.func("f")(inst.store, ptr, 16) == 6
+            assert inst.func("f") is inst.func("f")
+
+    def test_bounded_under_contention(self):
+        pool = self.new_pool(2)
+        in_use = []
+        peak = []
+        lock = Lock()
+
+        def work():
+            for _ in range(20):
+                with pool.instance() as inst:
+                    with lock:
+                        in_use.append(inst)
+                        peak.append(len(in_use))
+                    time.sleep(0.001)
+                    with lock:
+                        in_use.remove(inst)
+
+        workers = [Thread(target=work) for _ in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        stats = pool.stats()
+        assert max(peak) <= 2
+        assert stats["size"] <= 2
+        assert stats["in_use"] == 0
+        assert stats["checkouts"] == 160
+        assert stats["waits"] > 0
+
+    def test_discard_frees_slot(self):
+        pool = self.new_pool(1)
+
+        inst = pool.checkout()
+        pool.discard(inst)
+
+        assert pool.stats()["size"] == 0
+        assert pool.checkout() is not inst
+
+    def test_factory_failure_frees_slot(self):
+        def factory():
+            raise Exception("instantiation failed")
+
+        pool = wasm.InstancePool(factory, 1)
+
+        with pytest.raises(Exception, match="instantiation failed"):
+            pool.checkout()
+
+        assert pool.stats()["size"] == 0
+
+    def test_recycle_after_max_calls(self):
+        pool = self.new_pool(1, max_calls=2)
+
+        inst = pool.checkout()
+        inst.calls = 1
+        assert pool.checkin(inst) is False
+        assert pool.checkout() is inst
+
+        inst.calls = 2
+        assert pool.checkin(inst) is True
+
+        assert pool.stats()["recycles"] == 1
+        assert pool.stats()["size"] == 0
+        assert pool.checkout() is not inst
+
+    def test_recycle_over_max_memory(self):
+        pool = self.new_pool(1, max_memory=WASM_PAGE_SIZE)
+
+        inst = pool.checkout()
+        assert pool.checkin(inst) is False
+
+        inst = pool.checkout()
+        inst.memory.grow(inst.store, 1)
+        assert pool.checkin(inst) is True
+
+        assert pool.stats()["recycles"] == 1
+        assert pool.stats()["resident_bytes"] == 0
+
+        # The replacement starts out with the module's initial memory
+        with pool.instance() as fresh:
+            assert fresh is not inst
+            assert fresh.memory.data_len(fresh.store) == WASM_PAGE_SIZE
+
+    def test_recycling_disabled(self):
+        pool = self.new_pool(1)
+
+        inst = pool.checkout()
+        inst.calls = 1_000_000
+        inst.memory.grow(inst.store, 1)
+
+        assert pool.checkin(inst) is False
+        assert pool.stats()["recycles"] == 0
+
+    def test_instance_stats(self):
+        pool = self.new_pool(2)
+
+        with pool.instance() as inst:
+            inst.calls = 3
+
+        assert pool.stats()["instances"] == [
+            {"calls": 3, "memory_bytes": WASM_PAGE_SIZE}
+        ]
+
+
+class TestEncodeWasmRequest:
+    def _encode(self, step, payload, isr):
+        return wasm.encode_wasm_request(
+            wasm.encode_step(bytes(step)),
+            payload,
+            None if isr is None else bytes(isr),
+        )
+
+    @pytest.mark.parametrize(
+        "payload",
+        [b"", b"{}", b"x" * 127, b"x" * 128, b"x" * 20000, b"x" * 3_000_000],
+    )
+    @pytest.mark.parametrize(
+        "isr",
+        [
+            None,
+            protos.InterStepResult(),
+            protos.InterStepResult(
+                detective_result=protos.steps.DetectiveStepResult(
+                    matches=[protos.steps.DetectiveStepResultMatch(path="a.b")]
+                )
+            ),
+        ],
+    )
+    def test_matches_betterproto(self, payload, isr):
+        step = protos.PipelineStep(
+            name="detective",
+            wasm_function="f",
+            detective=protos.steps.DetectiveStep(path="object.field", args=["a"]),
+        )
+
+        req = protos.WasmRequest(
+            step=step, input_payload=payload, inter_step_result=isr
+        )
+
+        assert self._encode(step, payload, isr) == bytes(req)
+
+    def test_empty_step(self):
+        req = protos.WasmRequest(step=protos.PipelineStep(), input_payload=b"data")
+
+        assert wasm.encode_step(b"") == b""
+        assert self._encode(protos.PipelineStep(), b"data", None) == bytes(req)
+
+    def test_roundtrip(self):
+        step = protos.PipelineStep(
+            name="s", detective=protos.steps.DetectiveStep(path="x")
+        )
+        data = wasm.encode_wasm_request(wasm.encode_step(bytes(step)), b"payload")
+
+        req = protos.WasmRequest().parse(data)
+        assert req.step.name == "s"
+        assert req.step.detective.path == "x"
+        assert req.input_payload == b"payload"
+        assert req.inter_step_result is None
+
+
+class TestDecodeWasmResponse:
+    @pytest.mark.parametrize(
+        "resp",
+        [
+            protos.WasmResponse(),
+            protos.WasmResponse(
+                exit_code=protos.WasmExitCode.WASM_EXIT_CODE_FALSE, exit_msg="nope ✗"
+            ),
+            protos.WasmResponse(
+                output_payload=b"x" * 200,
+                exit_code=protos.WasmExitCode.WASM_EXIT_CODE_TRUE,
+                output_step=b'{"type": "object"}',
+                inter_step_result=protos.InterStepResult(
+                    detective_result=protos.steps.DetectiveStepResult(
+                        matches=[protos.steps.DetectiveStepResultMatch(path="a.b")]
+                    )
+                ),
+            ),
+        ],
+    )
+    def test_matches_betterproto(self, resp):
+        data = bytes(resp)
+
+        assert wasm.decode_wasm_response(data) == protos.WasmResponse().parse(data)
+        assert wasm.decode_wasm_response(memoryview(data)) == resp
+
+    def test_skips_unknown_fields(self):
+        # field 9 varint, field 10 bytes, field 11 fixed64 before exit_code=1
+        data = b"\x48\x05\x52\x01z\x59" + b"\x00" * 8 + b"\x10\x01"
+
+        assert wasm.decode_wasm_response(data).exit_code == 1
+
+    def test_truncated(self):
+        with pytest.raises(common.StreamdalException):
+            wasm.decode_wasm_response(b"\x0a\x05abc")
+
+
+class TestCall:
+    @pytest.fixture(autouse=True)
+    def before_each(self):
+        self.store = Store(wasm.get_engine())
+        module = wasm.modules.get(PASSTHROUGH_WAT)
+        self.inst = wasm.WasmInstance(Instance(self.store, module, []), self.store)
+
+    def test_call_raw(self):
+        data = wasm.encode_wasm_request(b"", b"payload")
+
+        # The tag is rewritten to output_payload by the module
+        assert wasm.call(self.inst, "f", data) == b"\x0a" + data[1:]
+        assert self.inst.calls == 1
+
+    @pytest.mark.parametrize("size", [1, 1000, 3_000_000])
+    def test_call_step(self, size):
+        payload = os.urandom(size)
+        step_field = wasm.encode_step(
+            bytes(protos.PipelineStep(name="passthrough", wasm_function="f"))
+        )
+
+        resp = wasm.call_step(self.inst, "f", step_field, payload)
+
+        assert resp.output_payload == payload
+        assert type(resp.output_payload) is bytes
+
+        # dealloc gets the unpacked result pointer, not the packed i64
+        freed = self.inst.exports["freed"].value(self.store)
+        assert 1024 < freed < self.inst.memory.data_len(self.store)
+
+    def test_output_outlives_memory(self):
+        resp = wasm.call_step(self.inst, "f", b"", b"first")
+        wasm.call_step(self.inst, "f", b"", b"second")
+
+        assert resp.output_payload == b"first"
+
+
+class TestTimeout:
+    @pytest.fixture(autouse=True)
+    def before_each(self):
+        self.store = Store(wasm.get_engine())
+        module = wasm.modules.get(SPIN_WAT)
+        self.inst = wasm.WasmInstance(Instance(self.store, module, []), self.store)
+
+    def test_deadline_ticks(self):
+        assert wasm.deadline_ticks(None) == wasm.NO_DEADLINE
+        assert wasm.deadline_ticks(0.01) * wasm.EPOCH_TICK_INTERVAL > 0.01
+        assert wasm.deadline_ticks(0.000001) == 2
+
+    def test_interrupts_call(self):
+        started = time.monotonic()
+
+        with pytest.raises(common.TimeoutException, match="20ms"):
+            wasm.call_step(self.inst, "f", b"", b"payload", timeout=0.02)
+
+        elapsed = time.monotonic() - started
+        assert 0.02 <= elapsed < 1
+
+    def test_ticker_stops(self):
+        with pytest.raises(common.TimeoutException):
+            wasm.call_step(self.inst, "f", b"", b"payload", timeout=0.001)
+        assert wasm._ticker is not None
+
+        # Stopped with no call running, the next call with a timeout starts it again
+        wasm.stop_epoch_ticker(timeout=1)
+        assert wasm._ticker is None
+
+        with pytest.raises(common.TimeoutException):
+            wasm.call_step(self.inst, "f", b"", b"payload", timeout=0.001)
+        assert wasm._ticker.is_alive()
+
+    def test_expired_before_start(self):
+        with pytest.raises(common.TimeoutException, match="before it started"):
+            wasm.call(self.inst, "f", b"payload", timeout=-0.001)
+
+        assert self.inst.calls == 0
+
+    def test_no_timeout_after_deadline_call(self):
+        store = Store(wasm.get_engine())
+        module = wasm.modules.get(PASSTHROUGH_WAT)
+        inst = wasm.WasmInstance(Instance(store, module, []), store)
+
+        wasm.call_step(inst, "f", b"", b"first", timeout=0.001)
+        time.sleep(0.01)
+
+        # The deadline of the previous call does not carry over to calls without one
+        assert wasm.call_step(inst, "f", b"", b"second").output_payload == b"second"
+
+
+class TestFunctionCache:
+    @staticmethod
+    def new_pool() -> wasm.InstancePool:
+        engine = wasm.get_engine()
+        module = wasm.modules.get(WAT)
+
+        def factory():
+            store = Store(engine)
+            return wasm.WasmInstance(Instance(store, module, []), store)
+
+        pool = wasm.InstancePool(factory, 2)
+        pool.checkin(pool.checkout())
+        return pool
+
+    def test_release_evicts(self):
+        cache = wasm.FunctionCache(max_unused=0)
+        cache.acquire(["a"])
+        pool = cache.setdefault("a", self.new_pool())
+
+        assert cache.get("a") is pool
+        assert cache.stats()["referenced"] == 1
+
+        assert cache.release(["a"]) == 1
+        assert "a" not in cache
+        assert pool.closed
+        assert pool.stats()["size"] == 0
+        assert cache.stats()["evictions"] == 1
+
+    def test_refcount(self):
+        cache = wasm.FunctionCache(max_unused=0)
+        cache.acquire(["a"])
+        cache.acquire(["a"])
+        cache.setdefault("a", self.new_pool())
+
+        assert cache.release(["a"]) == 0
+        assert "a" in cache
+        assert cache.release(["a"]) == 1
+
+    def test_lru_count_budget(self):
+        cache = wasm.FunctionCache(max_unused=2)
+        for wasm_id in ("a", "b", "c"):
+            cache.acquire([wasm_id])
+            cache.setdefault(wasm_id, self.new_pool())
+
+        cache.release(["a", "b"])
+        cache.get("a")  # a is now more recently used than b
+        cache.release(["c"])
+
+        assert "b" not in cache
+        assert "a" in cache and "c" in cache
+        assert cache.stats()["unused"] == 2
+
+    def test_unreferenced_pools_count_as_unused(self):
+        cache = wasm.FunctionCache(max_unused=1)
+        cache.setdefault("a", self.new_pool())
+        cache.setdefault("b", self.new_pool())
+
+        assert "a" not in cache
+        assert "b" in cache
+
+    def test_bytes_budget(self):
+        pool = self.new_pool()
+        resident = pool.resident_bytes()
+        assert resident == 65536
+
+        cache = wasm.FunctionCache(max_unused=10, max_unused_bytes=resident)
+        for wasm_id in ("a", "b"):
+            cache.acquire([wasm_id])
+            cache.setdefault(wasm_id, self.new_pool())
+
+        assert cache.stats()["resident_bytes"] == 2 * resident
+
+        cache.release(["a"])
+        assert "a" in cache
+
+        cache.release(["b"])
+        assert "a" not in cache
+        assert cache.stats()["resident_bytes"] == resident
+
+    def test_evicts_compiled_module(self):
+        module_wat = WAT.replace(b"(i64.const 6)", b"(i64.const 7)")
+        key = wasm.module_hash(module_wat)
+        wasm.modules.get(module_wat)
+
+        cache = wasm.FunctionCache(max_unused=0)
+        cache.setdefault("a", self.new_pool(), key)
+
+        assert key not in wasm.modules.modules
+
+    def test_close_pool_with_instance_in_use(self):
+        pool = self.new_pool()
+        inst = pool.checkout()
+
+        pool.close()
+        assert pool.stats()["idle"] == 0
+
+        pool.checkin(inst)
+        assert pool.stats()["size"] == 0
+        assert pool.resident_bytes() == 0
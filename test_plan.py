@@ -0,0 +1,168 @@
+import pytest
+import streamdal.metrics as metrics
+import streamdal.plan as plan
+import streamdal.wasm as wasm
+import streamdal_protos.protos as protos
+
+
+def new_counter(name: str, labels: dict, aud: protos.Audience):
+    """Stand-in for Metrics.counter(), returns the entry the handle would be built from"""
+    return metrics.CounterEntry(name=name, labels=labels, aud=aud)
+
+
+class TestPlan:
+    @pytest.fixture(autouse=True)
+    def before_each(self):
+        self.aud = protos.Audience(
+            component_name="kafka",
+            service_name="testing",
+            operation_name="test-topic",
+            operation_type=protos.OperationType.OPERATION_TYPE_PRODUCER,
+        )
+
+        self.step = protos.PipelineStep(
+            name="detective",
+            wasm_id="some-id",
+            wasm_bytes=b"module",
+            wasm_function="f",
+            on_false=protos.PipelineStepConditions(
+                abort=protos.AbortCondition.ABORT_CONDITION_ABORT_CURRENT,
+                notify=True,
+                metadata={"key": "value"},
+            ),
+            on_error=protos.PipelineStepConditions(
+                abort=protos.AbortCondition.ABORT_CONDITION_ABORT_ALL,
+            ),
+            detective=protos.steps.DetectiveStep(path="object.field"),
+        )
+
+        self.cmd = protos.Command(
+            audience=self.aud,
+            set_pipelines=protos.SetPipelinesCommand(
+                pipelines=[
+                    protos.Pipeline(id="one", name="first", steps=[self.step]),
+                    protos.Pipeline(id="two", name="second"),
+                ]
+            ),
+        )
+
+    def test_counter_names(self):
+        assert plan.counter_names(1) == plan.CONSUMER_COUNTERS
+        assert plan.counter_names(2) == plan.PRODUCER_COUNTERS
+        assert plan.PRODUCER_COUNTERS.errors == metrics.COUNTER_PRODUCE_ERRORS
+
+    def test_compile_condition(self):
+        cond = plan.compile_condition(self.step.on_false)
+
+        assert cond.notify is True
+        assert cond.metadata == {"key": "value"}
+        assert cond.abort_current is True
+        assert cond.abort_all is False
+
+        empty = plan.compile_condition(None)
+        assert empty.notify is False
+        assert empty.metadata == {}
+        assert not empty.abort_current and not empty.abort_all
+
+    def test_compile_step(self):
+        step = plan.compile_step(self.step)
+
+        assert step.name == "detective"
+        assert step.step_type == "detective"
+        assert step.infer_schema is False
+        assert step.timeout_exempt is False
+        assert step.wasm_id == "some-id"
+        assert step.wasm_function == "f"
+        assert step.on_error.abort_all is True
+        assert step.on_true.abort == protos.AbortCondition.ABORT_CONDITION_UNSET
+        assert step.function is None
+
+        # Module bytes live in the module registry, the step only refers to them by hash
+        assert not step.step.wasm_bytes
+        assert step.module_key == wasm.module_hash(b"module")
+        assert wasm.modules.source(step.module_key) == b"module"
+        assert step.step.detective.path == "object.field"
+        assert step.request_step_field == bytes(protos.WasmRequest(step=step.step))
+
+        # The original step is left untouched
+        assert self.step.wasm_bytes == b"module"
+
+    def test_compile_step_without_module(self):
+        step = plan.compile_step(protos.PipelineStep(name="no-module"))
+
+        assert step.module_key is None
+
+    def test_compile_http_request_step(self):
+        step = plan.compile_step(
+            protos.PipelineStep(
+                name="http", http_request=protos.steps.HttpRequestStep()
+            )
+        )
+
+        assert step.timeout_exempt is True
+
+    def test_compile_infer_schema_step(self):
+        step = plan.compile_step(
+            protos.PipelineStep(
+                name="schema", infer_schema=protos.steps.InferSchemaStep()
+            )
+        )
+
+        assert step.infer_schema is True
+
+    def test_compile_pipelines(self):
+        aud_plan = plan.compile_pipelines(self.cmd, "testing", new_counter, new_counter)
+
+        assert len(aud_plan) == 2
+        assert [p.id for p in aud_plan] == ["one", "two"]
+        assert aud_plan.rate_bytes.name == metrics.COUNTER_PRODUCE_BYTES_RATE
+        assert aud_plan.rate_processed.labels == {}
+
+        pipeline = aud_plan.pipelines[0]
+        assert len(pipeline.steps) == 1
+        assert pipeline.labels == {
+            "service": "testing",
+            "component": "kafka",
+            "operation": "test-topic",
+            "pipeline_name": "first",
+            "pipeline_id": "one",
+        }
+        assert pipeline.processed.name == metrics.COUNTER_PRODUCE_PROCESSED
+        assert pipeline.errors.name == metrics.COUNTER_PRODUCE_ERRORS
+        assert pipeline.errors.labels is pipeline.labels
+        assert pipeline.timeouts.name == metrics.COUNTER_PRODUCE_TIMEOUTS
+        assert pipeline.recycles.name == metrics.COUNTER_WASM_RECYCLES
+        assert pipeline.recycles.labels is pipeline.labels
+        assert pipeline.bytes.name == metrics.COUNTER_PRODUCE_BYTES
+        assert pipeline.bytes.labels is pipeline.labels
+        assert pipeline.duration.name == metrics.HISTOGRAM_PIPELINE_SECONDS
+        assert pipeline.steps[0].duration.name == metrics.HISTOGRAM_STEP_SECONDS
+        assert pipeline.steps[0].duration.labels == {
+            "service": "testing",
+            "component": "kafka",
+            "operation": "test-topic",
+            "step_type": "detective",
+        }
+        assert aud_plan.duration.name == metrics.HISTOGRAM_PROCESS_SECONDS
+
+        # Each pipeline gets its own labels
+        assert aud_plan.pipelines[1].labels["pipeline_id"] == "two"
+
+    def test_compile_pipelines_releases_module_bytes(self):
+        aud_plan = plan.compile_pipelines(self.cmd, "testing", new_counter, new_counter)
+
+        pipeline = aud_plan.pipelines[0]
+        assert not pipeline.pipeline.steps[0].wasm_bytes
+        assert pipeline.pipeline.steps[0] is pipeline.steps[0].step
+        assert [s.module_key for s in aud_plan.wasm_steps()] == [
+            wasm.module_hash(b"module")
+        ]
+
+        # The command keeps its bytes, the plan does not
+        assert self.cmd.set_pipelines.pipelines[0].steps[0].wasm_bytes == b"module"
+
+        # The registration is released with the plan
+        assert aud_plan.module_keys == (wasm.module_hash(b"module"),)
+        refs = wasm.modules.refs[aud_plan.module_keys[0]]
+        wasm.modules.release(aud_plan.module_keys)
+        assert wasm.modules.refs.get(aud_plan.module_keys[0], 0) == refs - 1
@@ -0,0 +1,168 @@
+import pytest
+import streamdal.common as common
+import streamdal.procpool as procpool
+import streamdal_protos.protos as protos
+from streamdal.kv import KV
+from test_module_cache import SPIN_WAT, WAT
+
+# Module whose f() checks whether the key "test" exists using the kvExists host function
+# and returns the encoded KvStepResponse
+KV_WAT = b"""
+(module
+  (import "env" "kvExists" (func $kv_exists (param i32 i32) (result i64)))
+  (memory (export "memory") 1)
+  (global $next (mut i32) (i32.const 1024))
+  (data (i32.const 0) "\\1a\\04test")
+  (func (export "alloc") (param $len i32) (result i32)
+    (local $ptr i32)
+    (local.set $ptr (global.get $next))
+    (global.set $next (i32.add (global.get $next) (local.get $len)))
+    (if (i32.gt_u (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+      (then
+        (drop (memory.grow
+          (i32.add
+            (i32.div_u
+              (i32.sub (global.get $next) (i32.mul (memory.size) (i32.const 65536)))
+              (i32.const 65536))
+            (i32.const 1))))))
+    (local.get $ptr))
+  (func (export "dealloc") (param i32 i32))
+  (func (export "f") (param i32 i32) (result i64)
+    (call $kv_exists (i32.const 0) (i32.const 6)))
+)
+"""
+
+
+class TestProcessPool:
+    pool: procpool.ProcessPool
+
+    @pytest.fixture(autouse=True)
+    def before_each(self):
+        kv = KV()
+        kv.purge()
+
+        self.kv = kv
+        self.pool = procpool.ProcessPool(2, kv=kv, slot_size=64 * 1024)
+        yield
+        self.pool.shutdown()
+
+    def kv_exists(self) -> bool:
+        res = self.pool.execute("kv", "f", b"")
+        resp = protos.steps.KvStepResponse().parse(res)
+        return resp.status == protos.steps.KvStatus.KV_STATUS_SUCCESS
+
+    def test_execute(self):
+        self.pool.register("test", WAT)
+
+        res = self.pool.execute("test", "f", b"payload")
+        resp = protos.WasmResponse().parse(res)
+
+        assert resp.exit_code == protos.WasmExitCode.WASM_EXIT_CODE_TRUE
+        assert resp.exit_msg == "ok"
+
+    def test_execute_payload_larger_than_slot(self):
+        self.pool.register("test", WAT)
+
+        res = self.pool.execute("test", "f", bytes(128 * 1024))
+
+        assert protos.WasmResponse().parse(res).exit_msg == "ok"
+
+    def test_load(self):
+        self.pool.register("test", WAT)
+        self.pool.load("test")
+
+        key = self.pool.modules["test"][0]
+        assert all(key in worker.loaded for worker in self.pool.workers)
+
+        res = self.pool.execute("test", "f", b"payload")
+        assert protos.WasmResponse().parse(res).exit_msg == "ok"
+
+    def test_unregister(self):
+        self.pool.register("test", WAT)
+        self.pool.register("same", bytes(WAT))
+        self.pool.load("test")
+        key = self.pool.modules["test"][0]
+
+        # Workers keep the module while another wasm_id has the same bytes
+        self.pool.unregister("test")
+        assert "test" not in self.pool.modules
+        assert all(key in worker.loaded for worker in self.pool.workers)
+
+        self.pool.unregister("same")
+        assert self.pool.modules == {}
+        assert not any(key in worker.loaded for worker in self.pool.workers)
+
+        with pytest.raises(common.StreamdalException, match="is not registered"):
+            self.pool.execute("test", "f", b"")
+
+        # Registering it again sends the bytes to the workers again
+        self.pool.register("test", WAT)
+        res = self.pool.execute("test", "f", b"payload")
+        assert protos.WasmResponse().parse(res).exit_msg == "ok"
+
+    def test_load_failure(self):
+        self.pool.register("bad", b"not a wasm module")
+        self.pool.load("bad")
+
+        # The failure is reported when the module is used
+        with pytest.raises(common.StreamdalException, match="not loaded"):
+            self.pool.execute("bad", "f", b"")
+
+    def test_execute_unregistered(self):
+        with pytest.raises(common.StreamdalException, match="is not registered"):
+            self.pool.execute("missing", "f", b"")
+
+    def test_execute_error(self):
+        self.pool.register("test", WAT)
+
+        with pytest.raises(common.StreamdalException):
+            self.pool.execute("test", "missing_function", b"")
+
+        # Worker is still usable afterwards
+        assert (
+            protos.WasmResponse().parse(self.pool.execute("test", "f", b"")).exit_code
+            == 1
+        )
+
+    def test_execute_timeout(self):
+        self.pool.register("spin", SPIN_WAT)
+        self.pool.register("test", WAT)
+
+        with pytest.raises(common.TimeoutException):
+            self.pool.execute("spin", "f", b"", timeout=0.05)
+
+        # The interrupted instance is replaced, the worker keeps serving requests
+        with pytest.raises(common.TimeoutException):
+            self.pool.execute("spin", "f", b"", timeout=0.05)
+
+        res = self.pool.execute("test", "f", b"", timeout=1)
+        assert protos.WasmResponse().parse(res).exit_code == 1
+
+    def test_kv_mirror(self):
+        self.pool.register("kv", KV_WAT)
+
+        # Run enough calls to reach every worker
+        assert not any(self.kv_exists() for _ in range(4))
+
+        self.kv.set("test", "value")
+        self.pool.kv_set("test", "value")
+        assert all(self.kv_exists() for _ in range(4))
+
+        self.pool.kv_delete("test")
+        assert not any(self.kv_exists() for _ in range(4))
+
+        self.pool.kv_set("test", "value")
+        self.pool.kv_purge()
+        assert not any(self.kv_exists() for _ in range(4))
+
+    def test_new_worker_gets_kv_snapshot(self):
+        self.kv.set("test", "value")
+        self.pool.register("kv", KV_WAT)
+
+        # Replace the workers and make sure new ones start with the current KV contents
+        workers = [self.pool.pool.checkout() for _ in range(2)]
+        for worker in workers:
+            self.pool.pool.discard(worker)
+            self.pool._stop_worker(worker)
+
+        assert all(self.kv_exists() for _ in range(4))
@@ -0,0 +1,76 @@
+import asyncio
+import concurrent.futures
+import pytest
+import threading
+from streamdal.reactor import Reactor
+
+
+class TestReactor:
+    reactor: Reactor
+
+    @pytest.fixture(autouse=True)
+    def before_each(self):
+        # The channel only connects once a call is made
+        self.reactor = Reactor("localhost", 8082)
+        self.reactor.start()
+        yield
+        self.reactor.stop()
+
+    def test_call(self):
+        async def call():
+            return threading.current_thread().name
+
+        # Coroutines run on the reactor's thread
+        assert self.reactor.call(call(), timeout=1) == "streamdal-io"
+        assert self.reactor.submit(call()).result(timeout=1) == "streamdal-io"
+
+    def test_call_timeout(self):
+        cancelled = threading.Event()
+
+        async def call():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(concurrent.futures.TimeoutError):
+            self.reactor.call(call(), timeout=0.05)
+
+        assert cancelled.wait(1)
+
+    def test_stop(self):
+        started = threading.Event()
+
+        async def call():
+            started.set()
+            await asyncio.sleep(10)
+
+        future = self.reactor.submit(call())
+        assert started.wait(1)
+
+        # Calls still running are cancelled
+        self.reactor.stop(timeout=1)
+
+        assert not self.reactor.thread.is_alive()
+        assert future.cancelled()
+        assert self.reactor.loop.is_closed()
+
+    def test_submit_after_stop(self):
+        ran = threading.Event()
+
+        async def call():
+            ran.set()
+
+        self.reactor.stop(timeout=1)
+        assert self.reactor.loop.is_closed()
+
+        # The coroutine is closed rather than scheduled on the closed loop
+        coro = call()
+        future = self.reactor.submit(coro)
+        assert future.cancelled()
+        assert coro.cr_frame is None
+        assert not ran.is_set()
+
+        with pytest.raises(concurrent.futures.CancelledError):
+            self.reactor.call(call(), timeout=1)
@@ -1,8 +1,12 @@
 import pytest
+import threading
 import streamdal.common as common
+import streamdal.plan as plan
 import streamdal_protos.protos as protos
 import uuid
 import unittest.mock as mock
+import streamdal.wasm as wasm
+from concurrent.futures import ThreadPoolExecutor
 from streamdal import StreamdalClient, StreamdalConfig
 
 
@@ -14,8 +18,15 @@ class TestStreamdalRegisterMethods:
         client = object.__new__(StreamdalClient)
         client.cfg = StreamdalConfig(service_name="testing")
         client.pipelines = {}
+        client.pending_pipelines = {}
+        client.routes = {}
+        client.audience_registry = common.AudienceRegistry()
+        client.pipelines_lock = threading.Lock()
+        client.warmup_pool = ThreadPoolExecutor(max_workers=1)
+        client.functions = wasm.FunctionCache()
         client.paused_pipelines = {}
         client.log = mock.Mock()
+        client.metrics = mock.Mock()
 
         self.client = client
 
@@ -43,3 +54,5 @@ class TestStreamdalRegisterMethods:
         aud_str = common.aud_to_str(cmd.audience)
         assert self.client.pipelines[aud_str] is not None
         assert len(self.client.pipelines[aud_str]) == 1
+        assert isinstance(self.client.pipelines[aud_str], plan.AudiencePlan)
+        assert self.client.pipelines[aud_str].pipelines[0].id == pipeline_id
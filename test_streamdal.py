@@ -1,12 +1,17 @@
 import asyncio
+import queue
 import streamdal.common as common
+import streamdal.plan as plan
 import threading
 import pytest
 import streamdal_protos.protos as protos
 import uuid
 import unittest.mock as mock
 import streamdal
+import streamdal.wasm as wasm
+from concurrent.futures import ThreadPoolExecutor
 from streamdal import StreamdalClient, StreamdalConfig
+from streamdal.reactor import Reactor
 from streamdal.tail import Tail
 
 
@@ -17,18 +22,23 @@ class TestStreamdalClient:
     def before_each(self):
         client = object.__new__(StreamdalClient)
         client.cfg = StreamdalConfig(service_name="testing")
-        client.grpc_loop = asyncio.get_event_loop()
+        client.reactor = Reactor("localhost", 8082)
+        client.reactor.start()
         client.log = mock.Mock()
         client.metrics = mock.Mock()
         client.grpc_stub = mock.AsyncMock()
-        client.register_stub = mock.AsyncMock()
-        client.grpc_loop = asyncio.get_event_loop()
-        client.register_loop = asyncio.get_event_loop()
         client.grpc_timeout = 5
         client.auth_token = "test"
         client.exit = threading.Event()
         client.session_id = uuid.uuid4().__str__()
         client.pipelines = {}
+        client.pending_pipelines = {}
+        client.routes = {}
+        client.audience_registry = common.AudienceRegistry()
+        client.pipelines_lock = threading.Lock()
+        client.warmup_pool = ThreadPoolExecutor(max_workers=1)
+        client.functions = wasm.FunctionCache()
+        client.process_pool = None
         client.paused_pipelines = {}
         client.audiences = {}
         client.tails = {}
@@ -36,6 +46,9 @@ class TestStreamdalClient:
         client.schemas = {}
 
         self.client = client
+        yield
+        client.reactor.stop()
+        client.warmup_pool.shutdown()
 
     def test_process_validation(self):
         with pytest.raises(ValueError, match="req is required"):
@@ -59,7 +72,122 @@ class TestStreamdalClient:
 
         assert res is not None
         assert res.data == payload_bytes
-        fake_metrics.incr.assert_called_once()
+        fake_metrics.counter.assert_called_once()
+        fake_metrics.counter.return_value.add.assert_called_once_with(1.0)
+
+    def test_process_passthrough(self):
+        req = streamdal.ProcessRequest(
+            data=b'{"object": {"type": "streamdal"}}',
+            operation_type=streamdal.OPERATION_TYPE_CONSUMER,
+            component_name="kafka",
+            operation_name="no-pipelines",
+        )
+
+        results = [self.client.process(req) for _ in range(3)]
+
+        res = results[0]
+        assert isinstance(res, streamdal.ProcessResponse)
+        assert res.data is req.data
+        assert res.status == protos.ExecStatus.EXEC_STATUS_TRUE
+        assert res.status_message is None
+        assert res.pipeline_status == []
+        assert res.metadata == {}
+
+        # Same as a response built the usual way, and nothing is shared between them
+        expected = streamdal.ProcessResponse(data=req.data, status=res.status)
+        assert res == expected
+        assert bytes(res) == bytes(expected)
+        assert res.to_dict() == expected.to_dict()
+        res.pipeline_status.append(protos.PipelineStatus(id="test"))
+        res.metadata["key"] = "value"
+        assert results[1].pipeline_status == []
+        assert results[1].metadata == {}
+
+        # The audience is built and announced once
+        assert len(self.client.routes) == 1
+        assert len(self.client.audiences) == 1
+        self.client.metrics.incr.assert_not_called()
+        self.client.metrics.counter.assert_not_called()
+
+    def test_passthrough_response_copy(self):
+        # The pinned betterproto version gets the cheaper copy
+        assert streamdal.passthrough_response is streamdal.copy_passthrough_response
+
+        for data in (b"", b"{}", bytes(range(256))):
+            copied = streamdal.copy_passthrough_response(data)
+            built = streamdal.build_passthrough_response(data)
+            assert streamdal.same_message(copied, built)
+            assert bytes(copied) == bytes(built)
+            assert copied.to_dict() == built.to_dict()
+            assert copied.to_json() == built.to_json()
+
+    def test_audiences_interned(self):
+        cmd = protos.Command(
+            audience=protos.Audience(
+                component_name="kafka",
+                service_name="testing",
+                operation_name="interned",
+                operation_type=protos.OperationType.OPERATION_TYPE_CONSUMER,
+            ),
+            set_pipelines=protos.SetPipelinesCommand(pipelines=[]),
+        )
+        self.client._set_pipelines(cmd)
+
+        req = streamdal.ProcessRequest(
+            data=b"{}",
+            operation_type=streamdal.OPERATION_TYPE_CONSUMER,
+            component_name="kafka",
+            operation_name="interned",
+        )
+        self.client.process(req)
+
+        # Pipelines, audiences and the route of process() share one Audience object
+        route = list(self.client.routes.values())[0]
+        assert route.aud is cmd.audience
+        assert self.client.audiences[route.key] is route.aud
+        assert self.client._get_pipelines(route.aud).aud is route.aud
+
+    def test_process_passthrough_with_tail(self):
+        req = streamdal.ProcessRequest(
+            data=b"{}",
+            operation_type=streamdal.OPERATION_TYPE_CONSUMER,
+            component_name="kafka",
+            operation_name="tailed",
+        )
+        self.client.process(req)
+
+        tail = mock.Mock()
+        tail.should_send.return_value = True
+        route = list(self.client.routes.values())[0]
+        self.client.tails[route.key] = {"tail-id": tail}
+
+        res = self.client.process(req)
+
+        assert isinstance(res, streamdal.ProcessResponse)
+        tail.put.assert_called_once()
+
+    def test_release_process_modules(self):
+        self.client.process_pool = mock.Mock()
+        cmd = protos.Command(
+            audience=protos.Audience(service_name="testing"),
+            set_pipelines=protos.SetPipelinesCommand(
+                pipelines=[
+                    protos.Pipeline(
+                        id="one",
+                        steps=[
+                            protos.PipelineStep(wasm_id="kept"),
+                            protos.PipelineStep(wasm_id="released"),
+                        ],
+                    )
+                ]
+            ),
+        )
+        pipelines = plan.compile_pipelines(cmd, "testing", mock.Mock(), mock.Mock())
+        self.client.functions.acquire(["kept", "kept", "released"])
+
+        # Only modules no other plan uses are dropped from the worker processes
+        self.client._release_functions(pipelines)
+        self.client.process_pool.unregister.assert_called_once_with("released")
 
     def test_notify_condition(self):
         fake_stub = mock.AsyncMock()
@@ -68,16 +196,26 @@ class TestStreamdalClient:
         self.client.metrics = fake_metrics
         self.client.grpc_stub = fake_stub
 
-        pipeline = protos.Pipeline(id=uuid.uuid4().__str__())
+        aud = protos.Audience()
+        pipeline = plan.compile_pipeline(
+            protos.Pipeline(id=uuid.uuid4().__str__()),
+            aud,
+            "testing",
+            fake_metrics.counter,
+            fake_metrics.histogram,
+        )
         step = protos.PipelineStep(name="test")
         step.on_true = protos.PipelineStepConditions(
             notify=True,
         )
-        aud = protos.Audience()
 
-        self.client._notify_condition(pipeline, step, aud, step.on_true, b"")
+        future = self.client._notify_condition(pipeline, step, aud, step.on_true, b"")
+        future.result(timeout=1)
         fake_stub.notify.assert_called_once()
-        fake_metrics.incr.assert_called_once()
+
+        # Counted through the pipeline's handle, no CounterEntry is built
+        pipeline.notify.add.assert_called_once()
+        fake_metrics.incr.assert_not_called()
 
     def test_process_success(self):
         wasm_resp = protos.WasmResponse(
@@ -194,6 +332,9 @@ class TestStreamdalClient:
             )
         )
 
+        # The notification is sent on the reactor, which runs its calls in order
+        client.reactor.call(asyncio.sleep(0), timeout=1)
+
         assert resp is not None
         fake_stub.notify.assert_called_once()
         assert resp.status == protos.ExecStatus.EXEC_STATUS_FALSE
@@ -267,6 +408,87 @@ class TestStreamdalClient:
         assert resp.status == protos.ExecStatus.EXEC_STATUS_TRUE
         assert resp.data == b'{"object": {"type": "streamdal"}}'
 
+    def test_process_batch(self):
+        wasm_resp = protos.WasmResponse(
+            output_payload=b'{"object": {"type": "streamdal"}}',
+            exit_code=protos.WasmExitCode.WASM_EXIT_CODE_FALSE,
+            exit_msg="field not found",
+        )
+        self.client._call_wasm = mock.MagicMock()
+        self.client._call_wasm.return_value = wasm_resp
+
+        pipeline = protos.Pipeline(
+            id=uuid.uuid4().__str__(),
+            name="batch",
+            steps=[
+                protos.PipelineStep(
+                    name="test",
+                    on_false=protos.PipelineStepConditions(
+                        abort=protos.AbortCondition.ABORT_CONDITION_ABORT_CURRENT
+                    ),
+                    detective=protos.steps.DetectiveStep(
+                        path="object.type",
+                        args=["batch"],
+                        type=protos.steps.DetectiveType.DETECTIVE_TYPE_STRING_CONTAINS_ANY,
+                    ),
+                )
+            ],
+        )
+
+        cmd = protos.Command(
+            audience=protos.Audience(
+                component_name="kafka",
+                operation_name="test-topic",
+                service_name="testing",
+                operation_type=protos.OperationType.OPERATION_TYPE_PRODUCER,
+            ),
+            set_pipelines=protos.SetPipelinesCommand(pipelines=[pipeline]),
+        )
+
+        handles = {}
+
+        def counter(name, labels, aud=None):
+            return handles.setdefault((name, tuple(labels.items())), mock.Mock())
+
+        self.client.metrics.counter.side_effect = counter
+        self.client._set_pipelines(cmd)
+
+        reqs = [
+            streamdal.ProcessRequest(
+                data=b'{"object": {"type": "streamdal"}}',
+                operation_type=streamdal.OPERATION_TYPE_PRODUCER,
+                component_name=component,
+                operation_name="test-topic",
+            )
+            for component in ["kafka", "kafka", "other", "kafka"]
+        ]
+
+        expected = [self.client.process(req) for req in reqs]
+        (processed,) = [
+            h for (name, _), h in handles.items() if name == "counter_produce_processed"
+        ]
+        assert processed.add.call_count == 3
+
+        for handle in handles.values():
+            handle.reset_mock()
+
+        results = self.client.process_batch(reqs)
+
+        assert results == expected
+        assert len(self.client.audiences) == 2
+
+        # Increments are aggregated into one add() per distinct counter
+        for handle in handles.values():
+            assert handle.add.call_count <= 1
+        processed.add.assert_called_once_with(3.0)
+
+    def test_process_batch_validation(self):
+        with pytest.raises(ValueError, match="reqs is required"):
+            self.client.process_batch(None)
+
+        with pytest.raises(ValueError, match="req is required"):
+            self.client.process_batch([None])
+
     def test_tail_request_start(self, mocker):
         m = mock.Mock()
         mocker.patch("streamdal.StreamdalClient._start_tail", m)
@@ -414,16 +636,16 @@ class TestStreamdalClient:
         )
 
         tail_mock = mock.Mock()
-        tail_mock.start_tail_workers = mock.Mock()
+        tail_mock.start = mock.Mock()
 
         mocker.patch("streamdal.Tail.__new__", return_value=tail_mock)
 
         tail = object.__new__(streamdal.Tail)
-        tail.start_tail_workers = mock.Mock()
+        tail.start = mock.Mock()
 
         self.client._start_tail(cmd)
         assert len(self.client.tails) == 1
-        assert tail_mock.start_tail_workers.called_once()
+        assert tail_mock.start.called_once()
 
     def test_stop_tail(self):
         tail_id = uuid.uuid4().__str__()
@@ -444,6 +666,7 @@ class TestStreamdalClient:
         tail = object.__new__(streamdal.Tail)
         tail.request = req
         tail.exit = threading.Event()
+        tail.queue = queue.SimpleQueue()
 
         cmd = protos.Command(
             tail=protos.TailCommand(request=req),
@@ -456,6 +679,46 @@ class TestStreamdalClient:
         self.client._stop_tail(cmd)
         assert len(self.client.tails) == 0
 
+    def test_tail_stop_wakes_iterator(self):
+        tail = object.__new__(streamdal.Tail)
+        tail.exit = threading.Event()
+        tail.queue = queue.SimpleQueue()
+        tail.reactor = self.client.reactor
+
+        async def collect():
+            return [msg async for msg in tail.tail_iterator()]
+
+        # Messages queued before the tail is stopped are all delivered
+        messages = [f"message-{i}" for i in range(10)]
+        for msg in messages:
+            tail.put(msg)
+        tail.stop()
+
+        # The iterator returns on the sentinel without waiting for its poll timeout
+        future = self.client.reactor.submit(collect())
+        assert future.result(timeout=0.5) == messages
+        assert tail.queue.empty()
+
+    def test_tail_put_wakes_iterator(self):
+        tail = object.__new__(streamdal.Tail)
+        tail.exit = threading.Event()
+        tail.queue = queue.SimpleQueue()
+        tail.reactor = self.client.reactor
+        waiting = threading.Event()
+
+        async def collect():
+            iterator = tail.tail_iterator()
+            waiting.set()
+            return [msg async for msg in iterator]
+
+        future = self.client.reactor.submit(collect())
+        assert waiting.wait(0.5)
+
+        # Whether or not the iterator is waiting yet, put() gets the messages to it
+        tail.put("message")
+        tail.stop()
+        assert future.result(timeout=0.5) == ["message"]
+
     def test_remove_tail(self):
         tail_id = uuid.uuid4().__str__()
 
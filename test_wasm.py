@@ -1,10 +1,16 @@
-import asyncio
 import pytest
+import threading
+import time
 import streamdal
+import streamdal.plan as plan
+import streamdal.wasm as wasm
 import streamdal_protos.protos as protos
 import unittest.mock as mock
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from streamdal import StreamdalClient, StreamdalConfig, hostfunc, kv
+from streamdal.reactor import Reactor
+from test_module_cache import SPIN_WAT, WAT
 
 
 class TestStreamdalWasm:
@@ -14,11 +20,18 @@ class TestStreamdalWasm:
     def before_each(self):
         client = object.__new__(StreamdalClient)
         client.cfg = StreamdalConfig(service_name="testing")
-        client.functions = {}
+        client.functions = wasm.FunctionCache()
+        client.linker = None
+        client.process_pool = None
         client.kv = kv.KV()
         client.host_func = hostfunc.HostFunc(kv=client.kv)
         client.paused_pipelines = {}
         client.pipelines = {}
+        client.pending_pipelines = {}
+        client.routes = {}
+        client.audience_registry = streamdal.common.AudienceRegistry()
+        client.pipelines_lock = threading.Lock()
+        client.warmup_pool = ThreadPoolExecutor(max_workers=1)
         client.audiences = {}
         client.tails = {}
         client.paused_tails = {}
@@ -26,10 +39,12 @@ class TestStreamdalWasm:
         client.log = mock.Mock()
         client.metrics = mock.Mock()
         client.grpc_stub = mock.AsyncMock()
-        client.register_stub = mock.AsyncMock()
-        client.grpc_loop = asyncio.get_event_loop()
-        client.register_loop = asyncio.get_event_loop()
+        client.reactor = Reactor("localhost", 8082)
+        client.reactor.start()
         self.client = client
+        yield
+        client.reactor.stop()
+        client.warmup_pool.shutdown()
 
     def test_call_wasm_failure(self, mocker):
         mocker.patch(
@@ -45,6 +60,402 @@ class TestStreamdalWasm:
         assert res is not None
         assert res.exit_code == 3
 
+    def new_spin_step(self, **kwargs) -> protos.PipelineStep:
+        return protos.PipelineStep(
+            name="spin",
+            wasm_bytes=SPIN_WAT,
+            wasm_id=uuid.uuid4().__str__(),
+            wasm_function="f",
+            **kwargs,
+        )
+
+    def process_spin_pipeline(self, steps: list, add) -> protos.SdkResponse:
+        aud = protos.Audience(
+            service_name="testing",
+            component_name="kafka",
+            operation_type=protos.OperationType.OPERATION_TYPE_CONSUMER,
+            operation_name="topic",
+        )
+        cmd = protos.Command(
+            audience=aud,
+            set_pipelines=protos.SetPipelinesCommand(
+                pipelines=[protos.Pipeline(id="spin", name="spin", steps=steps)]
+            ),
+        )
+        req = streamdal.ProcessRequest(
+            operation_type=streamdal.OPERATION_TYPE_CONSUMER,
+            operation_name="topic",
+            component_name="kafka",
+            data=b"{}",
+        )
+
+        self.pipelines = plan.compile_pipelines(
+            cmd,
+            "testing",
+            lambda name, labels, aud: streamdal.metrics.CounterEntry(
+                name=name, labels=labels, aud=aud
+            ),
+            lambda name, labels, aud: mock.Mock(),
+        )
+        return self.client._process(req, aud, self.pipelines, add)
+
+    def test_call_wasm_timeout(self):
+        """Test a step running past its timeout is interrupted and returns an error"""
+        step = self.new_spin_step()
+        on_timeout = mock.Mock()
+
+        res = self.client._call_wasm(
+            step=step, data=b"", isr=None, timeout=0.02, on_timeout=on_timeout
+        )
+
+        assert res.exit_code == protos.WasmExitCode.WASM_EXIT_CODE_ERROR
+        assert "timeout" in res.exit_msg
+        on_timeout.assert_called_once()
+
+        # The interrupted instance is not returned to the pool
+        stats = self.client.function_stats()[step.wasm_id]
+        assert stats["size"] == 0
+
+    def test_step_timeout(self):
+        """Test a timed out step applies on_error and increments the timeouts counter"""
+        self.client.cfg = StreamdalConfig(service_name="testing", step_timeout=0.02)
+        add = mock.Mock()
+
+        step = self.new_spin_step(
+            on_error=protos.PipelineStepConditions(
+                abort=protos.AbortCondition.ABORT_CONDITION_ABORT_ALL
+            )
+        )
+
+        resp = self.process_spin_pipeline([step], add)
+
+        assert resp.status == protos.ExecStatus.EXEC_STATUS_ERROR
+        assert "timeout" in resp.status_message
+        add.assert_any_call(self.pipelines.pipelines[0].timeouts, 1.0)
+
+    def test_instance_recycled(self):
+        """Test instances are replaced after wasm_instance_max_calls and recycles are counted"""
+        self.client.cfg = StreamdalConfig(
+            service_name="testing", wasm_instance_max_calls=2
+        )
+        add = mock.Mock()
+        step = protos.PipelineStep(
+            name="wat",
+            wasm_bytes=WAT,
+            wasm_id=uuid.uuid4().__str__(),
+            wasm_function="f",
+        )
+
+        for _ in range(5):
+            self.process_spin_pipeline([step], add)
+
+        recycles = [
+            c
+            for c in add.call_args_list
+            if c[0][0].name == streamdal.metrics.COUNTER_WASM_RECYCLES
+        ]
+        assert len(recycles) == 2
+
+        stats = self.client.function_stats()[step.wasm_id]
+        assert stats["recycles"] == 2
+        assert stats["instances"][0]["calls"] == 1
+
+    def test_pipeline_timeout(self):
+        """Test steps share the pipeline timeout"""
+        self.client.cfg = StreamdalConfig(
+            service_name="testing", step_timeout=2, pipeline_timeout=0.1
+        )
+        add = mock.Mock()
+        call_wasm = mock.Mock(wraps=self.client._call_wasm)
+        self.client._call_wasm = call_wasm
+
+        started = time.monotonic()
+        resp = self.process_spin_pipeline(
+            [self.new_spin_step(), self.new_spin_step()], add
+        )
+        elapsed = time.monotonic() - started
+
+        # Each step only gets what is left of the pipeline's budget
+        timeouts = [c.args[3] for c in call_wasm.call_args_list]
+        assert len(timeouts) == 2
+        assert timeouts[0] <= 0.1
+        assert timeouts[1] <= 0.1 - timeouts[0] + 0.01
+
+        # Both steps ran into the budget and were counted as timeouts
+        assert len(resp.pipeline_status[0].step_status) == 2
+        counter = self.pipelines.pipelines[0].timeouts
+        assert add.call_args_list.count(mock.call(counter, 1.0)) == 2
+
+        # Without the pipeline budget the two steps would take 4 seconds
+        assert elapsed < 2
+
+    def set_wat_pipelines(self, aud: protos.Audience, wasm_id: str) -> None:
+        self.client._set_pipelines(
+            protos.Command(
+                audience=aud,
+                set_pipelines=protos.SetPipelinesCommand(
+                    pipelines=[
+                        protos.Pipeline(
+                            id=wasm_id,
+                            name=wasm_id,
+                            steps=[
+                                protos.PipelineStep(
+                                    name="wat",
+                                    wasm_bytes=WAT,
+                                    wasm_id=wasm_id,
+                                    wasm_function="f",
+                                )
+                            ],
+                        )
+                    ]
+                ),
+            )
+        )
+
+    def blocked_warmup(self, policy: str):
+        """Start warming pipelines in the background, blocked until the returned event is set"""
+        self.client.cfg = StreamdalConfig(service_name="testing", warmup_policy=policy)
+        self.client.warmup_pool = ThreadPoolExecutor(max_workers=1)
+
+        release = threading.Event()
+        warm_step = self.client._warm_step
+
+        def blocked(step):
+            release.wait()
+            warm_step(step)
+
+        self.client._warm_step = blocked
+
+        return release
+
+    def new_aud(self) -> protos.Audience:
+        return protos.Audience(
+            service_name="testing",
+            component_name="kafka",
+            operation_type=protos.OperationType.OPERATION_TYPE_PRODUCER,
+            operation_name="warmup",
+        )
+
+    def new_request(self) -> streamdal.ProcessRequest:
+        return streamdal.ProcessRequest(
+            operation_type=streamdal.OPERATION_TYPE_PRODUCER,
+            operation_name="warmup",
+            component_name="kafka",
+            data=b"{}",
+        )
+
+    def test_set_pipelines_warmup(self):
+        """Test modules are compiled and instantiated before pipelines become active"""
+        self.client.warmup_pool = ThreadPoolExecutor(max_workers=1)
+        aud = self.new_aud()
+        wasm_id = uuid.uuid4().__str__()
+
+        self.set_wat_pipelines(aud, wasm_id)
+
+        assert self.client.wait_for_pipelines(5)
+
+        pipelines = self.client.pipelines[streamdal.common.aud_to_str(aud)]
+        assert pipelines.ready.is_set()
+        assert pipelines.pipelines[0].steps[0].function is not None
+        assert self.client.function_stats()[wasm_id]["size"] == 1
+        assert self.client.pending_pipelines == {}
+
+    def test_previous_pipelines_used_while_warming(self):
+        aud = self.new_aud()
+        self.set_wat_pipelines(aud, "old")
+        old = self.client._get_pipelines(aud)
+
+        release = self.blocked_warmup(streamdal.WARMUP_POLICY_WAIT)
+        self.set_wat_pipelines(aud, "new")
+
+        assert self.client._get_pipelines(aud) is old
+
+        release.set()
+        assert self.client.wait_for_pipelines(5)
+        assert self.client._get_pipelines(aud).pipelines[0].id == "new"
+
+    def test_warmup_policy_fail_open(self):
+        release = self.blocked_warmup(streamdal.WARMUP_POLICY_FAIL_OPEN)
+        self.set_wat_pipelines(self.new_aud(), "new")
+
+        resp = self.client.process(self.new_request())
+
+        assert resp.status == protos.ExecStatus.EXEC_STATUS_TRUE
+        assert resp.pipeline_status == []
+        assert not self.client.wait_for_pipelines(0.01)
+
+        release.set()
+
+    def test_warmup_policy_fail_closed(self):
+        release = self.blocked_warmup(streamdal.WARMUP_POLICY_FAIL_CLOSED)
+        self.set_wat_pipelines(self.new_aud(), "new")
+
+        resp = self.client.process(self.new_request())
+        batch = self.client.process_batch([self.new_request(), self.new_request()])
+
+        assert resp.status == protos.ExecStatus.EXEC_STATUS_ERROR
+        assert resp.status_message == "Pipelines are not ready yet"
+        assert resp.data == b"{}"
+        assert [r.status for r in batch] == [protos.ExecStatus.EXEC_STATUS_ERROR] * 2
+
+        release.set()
+
+    def test_warmup_policy_wait(self):
+        release = self.blocked_warmup(streamdal.WARMUP_POLICY_WAIT)
+        self.set_wat_pipelines(self.new_aud(), "new")
+
+        results = []
+        t = threading.Thread(
+            target=lambda: results.append(self.client.process(self.new_request()))
+        )
+        t.start()
+        t.join(0.05)
+        assert results == []
+
+        release.set()
+        t.join(5)
+
+        assert len(results) == 1
+        assert results[0].pipeline_status[0].id == "new"
+
+    def test_warmup_policy_wait_timeout(self):
+        release = self.blocked_warmup(streamdal.WARMUP_POLICY_WAIT)
+        self.client.cfg = StreamdalConfig(
+            service_name="testing",
+            warmup_policy=streamdal.WARMUP_POLICY_WAIT,
+            warmup_timeout=0.05,
+        )
+        self.set_wat_pipelines(self.new_aud(), "new")
+
+        # Payloads are failed closed once warmup takes longer than warmup_timeout
+        resp = self.client.process(self.new_request())
+
+        assert resp.status == protos.ExecStatus.EXEC_STATUS_ERROR
+        assert resp.status_message == "Pipelines are not ready yet"
+
+        release.set()
+
+    def test_set_pipelines_after_shutdown(self):
+        self.client.cfg = StreamdalConfig(service_name="testing", warmup_timeout=0.05)
+        self.client.warmup_pool.shutdown()
+        self.set_wat_pipelines(self.new_aud(), "new")
+
+        # Nothing warms them up, so they are used as they are instead of never being ready
+        resp = self.client.process(self.new_request())
+
+        assert resp.pipeline_status[0].id == "new"
+
+    def test_superseded_pipelines_not_activated(self):
+        aud = self.new_aud()
+        release = self.blocked_warmup(streamdal.WARMUP_POLICY_WAIT)
+        self.set_wat_pipelines(aud, "slow")
+
+        # Pipelines without modules to load are active right away
+        self.client._set_pipelines(
+            protos.Command(
+                audience=aud,
+                set_pipelines=protos.SetPipelinesCommand(pipelines=[]),
+            )
+        )
+        assert len(self.client._get_pipelines(aud)) == 0
+
+        release.set()
+        assert self.client.wait_for_pipelines(5)
+        self.client.warmup_pool.shutdown(wait=True)
+
+        assert len(self.client._get_pipelines(aud)) == 0
+
+    def test_replaced_pipelines_evicted(self):
+        """Test modules no longer used by any pipelines are evicted over budget"""
+        self.client.functions = wasm.FunctionCache(max_unused=0)
+        aud = self.new_aud()
+        old_id = uuid.uuid4().__str__()
+
+        self.set_wat_pipelines(aud, old_id)
+        assert self.client.wait_for_pipelines(5)
+        assert old_id in self.client.functions
+
+        self.set_wat_pipelines(aud, uuid.uuid4().__str__())
+        assert self.client.wait_for_pipelines(5)
+
+        assert old_id not in self.client.functions
+        assert self.client.function_cache_stats()["evictions"] == 1
+        assert self.client.function_cache_stats()["functions"] == 1
+
+        name = self.client.metrics.counter.call_args[0][0]
+        assert name == streamdal.metrics.COUNTER_WASM_EVICTIONS
+        self.client.metrics.counter.return_value.add.assert_called_with(1.0)
+
+    def test_pipelines_release_module_bytes(self):
+        """Test stored pipelines don't hold module bytes once they are compiled"""
+        aud = self.new_aud()
+        wasm_id = uuid.uuid4().__str__()
+        wasm_bytes = WAT + f";; {wasm_id}".encode()
+        released = self.client.function_cache_stats()["released_bytes"]
+
+        self.client._set_pipelines(
+            protos.Command(
+                audience=aud,
+                set_pipelines=protos.SetPipelinesCommand(
+                    pipelines=[
+                        protos.Pipeline(
+                            id=wasm_id,
+                            name=wasm_id,
+                            steps=[
+                                protos.PipelineStep(
+                                    name="wat",
+                                    wasm_bytes=wasm_bytes,
+                                    wasm_id=wasm_id,
+                                    wasm_function="f",
+                                )
+                            ],
+                        )
+                    ]
+                ),
+            )
+        )
+
+        pipeline = self.client._get_pipelines(aud).pipelines[0]
+        step = pipeline.steps[0]
+
+        assert not step.step.wasm_bytes
+        assert not pipeline.pipeline.steps[0].wasm_bytes
+        assert wasm.modules.source(step.module_key) is None
+
+        stats = self.client.function_cache_stats()
+        assert stats["released_bytes"] - released == len(wasm_bytes)
+
+    def test_call_wasm_concurrent(self):
+        """Test concurrent callers each get their own instance of the module"""
+        self.client.cfg = StreamdalConfig(service_name="testing", wasm_pool_size=2)
+
+        step = protos.PipelineStep(
+            name="concurrent",
+            wasm_bytes=WAT,
+            wasm_id=uuid.uuid4().__str__(),
+            wasm_function="f",
+        )
+
+        results = []
+
+        def work():
+            for _ in range(25):
+                results.append(self.client._call_wasm(step=step, data=b"{}", isr=None))
+
+        workers = [threading.Thread(target=work) for _ in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert len(results) == 100
+        assert all(r.exit_code == 1 and r.exit_msg == "ok" for r in results)
+
+        stats = self.client.function_stats()[step.wasm_id]
+        assert stats["checkouts"] == 100
+        assert 1 <= stats["size"] <= 2
+        assert stats["in_use"] == 0
+
     def test_detective_wasm(self):
         """Test we can execute the detective wasm file"""
 